@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import psycopg2
+
+from erbium import init_database, insert_data, load_data
+from map_select_queries import compile_query, locate_attributes
+from map_query_results import decode_rows
+from generate_data_univ import generate
+from sql_analyzer import parse_and_analyze
+
+##############################################################################################################
+### End-to-end benchmark of the physical mappings of a schema (the connected_subgraphsN of example.json):
+###
+###     python3 bench_mappings.py [--schema example.json] [--mappings connected_subgraphs1,...] [--scales 0.01,0.1]
+###                               [--runs N] [--out report.json] [--baseline old_report.json]
+###                               [--composite-storage flattened,row,jsonb]
+###     python3 bench_mappings.py --diff old_report.json new_report.json
+###
+### For every mapping and scale factor, a database (erbench_<mapping>_<scale>) is initialized with the mapping and
+### loaded with the data of generate_data_univ.py (the same data for all mappings), and then the query mix below is
+### run against it. The report has, per mapping and scale factor:
+###   - init and load times (and instances loaded per second)
+###   - table sizes (pg_total_relation_size, including indexes)
+###   - per query: compile time, latency percentiles and throughput over the runs (executing the SQL, fetching and
+###     decoding the rows), the number of rows, and the shared buffers hit/read (EXPLAIN (ANALYZE, BUFFERS))
+### Reports of two revisions (or two runs) can be compared with --diff, or with --baseline right after a run.
+###
+### With --composite-storage, every mapping is also run once per storage of the composite attributes (see
+### construct_create_statements.composite_columns), with all of them stored that way (erbench_<mapping>_<storage>_
+### <scale>), so the table sizes, load times and the scans and filters over person.name can be compared per format.
+##############################################################################################################
+
+# The ER language has no joins between entities; the subclass scans (instructor, student) are where the mappings
+# differ in how many tables are joined, and the traversals join the prereq relationship with itself (starting
+# from a course that has prerequisites in the generated data)
+QUERY_MIX = {
+    "scan_person": "select * from person",
+    "scan_instructor": "select * from instructor",
+    "scan_student": "select * from student",
+    "project_names": "select person_id, name from person",
+    "filter_lastname": "select person_id, name from person where {lastname} like 'S%'",
+    "filter_city": "select person_id, city from person where city like 'S%'",
+    "point_person": "select * from person where person_id = 1",
+    "group_by_city": "select city, count(*) as n from person group by city order by n desc limit 10",
+    "multivalued_phones": "select person_id, phone_numbers from person",
+    "unnest_phones": "select person_id, count(phone_numbers) as phones from person group by person_id",
+    "closure_prereq": "closure of prereq from {course_id}",
+    "paths_prereq": "paths of prereq from {course_id} max depth 3",
+}
+
+# The lastname of person.name in a (passed through) WHERE condition, which depends on how the composite is stored
+LASTNAME = {"flattened": "name__lastname", "row": "(name).lastname", "jsonb": "name->>'lastname'"}
+
+def percentile(times, p):
+    times = sorted(times)
+    k = (len(times) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(times) - 1)
+    return times[lo] + (times[hi] - times[lo]) * (k - lo)
+
+def latency_summary(times):
+    return {
+        "p50_ms": round(percentile(times, 50) * 1000, 3),
+        "p95_ms": round(percentile(times, 95) * 1000, 3),
+        "p99_ms": round(percentile(times, 99) * 1000, 3),
+        "mean_ms": round(statistics.mean(times) * 1000, 3),
+        "throughput_qps": round(len(times) / sum(times), 1),
+    }
+
+def db_name_for(mapping, scale, storage=None):
+    return f"erbench_{mapping}_{storage + '_' if storage else ''}{str(scale).replace('.', '_')}".lower()
+
+def result_key(mapping, scale, storage=None):
+    return f"{mapping}/{storage}@{scale}" if storage else f"{mapping}@{scale}"
+
+# The (top-level) composite attributes of the schema, to be stored as storage (a multivalued one cannot be flattened)
+def composite_storage(data, storage):
+    names = {}
+    for statement in data["create_entity_statements"] + data["create_relationship_statements"]:
+        result = parse_and_analyze(statement)
+        for attr in result["attributes"]:
+            if attr["attr_type"] == 'COMPOSITE' and not (storage == "flattened" and attr["is_multivalued"]):
+                names[f"{result['table_name']}.{attr['attr_name']}".lower()] = storage
+    return names
+
+def drop_database(db_name):
+    conn = psycopg2.connect(dbname="postgres")
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS {db_name} WITH (FORCE)")
+    cursor.close()
+    conn.close()
+
+# The shared buffers hit and read by one run of the query (summed over the plan)
+def buffer_counts(cursor, sql):
+    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}")
+    plan = cursor.fetchone()[0][0]
+    return {"shared_hit": plan["Plan"].get("Shared Hit Blocks", 0), "shared_read": plan["Plan"].get("Shared Read Blocks", 0)}
+
+def table_sizes(cursor, tables):
+    sizes = {}
+    for table_name, _ in tables:
+        cursor.execute("SELECT pg_total_relation_size(%s)", (table_name,))
+        sizes[table_name] = cursor.fetchone()[0]
+    sizes["total"] = sum(sizes.values())
+    return sizes
+
+def start_course(data_dir):
+    course_id = 0
+    with open(os.path.join(data_dir, "prereq.jsonl")) as f:
+        for line in f:
+            course_id = json.loads(line)["course_id"]
+    return course_id
+
+def run_query_mix(db_name, runs, course_id):
+    tables, types, graph = load_data(db_name)
+    conn = psycopg2.connect(f"dbname={db_name}")
+    cursor = conn.cursor()
+    cursor.execute("ANALYZE")
+    conn.commit()
+
+    report = {"table_sizes": table_sizes(cursor, tables), "queries": {}}
+    lastname = LASTNAME[locate_attributes(tables, graph.get_node_by_name("person"))["name"]["storage"]]
+    for name, query in QUERY_MIX.items():
+        start = time.perf_counter()
+        result, sql = compile_query(query.format(course_id=course_id, lastname=lastname), tables, graph)
+        compile_time = time.perf_counter() - start
+        entity = None if 'traversal' in result else graph.get_node_by_name(result['table_name'])
+
+        times = []
+        for i in range(runs + 1):
+            start = time.perf_counter()
+            cursor.execute(sql)
+            column_names = [d[0] for d in cursor.description]
+            rows = decode_rows(cursor.fetchall(), column_names, entity)
+            elapsed = time.perf_counter() - start
+            # the first run warms up the buffers (and the plan cache)
+            if i > 0:
+                times.append(elapsed)
+        report["queries"][name] = dict(latency_summary(times), compile_ms=round(compile_time * 1000, 3), rows=len(rows),
+                                       buffers=buffer_counts(cursor, sql))
+        conn.rollback()
+
+    cursor.close()
+    conn.close()
+    return report
+
+def bench_mapping(schema, mapping, scale, data_dir, runs, keep, storage=None):
+    db_name = db_name_for(mapping, scale, storage)
+    with open(schema) as f:
+        data = json.load(f)
+    data["use_connected_subgraph"] = mapping
+    if storage:
+        data["composite_storage"] = composite_storage(data, storage)
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(data, f)
+        schema_file = f.name
+
+    try:
+        start = time.perf_counter()
+        init_database(db_name, schema_file)
+        init_time = time.perf_counter() - start
+    finally:
+        os.unlink(schema_file)
+
+    with open(os.path.join(data_dir, "manifest.json")) as f:
+        instances = sum(json.load(f)["counts"].values())
+    start = time.perf_counter()
+    insert_data(db_name, data_dir)
+    load_time = time.perf_counter() - start
+
+    report = {"init_s": round(init_time, 3), "load_s": round(load_time, 3), "instances": instances,
+              "load_instances_per_s": round(instances / load_time, 1)}
+    report.update(run_query_mix(db_name, runs, start_course(data_dir)))
+    if not keep:
+        drop_database(db_name)
+    return report
+
+def run(schema, mappings, scales, runs, seed, keep, storages=(None,)):
+    report = {"schema": schema, "runs": runs, "seed": seed, "results": {}}
+    for scale in scales:
+        # the same data for every mapping
+        with tempfile.TemporaryDirectory() as data_dir:
+            generate(data_dir, scale, seed, fmt="jsonl")
+            for mapping in mappings:
+                for storage in storages:
+                    print(f"{result_key(mapping, scale, storage)}...", flush=True)
+                    report["results"][result_key(mapping, scale, storage)] = \
+                        bench_mapping(schema, mapping, scale, data_dir, runs, keep, storage)
+    return report
+
+##############################################################################################################
+### Comparing reports
+##############################################################################################################
+def ratio(old, new):
+    return f"{new / old:.2f}x" if old else "-"
+
+def diff_reports(old, new):
+    lines = []
+    for key in sorted(set(old["results"]) & set(new["results"])):
+        a, b = old["results"][key], new["results"][key]
+        lines.append(f"{key}")
+        lines.append(f"  {'load_s':<22} {a['load_s']:>10} {b['load_s']:>10} {ratio(a['load_s'], b['load_s']):>8}")
+        lines.append(f"  {'table bytes':<22} {a['table_sizes']['total']:>10} {b['table_sizes']['total']:>10} "
+                     f"{ratio(a['table_sizes']['total'], b['table_sizes']['total']):>8}")
+        for name in a["queries"]:
+            if name in b["queries"]:
+                qa, qb = a["queries"][name], b["queries"][name]
+                lines.append(f"  {name + ' p50_ms':<22} {qa['p50_ms']:>10} {qb['p50_ms']:>10} {ratio(qa['p50_ms'], qb['p50_ms']):>8}")
+    return "\n".join(lines)
+
+def summarize(report):
+    lines = []
+    names = list(QUERY_MIX)
+    lines.append(f"{'':<36}{'load_s':>9}{'MB':>8}" + "".join(f"{n[:14]:>16}" for n in names))
+    for key, r in report["results"].items():
+        lines.append(f"{key:<36}{r['load_s']:>9}{r['table_sizes']['total'] / 2**20:>8.1f}" +
+                     "".join(f"{r['queries'][n]['p50_ms']:>16}" for n in names if n in r["queries"]))
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the physical mappings of a schema")
+    parser.add_argument("--schema", default="example.json", help="JSON file with the schema and its connected_subgraphsN mappings")
+    parser.add_argument("--mappings", help="Comma-separated mappings to run (default: all of them)")
+    parser.add_argument("--scales", default="0.01", help="Comma-separated scale factors (see generate_data_univ.py)")
+    parser.add_argument("--runs", type=int, default=20, help="Timed runs per query")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated data")
+    parser.add_argument("--out", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="Compare with this earlier report")
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark databases")
+    parser.add_argument("--composite-storage", help="Comma-separated storages of the composite attributes to compare "
+                                                    "(flattened, row, jsonb; default: as the mapping has them)")
+    parser.add_argument("--diff", nargs=2, metavar=("OLD", "NEW"), help="Only compare two reports")
+    args = parser.parse_args()
+
+    if args.diff:
+        with open(args.diff[0]) as f, open(args.diff[1]) as g:
+            print(diff_reports(json.load(f), json.load(g)))
+        return
+
+    if args.mappings:
+        mappings = args.mappings.split(",")
+    else:
+        with open(args.schema) as f:
+            mappings = sorted(k for k in json.load(f) if k.startswith("connected_subgraphs"))
+    scales = [float(s) for s in args.scales.split(",")]
+
+    storages = args.composite_storage.split(",") if args.composite_storage else [None]
+    report = run(args.schema, mappings, scales, args.runs, args.seed, args.keep, storages)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=4)
+    print(summarize(report))
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(diff_reports(json.load(f), report))
+
+if __name__ == "__main__":
+    main()
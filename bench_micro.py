@@ -0,0 +1,285 @@
+import argparse
+import gc
+import json
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+
+from sql_parser import parse
+from sql_analyzer import parse_and_analyze
+from er_graph import Graph, serialize_graph, deserialize_graph
+from construct_create_statements import create_table_statements, figure_out_mappings
+from map_insert_statements import generate_insert_statements, match_to_schema, insert_tables
+from map_select_queries import generate_sql_query, generate_select_query
+from row_batches import RowBatch
+from psycopg2.extensions import adapt
+
+##############################################################################################################
+### Database-free micro-benchmarks of the parser, the graph and the mappers:
+###
+###     python3 bench_micro.py [--schema example.json] [--entities 20 --attributes 100 --depth 5]
+###                            [--repeat N] [--out report.json] [--baseline old_report.json] [--threshold 0.2]
+###
+### Each benchmark runs over the example schema and over a synthetic schema (--entities entities with --attributes
+### attributes each, plus a composite attribute nested --depth levels deep, which is stored as a composite type in
+### one mapping and flattened in another). Per benchmark, the report has the median and minimum time per call over
+### --repeat timed rounds (after a warm-up round, with the garbage collector off), and the bytes and blocks
+### allocated by one call and its peak memory (tracemalloc, measured separately since it slows everything down).
+###
+### insert_per_statement and insert_row_batches load the same INSERT_ROWS instances, as one rendered INSERT per
+### instance and table (as insert statements used to be loaded) and as a RowBatch per entity rendered as COPY text,
+### so that their allocations and peak memory can be compared.
+###
+### With --baseline, the medians are compared with an earlier report, and the script exits with status 1 if any of
+### them got slower by more than --threshold (e.g., 0.2 = 20%).
+##############################################################################################################
+
+# Compiled for every (non-weak) entity of the schema, next to reassembling the whole entity (generate_sql_query)
+GROUPED_QUERY = "select {attribute}, count(*) as n from {entity} group by {attribute} order by n desc limit 10"
+
+# Instances loaded per call by the insert_* benchmarks (the insert statements of the schema, over and over)
+INSERT_ROWS = 1000
+
+##############################################################################################################
+### Schemas
+##############################################################################################################
+def composite(name, depth):
+    if depth == 0:
+        return f"{name} VARCHAR"
+    return f"{name} COMPOSITE (a{depth} VARCHAR, b{depth} INT, {composite(f'c{depth}', depth - 1)})"
+
+def composite_leaves(prefix, depth):
+    if depth == 0:
+        return [prefix]
+    return [f"{prefix}.a{depth}", f"{prefix}.b{depth}"] + composite_leaves(f"{prefix}.c{depth}", depth - 1)
+
+def composite_value(depth, i):
+    if depth == 0:
+        return f"'v{i}'"
+    return f"('a{i}', {i}, {composite_value(depth - 1, i)})"
+
+# A schema in the format of example.json: entities e0..eN, each with an id, a multivalued attribute, the plain
+# attributes, and a composite attribute nested depth levels; every other entity stores the composite as a type
+# (only the composite is listed in its connected subgraph), the others flatten it (its leaves are listed)
+def synthetic_schema(entities, attributes, depth):
+    creates, subgraphs, inserts = [], [], []
+    for e in range(entities):
+        name = f"e{e}"
+        columns = [f"{name}_key INT PRIMARY KEY", "tags varchar[]"] + [f"x{i} VARCHAR" for i in range(attributes)]
+        columns.append(composite("deep", depth))
+        creates.append(f"CREATE ENTITY {name} ({', '.join(columns)});")
+        deep = [f"{name}.deep"] if e % 2 == 0 else composite_leaves(f"{name}.deep", depth)
+        subgraphs.append([name, f"{name}.{name}_key", f"{name}.tags"] + [f"{name}.x{i}" for i in range(attributes)] + deep)
+        values = [str(e), "['t1', 't2', 't3']"] + [f"'x{i}'" for i in range(attributes)] + [composite_value(depth, e)]
+        inserts.append(f"INSERT INTO {name} VALUES ({', '.join(values)});")
+    return {"create_entity_statements": creates, "create_relationship_statements": [], "use_connected_subgraph": "mapping",
+            "mapping": subgraphs, "insert_statements": inserts}
+
+# What init_database does to a schema, without the database; the graph is then serialized and deserialized, as
+# it is by load_data for every command after init
+def build_schema(data):
+    graph = Graph()
+    for statement in data["create_entity_statements"]:
+        graph.add_entity(parse_and_analyze(statement))
+    for statement in data["create_relationship_statements"]:
+        graph.add_relationship(parse_and_analyze(statement))
+    connected_subgraphs = data[data["use_connected_subgraph"]]
+    tables, types = create_table_statements(graph, connected_subgraphs, data.get("composite_storage"))
+    figure_out_mappings(graph, connected_subgraphs, tables)
+    graph_json = serialize_graph(graph)
+    return graph, tables, types, connected_subgraphs, graph_json
+
+##############################################################################################################
+### Benchmarks: name -> (function, number of items it processes per call)
+##############################################################################################################
+def benchmarks(label, data):
+    graph, tables, types, connected_subgraphs, graph_json = build_schema(data)
+    loaded = deserialize_graph(graph_json)
+    statements = data["create_entity_statements"] + data["create_relationship_statements"] + data["insert_statements"]
+    names = [node.unique_name for node in loaded.nodes]
+
+    inserts = []
+    for statement in data["insert_statements"]:
+        parsed = parse_and_analyze(statement)
+        entity = loaded.get_node_by_name(parsed["table_name"])
+        inserts.append((match_to_schema(parsed["table_name"], parsed["values"], entity), insert_tables(entity, tables, loaded)))
+    rows = [(entity, *insert) for entity, insert in zip(insert_entities(data, loaded), inserts)] * (INSERT_ROWS // max(len(inserts), 1) + 1)
+    rows = rows[:INSERT_ROWS]
+
+    # (weak entities cannot be queried on their own yet)
+    queries = []
+    for entity in loaded.nodes:
+        if entity.is_entity() and not entity.is_weak_entity:
+            attribute = next(a.unique_name.split(".", 1)[1] for a in entity.attributes if not a.is_composite and not a.is_multivalued)
+            queries.append((entity, parse_and_analyze(GROUPED_QUERY.format(entity=entity.unique_name, attribute=attribute))))
+
+    def run_parse():
+        for s in statements:
+            parse(s)
+
+    def run_parse_and_analyze():
+        for s in statements:
+            parse_and_analyze(s)
+
+    def run_get_node_by_name():
+        for name in names:
+            loaded.get_node_by_name(name)
+
+    def run_create_table_statements():
+        create_table_statements(graph, connected_subgraphs, data.get("composite_storage"))
+
+    def run_generate_insert_statements():
+        for values, relevant_tables in inserts:
+            generate_insert_statements(values, relevant_tables, types)
+
+    def run_insert_per_statement():
+        for _, values, relevant_tables in rows:
+            for _, _, statement, params in generate_insert_statements(values, relevant_tables, types):
+                # (what cursor.mogrify does, without a connection)
+                statement % tuple(adapt(p).getquoted().decode() for p in params)
+
+    def run_insert_row_batches():
+        by_entity = {}
+        for entity, values, relevant_tables in rows:
+            by_entity.setdefault(entity.unique_name, (RowBatch(entity, relevant_tables), []))[1].append(values)
+        for batch, entity_rows in by_entity.values():
+            batch.extend(entity_rows)
+            for layout in batch.layouts:
+                batch.copy_text(layout).read()
+
+    def run_generate_sql_query():
+        for entity, query in queries:
+            generate_sql_query(tables, entity, loaded)
+            generate_select_query(tables, entity, loaded, query)
+
+    return {
+        f"{label}/parse": (run_parse, len(statements)),
+        f"{label}/parse_and_analyze": (run_parse_and_analyze, len(statements)),
+        f"{label}/get_node_by_name": (run_get_node_by_name, len(names)),
+        f"{label}/serialize_graph": (lambda: serialize_graph(graph), 1),
+        f"{label}/deserialize_graph": (lambda: deserialize_graph(graph_json), 1),
+        f"{label}/create_table_statements": (run_create_table_statements, 1),
+        f"{label}/generate_insert_statements": (run_generate_insert_statements, len(inserts)),
+        f"{label}/generate_sql_query": (run_generate_sql_query, 2 * len(queries)),
+        f"{label}/insert_per_statement": (run_insert_per_statement, len(rows)),
+        f"{label}/insert_row_batches": (run_insert_row_batches, len(rows)),
+    }
+
+def insert_entities(data, graph):
+    return [graph.get_node_by_name(parse_and_analyze(statement)["table_name"]) for statement in data["insert_statements"]]
+
+##############################################################################################################
+### Measuring
+##############################################################################################################
+# Enough calls per round that a round takes at least min_round seconds, so that timer resolution does not matter
+def calls_per_round(function, min_round):
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        if time.perf_counter() - start >= min_round:
+            return calls
+        calls *= 2
+
+def measure(function, items, repeat, min_round):
+    calls = calls_per_round(function, min_round)
+    times = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(calls):
+                function()
+            times.append((time.perf_counter() - start) / calls)
+    finally:
+        gc.enable()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+    function()
+    peak = tracemalloc.get_traced_memory()[1] - current
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = [s for s in after.compare_to(before, "filename") if s.size_diff > 0 or s.count_diff > 0]
+    return {"median_us": round(statistics.median(times) * 1e6, 3), "min_us": round(min(times) * 1e6, 3),
+            "per_item_us": round(statistics.median(times) * 1e6 / max(items, 1), 3), "items": items,
+            "alloc_bytes": sum(max(s.size_diff, 0) for s in allocated), "alloc_blocks": sum(max(s.count_diff, 0) for s in allocated),
+            "peak_bytes": peak}
+
+def run(schema, entities, attributes, depth, repeat, min_round, only=None):
+    with open(schema) as f:
+        example = json.load(f)
+    suites = benchmarks("example", example)
+    suites.update(benchmarks(f"synthetic_{entities}x{attributes}_d{depth}", synthetic_schema(entities, attributes, depth)))
+
+    report = {"python": sys.version.split()[0], "repeat": repeat, "results": {}}
+    for name, (function, items) in suites.items():
+        if only and not any(o in name for o in only):
+            continue
+        print(f"{name}...", file=sys.stderr, flush=True)
+        report["results"][name] = measure(function, items, repeat, min_round)
+    return report
+
+# The benchmarks whose median got slower by more than threshold
+def regressions(baseline, report, threshold):
+    slower = []
+    for name, r in report["results"].items():
+        old = baseline["results"].get(name)
+        if old and old["median_us"] and r["median_us"] > old["median_us"] * (1 + threshold):
+            slower.append((name, old["median_us"], r["median_us"]))
+    return slower
+
+def summarize(report, baseline=None):
+    lines = [f"{'benchmark':<56}{'median us':>14}{'min us':>14}{'alloc KB':>10}{'blocks':>9}{'peak KB':>10}" + (f"{'baseline':>14}{'ratio':>8}" if baseline else "")]
+    for name, r in report["results"].items():
+        line = f"{name:<56}{r['median_us']:>14}{r['min_us']:>14}{r['alloc_bytes'] / 1024:>10.1f}{r['alloc_blocks']:>9}{r.get('peak_bytes', 0) / 1024:>10.1f}"
+        old = baseline["results"].get(name) if baseline else None
+        if old:
+            line += f"{old['median_us']:>14}{r['median_us'] / old['median_us']:>7.2f}x"
+        lines.append(line)
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the parser, the graph and the mappers (no database needed)")
+    parser.add_argument("--schema", default="example.json", help="JSON file with the create/insert statements and the mapping to use")
+    parser.add_argument("--entities", type=int, default=20, help="Entities in the synthetic schema")
+    parser.add_argument("--attributes", type=int, default=100, help="Plain attributes per entity in the synthetic schema")
+    parser.add_argument("--depth", type=int, default=5, help="Nesting depth of the composite attribute in the synthetic schema")
+    parser.add_argument("--repeat", type=int, default=7, help="Timed rounds per benchmark")
+    parser.add_argument("--min-round", type=float, default=0.05, help="Minimum seconds per timed round")
+    parser.add_argument("--only", help="Comma-separated substrings of the benchmarks to run")
+    parser.add_argument("--out", help="Write the JSON report to this file")
+    parser.add_argument("--baseline", help="Compare with this earlier report and fail on regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown (fraction of the baseline median) that counts as a regression")
+    args = parser.parse_args()
+
+    # the analyzer and mappers log at DEBUG; keep that out of the timings
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = run(args.schema, args.entities, args.attributes, args.depth, args.repeat, args.min_round,
+                 args.only.split(",") if args.only else None)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=4)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(summarize(report, baseline))
+
+    if baseline:
+        slower = regressions(baseline, report, args.threshold)
+        for name, old, new in slower:
+            print(f"REGRESSION {name}: {old} us -> {new} us ({new / old:.2f}x)")
+        if slower:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
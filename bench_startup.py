@@ -0,0 +1,88 @@
+import argparse
+import io
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import time
+
+##############################################################################################################
+### Measures what every erbium.py invocation pays before doing any real work, and the per-statement overhead
+### of parsing and analyzing:
+###
+###     python3 bench_startup.py [--runs N] [--statements example.json]
+###
+###   - startup: "python3 erbium.py --help" and "import erbium", in fresh processes
+###   - first statement: building the grammar and parsing one statement, in a fresh process
+###   - per statement: parse_and_analyze over the create, insert and select statements of the example, with
+###     logging at WARNING (the default) and at DEBUG (to show what debug output costs when it is turned on)
+##############################################################################################################
+
+def time_command(command, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+def time_in_process(code, runs):
+    # the code prints its own timing, so the interpreter's startup is left out
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        times.append(float(out.strip().splitlines()[-1]))
+    return times
+
+def summary(times):
+    return {"median_ms": round(statistics.median(times) * 1000, 3), "min_ms": round(min(times) * 1000, 3), "runs": len(times)}
+
+def statements_from(load_file):
+    with open(load_file) as f:
+        data = json.load(f)
+    statements = data["create_entity_statements"] + data["create_relationship_statements"] + data["insert_statements"]
+    statements += ["select * from person", "select city, count(*) as n from person where city like 'S%' group by city order by n desc limit 5",
+                   "select person_id, name from student order by person_id limit 10 offset 5", "closure of prereq from 1 max depth 3"]
+    return statements
+
+def time_statements(statements, level, rounds):
+    from sql_analyzer import parse_and_analyze
+    root = logging.getLogger()
+    handler = logging.StreamHandler(io.StringIO())
+    root.addHandler(handler)
+    old_level = root.level
+    root.setLevel(level)
+    try:
+        parse_and_analyze(statements[0])
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for s in statements:
+                parse_and_analyze(s)
+        elapsed = time.perf_counter() - start
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(old_level)
+    return {"per_statement_us": round(elapsed / (rounds * len(statements)) * 1e6, 1), "statements": rounds * len(statements)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup and per-statement overhead of erbium.py")
+    parser.add_argument("--runs", type=int, default=10, help="Fresh processes per startup measurement")
+    parser.add_argument("--rounds", type=int, default=5, help="Passes over the statements for the per-statement measurement")
+    parser.add_argument("--statements", default="example.json", help="JSON file with create/insert statements")
+    args = parser.parse_args()
+
+    statements = statements_from(args.statements)
+    first = statements[0].replace('"', '\\"')
+    report = {
+        "erbium.py --help": summary(time_command([sys.executable, "erbium.py", "--help"], args.runs)),
+        "import erbium": summary(time_in_process("import time; t = time.perf_counter(); import erbium; print(time.perf_counter() - t)", args.runs)),
+        "first statement": summary(time_in_process(
+            f"import time; from sql_analyzer import parse_and_analyze; t = time.perf_counter(); parse_and_analyze(\"{first}\"); print(time.perf_counter() - t)", args.runs)),
+        "per statement (WARNING)": time_statements(statements, logging.WARNING, args.rounds),
+        "per statement (DEBUG)": time_statements(statements, logging.DEBUG, args.rounds),
+    }
+    print(json.dumps(report, indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 from er_graph import NodeType, EdgeType, Graph, Edge, Node
+from map_select_queries import locate_attributes
 import json
+import logging
 from typing import List, Dict, Any, Tuple
 
 ## We could use a different modifier to create the internal primary keys 
@@ -35,15 +37,58 @@ def create_composite_type(graph: Graph, node: Node, created_types_names: set, cr
     for sub_node in node.children:
         if sub_node.attr_type == 'COMPOSITE':
             sub_type_name = create_composite_type(graph, sub_node, created_types_names, created_types)
-            sub_columns.append((sub_node.unique_name.split('.')[-1], sub_type_name))
+            sub_columns.append((sub_node.unique_name.split('.')[-1], sub_type_name + ("[]" if sub_node.is_multivalued else "")))
         else:
-            sub_columns.append((sub_node.unique_name.split('.')[-1], get_attribute_type(sub_node.attr_type)))
+            sub_columns.append((sub_node.unique_name.split('.')[-1], get_attribute_type(sub_node.attr_type) + ("[]" if sub_node.is_multivalued else "")))
 
     created_types_names.add(type_name)
     created_types[type_name] = sub_columns
 
     return type_name
 
+# How a composite attribute is stored (see the "composite_storage" of the schema file, e.g.,
+# {"person.name": "jsonb"}), whichever of its parts the connected subgraph lists:
+#   - flattened: a column per leaf, name__child (name__child__grandchild for nested composites)
+#   - row: a column of a composite type, see create_composite_type
+#   - jsonb: a JSONB column, with the (nested) value as a JSON object
+# A multivalued composite is an array of either (TYPE[], JSONB[]), or is normalized into a table of its own as
+# other multivalued attributes are (if it is the only attribute in the subgraph)
+# Without a declaration, a composite listed as a whole is a row, and one whose children are listed is flattened
+COMPOSITE_STORAGE = ["flattened", "row", "jsonb"]
+
+# The top-level composite attribute that an attribute is (a part of), if any
+def top_composite(node):
+    while node.parent_attribute is not None:
+        node = node.parent_attribute
+    return node if node.is_composite else None
+
+def flattened_columns(node, prefix):
+    columns = []
+    for child in node.children:
+        name = f"{prefix}__{child.unique_name.split('.')[-1]}"
+        if child.is_composite:
+            assert not child.is_multivalued, f"{child.unique_name} is multivalued, and cannot be flattened"
+            columns += flattened_columns(child, name)
+        else:
+            columns.append((name, get_attribute_type(child.attr_type) + ("[]" if child.is_multivalued else ""), child.unique_name))
+    return columns
+
+# A multivalued attribute that is the only attribute in its subgraph is normalized into a table of its own
+def only_attribute(graph, subgraph):
+    return len({top_composite(n) or n for n in map(graph.get_node_by_name, subgraph) if n.is_attribute()}) == 1
+
+def composite_columns(graph, node, storage, normalized, created_types_names, created_types):
+    assert storage in COMPOSITE_STORAGE, f"Unknown storage {storage} for {node.unique_name} (one of {', '.join(COMPOSITE_STORAGE)})"
+    attribute_name = node.unique_name.split('.', 1)[-1].replace('.', '__')
+    suffix = "[]" if node.is_multivalued and not normalized else ""
+    if storage == "flattened":
+        assert not node.is_multivalued, f"{node.unique_name} is multivalued, and cannot be flattened"
+        return flattened_columns(node, attribute_name)
+    if storage == "jsonb":
+        return [(attribute_name, get_attribute_type(node.attr_type) + suffix, node.unique_name)]
+    type_name = create_composite_type(graph, node, created_types_names, created_types)
+    return [(attribute_name, type_name + suffix, node.unique_name)]
+
 # Subclassses take some effort to get right
 # For each subclass, we need to know whether it is going to be a separate table, and also whether it is broken off from the parent
 # We tell this based on whether there exists a connected subgraph that includes the subclass, its parent entity, and at least one of its attributes, but no relationships
@@ -99,10 +144,15 @@ def helper_figure_out_subclass_or_weak_entity_status(graph, connected_subgraphs)
 
 # Next, we will consider composite types, and try to keep track of whether they are flattened or not
 
-def create_table_statements(graph: Graph, connected_subgraphs: List[List[str]]):
+def create_table_statements(graph: Graph, connected_subgraphs: List[List[str]], composite_storage: Dict[str, str] = None):
     tables_to_be_created = []
     created_types_names = set()
     created_types = {}
+    composite_storage = {name.lower(): storage for name, storage in (composite_storage or {}).items()}
+    for name in composite_storage:
+        node = graph.get_node_by_name(name)
+        assert node and node.is_attribute() and node.is_composite and node.parent_attribute is None, \
+            f"{name} is not a (top-level) composite attribute"
 
     # For each subclass, figure out whether it is separated out, or partially or totally contained within its parent
     helper_figure_out_subclass_or_weak_entity_status(graph, connected_subgraphs)
@@ -112,6 +162,8 @@ def create_table_statements(graph: Graph, connected_subgraphs: List[List[str]]):
         columns = []
 
         table_attributes = []
+        # (the composites with a declared storage, which get their columns once, however many parts are listed)
+        stored_composites = set()
 
         subgraph_copy = subgraph.copy()
         for n in subgraph_copy:
@@ -175,12 +227,18 @@ def create_table_statements(graph: Graph, connected_subgraphs: List[List[str]]):
                     # But since we already have the ".", we can simply replace those with "__"
                     attribute_name = unique_name.split('.', 1)[-1].replace('.', '__')
 
+                    top = top_composite(node)
                     if unique_name[-3:] == '_id':
                         continue
+                    elif top and top.unique_name in composite_storage:
+                        if top.unique_name not in stored_composites:
+                            stored_composites.add(top.unique_name)
+                            table_attributes += composite_columns(graph, top, composite_storage[top.unique_name], top.is_multivalued and only_attribute(graph, subgraph),
+                                                                  created_types_names, created_types)
                     elif node.is_composite:
                         # We should add in asserts to confirm that none of its children are in any subgraph
-                        type_name = create_composite_type(graph, node, created_types_names, created_types)
-                        table_attributes.append( (attribute_name, type_name, unique_name) )
+                        table_attributes += composite_columns(graph, node, "row", node.is_multivalued and only_attribute(graph, subgraph),
+                                                          created_types_names, created_types)
                     elif node.is_multivalued:
                             # This is going to depend on whether this is the only attribute in this connected subgraph
                             if len([n for n in subgraph_copy if graph.get_node_by_name(n).is_attribute()]) == 1:
@@ -222,7 +280,7 @@ def figure_out_mappings(graph, connected_subgraphs, created_tables):
             if node.is_subclass and not node.all_by_itself:
                 node.tables |= node.parent_entity.tables            
 
-            print(node.unique_name, node.tables)
+            logging.debug("Mapped %s to %s", node.unique_name, node.tables)
 
         elif node.is_relationship():
             # Look for the connected subgraph containing that relationship. There can be only one for now
@@ -232,6 +290,26 @@ def figure_out_mappings(graph, connected_subgraphs, created_tables):
                     node.tables = {created_tables[i][0]}
                     break
 
-            print(node.unique_name, node.tables)
-
-
+            logging.debug("Mapped %s to %s", node.unique_name, node.tables)
+
+# Materialized entity views: for each of the given entities, a table that holds the fully assembled entity
+# It has the same columns as the query that reassembles the entity, except that normalized multivalued
+# attributes are kept as arrays. The insert path keeps these up to date.
+def create_view_tables(graph, created_tables, view_entities):
+    view_tables = []
+    for name in view_entities:
+        entity = graph.get_node_by_name(name)
+        assert entity and entity.is_entity(), f"{name} is not an entity"
+
+        view_columns = []
+        for attr_name, location in locate_attributes(created_tables, entity).items():
+            for source in location['sources']:
+                table_name, column_name = source.split('.')
+                column = [c for t in created_tables if t[0] == table_name for c in t[1] if c[0] == column_name][0]
+                column_type = column[1] + "[]" if location['normalized'] else column[1]
+                view_columns.append((column_name, column_type, column[2]))
+
+        entity.materialized_view = f"mv_{entity.unique_name}"
+        view_tables.append((entity.materialized_view, view_columns))
+
+    return view_tables
@@ -0,0 +1,202 @@
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List
+
+import psycopg2
+
+from map_select_queries import generate_sql_query
+from map_query_results import decode_rows, decode_columns
+from instrumentation import timed
+
+##############################################################################################################
+### Bulk export of the fully assembled instances of an entity:
+###
+###     python3 erbium.py export <dbname> <entity> jsonl|csv|parquet [--out path] [--workers N] [--batch-size N]
+###
+### The query that reassembles the entity (generate_sql_query) runs on a server-side cursor, so the instances
+### stream through in batches of --batch-size and memory stays the same however big the entity is; each batch is
+### decoded into the structure of the entity (attributes_with_structure) and written out:
+###   jsonl:   one JSON object per instance, as read by "erbium.py insert"
+###   csv:     one row per instance; composite attributes are split into name__child columns and multivalued
+###            attributes are JSON arrays (as written by generate_data_univ.py, and read by "erbium.py insert")
+###   parquet: composite attributes are struct columns and multivalued attributes list columns (needs pyarrow)
+###
+### With --workers N, the key range of the entity (the key of its main table, erbium_key) is split into N ranges, which are
+### exported in parallel by worker processes, each into a file of its own (<out>.partK.<ext>).
+##############################################################################################################
+
+EXTENSIONS = {"jsonl": "jsonl", "csv": "csv", "parquet": "parquet"}
+
+def entity_to_export(graph, entity_name):
+    entity = graph.get_node_by_name(entity_name)
+    assert entity and entity.is_entity(), f"Unknown entity {entity_name}"
+    return entity
+
+# CSV columns, following attributes_with_structure
+def csv_columns(attributes_with_structure, prefix="") -> List[str]:
+    columns = []
+    for attr in attributes_with_structure:
+        if attr["attr_type"] == 'COMPOSITE' and not attr.get("is_multivalued", False):
+            columns += csv_columns(attr["sub_attributes"], f"{prefix}{attr['attr_name']}__")
+        else:
+            columns.append(prefix + attr["attr_name"])
+    return columns
+
+def flatten_instance(values: Dict[str, Any], attributes_with_structure, prefix="") -> Dict[str, Any]:
+    ret = {}
+    for attr in attributes_with_structure:
+        value = values.get(attr["attr_name"])
+        if attr["attr_type"] == 'COMPOSITE' and not attr.get("is_multivalued", False):
+            ret.update(flatten_instance(value or {}, attr["sub_attributes"], f"{prefix}{attr['attr_name']}__"))
+        elif attr.get("is_multivalued", False):
+            ret[prefix + attr["attr_name"]] = json.dumps(value if value is not None else [], default=str)
+        else:
+            ret[prefix + attr["attr_name"]] = value
+    return ret
+
+##############################################################################################################
+### Writers: write(rows, column_names) per batch of fetched rows, and close()
+##############################################################################################################
+class JsonLinesWriter:
+    def __init__(self, path, entity):
+        self.file = open(path, "w") if path != "-" else sys.stdout
+        self.entity = entity
+
+    def write(self, rows, column_names):
+        for instance in decode_rows(rows, column_names, self.entity):
+            self.file.write(json.dumps(instance, default=str))
+            self.file.write("\n")
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+class CsvWriter:
+    def __init__(self, path, entity):
+        self.file = open(path, "w", newline="") if path != "-" else sys.stdout
+        self.entity = entity
+        self.columns = csv_columns(entity.attributes_with_structure)
+        self.writer = csv.DictWriter(self.file, fieldnames=self.columns, extrasaction="ignore")
+        self.writer.writeheader()
+
+    def write(self, rows, column_names):
+        for instance in decode_rows(rows, column_names, self.entity):
+            self.writer.writerow(flatten_instance(instance, self.entity.attributes_with_structure))
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+class ParquetWriter:
+    def __init__(self, path, entity):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is needed for Parquet output: pip install pyarrow")
+        assert path != "-", "Parquet cannot be written to stdout"
+        self.pq = pq
+        self.path = path
+        self.entity = entity
+        self.writer = None
+
+    def write(self, rows, column_names):
+        batch = decode_columns(rows, column_names, self.entity, "arrow")
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, batch.schema)
+        self.writer.write_batch(batch)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+WRITERS = {"jsonl": JsonLinesWriter, "csv": CsvWriter, "parquet": ParquetWriter}
+
+##############################################################################################################
+### Exporting
+##############################################################################################################
+# Export the instances with lo <= key <= hi (all of them if lo is None) to path; returns the number of instances
+def export_range(db_name, tables, graph, entity_name, fmt, path, lo=None, hi=None, batch_size=10000):
+    entity = entity_to_export(graph, entity_name)
+    if lo is None:
+        sql = generate_sql_query(tables, entity, graph)
+    else:
+        # (the key of the main table need not be one of the attributes, so the query returns it as erbium_key)
+        sql = generate_sql_query(tables, entity, graph, with_key=True)
+        sql = f"SELECT * FROM ({sql}) AS instances WHERE erbium_key BETWEEN {int(lo)} AND {int(hi)}"
+
+    conn = psycopg2.connect(f"dbname={db_name}")
+    # (a named cursor is a server-side cursor, which has to be in a transaction)
+    cursor = conn.cursor(name=f"erbium_export_{os.getpid()}")
+    cursor.itersize = batch_size
+    writer = WRITERS[fmt](path, entity)
+    count = 0
+    try:
+        cursor.execute(sql)
+        while True:
+            with timed("execute", entity=entity.unique_name) as timer:
+                rows = cursor.fetchmany(batch_size)
+                timer.rows = len(rows)
+            if not rows:
+                break
+            column_names = [d[0] for d in cursor.description]
+            if column_names[0] == "erbium_key":
+                rows, column_names = [row[1:] for row in rows], column_names[1:]
+            with timed("decode_rows", entity=entity.unique_name, rows=len(rows)):
+                writer.write(rows, column_names)
+            count += len(rows)
+    finally:
+        writer.close()
+        cursor.close()
+        conn.rollback()
+        conn.close()
+    return count
+
+def key_range_query(tables, graph, entity):
+    return f"SELECT min(erbium_key), max(erbium_key) FROM ({generate_sql_query(tables, entity, graph, attributes=[], with_key=True)}) AS instances"
+
+def split_key_range(db_name, tables, graph, entity_name, parts):
+    entity = entity_to_export(graph, entity_name)
+    conn = psycopg2.connect(f"dbname={db_name}")
+    cursor = conn.cursor()
+    cursor.execute(key_range_query(tables, graph, entity))
+    lo, hi = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    if lo is None:
+        return []
+    step = (hi - lo + parts) // parts
+    return [(start, min(start + step - 1, hi)) for start in range(lo, hi + 1, step)]
+
+def export_partition(task):
+    db_name, entity_name, fmt, path, lo, hi, batch_size = task
+    # (each worker reads the catalog on its own)
+    from erbium import load_data
+    tables, _, graph = load_data(db_name)
+    return path, export_range(db_name, tables, graph, entity_name, fmt, path, lo, hi, batch_size)
+
+def part_path(out, k):
+    base, ext = os.path.splitext(out)
+    return f"{base}.part{k}{ext}"
+
+# Returns {file: instances written}
+def export_entity(db_name, tables, graph, entity_name, fmt, out=None, workers=1, batch_size=10000):
+    assert fmt in WRITERS, f"Unknown format {fmt}"
+    out = out or f"{entity_name.lower()}.{EXTENSIONS[fmt]}"
+    start = time.perf_counter()
+    if workers <= 1:
+        written = {out: export_range(db_name, tables, graph, entity_name, fmt, out, batch_size=batch_size)}
+    else:
+        assert out != "-", "A parallel export needs an output file"
+        tasks = [(db_name, entity_name, fmt, part_path(out, k), lo, hi, batch_size)
+                 for k, (lo, hi) in enumerate(split_key_range(db_name, tables, graph, entity_name, workers))]
+        with ProcessPoolExecutor(workers) as pool:
+            written = dict(pool.map(export_partition, tasks))
+    elapsed = time.perf_counter() - start
+    total = sum(written.values())
+    print(f"Exported {total} instances of {entity_name} in {elapsed:.1f}s ({total / elapsed if elapsed else 0:,.0f} per second) "
+          f"to {', '.join(written)}", file=sys.stderr)
+    return written
@@ -0,0 +1,173 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List, Dict, Any, Optional
+
+import psycopg2
+
+from map_select_queries import locate_attributes
+from map_query_results import decode_rows
+
+##############################################################################################################
+### Point lookups of entity instances by key: get(entity, key) and get_many(entity, keys)
+###
+### A lookup reads each of the entity's tables with an (indexed) "key = ANY(...)" query, and puts the entity back
+### together from the rows (locate_attributes/decode_rows), so nothing else in the entity is scanned or aggregated.
+### Keys asked for by concurrent callers are batched, in the style of a dataloader: while a batch for an entity is
+### running, the keys that come in are collected into the next one, which then runs as a single query per table.
+###
+### Looked up entities are kept in a (read-through) LRU cache if a ResultCache is passed in, whose version counters
+### are used to drop the ones whose tables have changed since; without it, nothing would ever tell that an entry
+### (or a key that did not exist) is stale, so every lookup goes to the database.
+##############################################################################################################
+
+class EntityLoader:
+    def __init__(self, db_name, tables, graph, cache_size=10000, versions=None):
+        self.tables = tables
+        self.graph = graph
+        self.cache_size = cache_size
+        self.cache = OrderedDict()   # (entity, key) -> (versions of the entity's tables, entity instance or None)
+        self.versions = versions
+        self.lock = threading.Lock()
+        self.pending = {}            # entity -> {key: Future} for the next batch
+        self.plans = {}
+        self.hits, self.misses, self.batches = 0, 0, 0
+
+        self.conn = psycopg2.connect(f"dbname={db_name}")
+        # all the tables of a batch are read from the same snapshot
+        self.conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        self.conn_lock = threading.Lock()
+
+    # Which tables to read, and how to put the entity back together from them (worked out once per entity)
+    def plan(self, entity):
+        if entity.unique_name in self.plans:
+            return self.plans[entity.unique_name]
+        table_names = [entity.materialized_view] if entity.materialized_view else entity.tables
+        relevant_tables = [table for table in self.tables if table[0] in table_names]
+        locations = locate_attributes(self.tables, entity, table_names)
+        column_names = [c for location in locations.values() for c in location['columns']]
+        normalized = {locations[a]['tables'][0]: a for a in locations if locations[a]['normalized']}
+        main_table = relevant_tables[0]
+        key_type = main_table[1][0][1].upper()
+        plan = {
+            'entity': entity,
+            'tables': relevant_tables,
+            'table_names': [t[0] for t in relevant_tables],
+            'column_names': column_names,
+            'normalized': normalized,
+            'coerce': int if key_type.startswith('INT') or key_type in ['BIGINT', 'SMALLINT', 'SERIAL'] else str,
+        }
+        self.plans[entity.unique_name] = plan
+        return plan
+
+    def entity(self, entity_name):
+        entity = self.graph.get_node_by_name(entity_name)
+        assert entity and entity.is_entity(), f"Unknown entity {entity_name}"
+        return entity
+
+    def get(self, entity_name, key) -> Optional[Dict[str, Any]]:
+        return self.get_many(entity_name, [key])[0]
+
+    # Returns the entity instances in the same order as the keys, with None for the keys that don't exist
+    def get_many(self, entity_name, keys) -> List[Optional[Dict[str, Any]]]:
+        plan = self.plan(self.entity(entity_name))
+        name = plan['entity'].unique_name
+        keys = [plan['coerce'](k) for k in keys]
+        versions = self.current_versions(plan)
+
+        found = {}
+        futures = {}
+        leader = False
+        with self.lock:
+            for key in keys:
+                entry = self.cache.get((name, key)) if self.versions is not None else None
+                if entry is not None and entry[0] == versions:
+                    self.cache.move_to_end((name, key))
+                    found[key] = entry[1]
+                    self.hits += 1
+                elif key not in futures:
+                    self.misses += 1
+                    if name not in self.pending:
+                        self.pending[name] = {}
+                        leader = True
+                    futures[key] = self.pending[name].setdefault(key, Future())
+        if leader:
+            self.run_batch(plan)
+        for key, future in futures.items():
+            found[key] = future.result()
+        return [found[key] for key in keys]
+
+    def current_versions(self, plan):
+        if self.versions is None:
+            return None
+        return self.versions.table_versions(plan['table_names'])
+
+    # Run the pending batch for an entity; whoever started the batch runs it, and the other callers wait for it
+    def run_batch(self, plan):
+        name = plan['entity'].unique_name
+        with self.conn_lock:
+            # keys kept coming in while we waited for the connection
+            with self.lock:
+                batch = self.pending.pop(name)
+            versions = self.current_versions(plan)
+            try:
+                instances = self.load(plan, list(batch))
+            except Exception as e:
+                for future in batch.values():
+                    future.set_exception(e)
+                return
+        with self.lock:
+            self.batches += 1
+            for key in batch if self.versions is not None else []:
+                self.cache[(name, key)] = (versions, instances.get(key))
+                self.cache.move_to_end((name, key))
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        for key, future in batch.items():
+            future.set_result(instances.get(key))
+
+    # One "key = ANY(...)" query per table; returns {key: entity instance} for the keys that exist
+    def load(self, plan, keys) -> Dict[Any, Dict[str, Any]]:
+        rows_by_table = {}
+        cursor = self.conn.cursor()
+        try:
+            for table_name, columns in plan['tables']:
+                key_column = columns[0][0]
+                cursor.execute(f"SELECT {', '.join(c[0] for c in columns)} FROM {table_name} WHERE {key_column} = ANY(%s)", (keys,))
+                rows_by_table[table_name] = cursor.fetchall()
+            cursor.close()
+        finally:
+            self.conn.rollback()
+
+        # Same as the joins in generate_sql_query: an instance has to be in all of the (non-normalized) tables
+        values = {}
+        present = None
+        for table_name, columns in plan['tables']:
+            names = [c[0] for c in columns]
+            if table_name in plan['normalized']:
+                attr_name = plan['normalized'][table_name]
+                for row in rows_by_table[table_name]:
+                    values.setdefault(row[0], {}).setdefault(attr_name, []).append(row[1])
+                continue
+            keys_in_table = set()
+            for row in rows_by_table[table_name]:
+                values.setdefault(row[0], {}).update(zip(names, row))
+                keys_in_table.add(row[0])
+            present = keys_in_table if present is None else present & keys_in_table
+
+        present = [k for k in keys if k in (present or set())]
+        rows = [tuple(values[k].get(c, [] if c in plan['normalized'].values() else None) for c in plan['column_names']) for k in present]
+        return dict(zip(present, decode_rows(rows, plan['column_names'], plan['entity'])))
+
+    # Drop cached instances (all of them, those of an entity, or some keys of an entity)
+    def invalidate(self, entity_name=None, keys=None):
+        with self.lock:
+            for name, key in list(self.cache):
+                if entity_name is None or (name == entity_name.lower() and (keys is None or key in keys)):
+                    del self.cache[(name, key)]
+
+    def stats(self):
+        return {"entries": len(self.cache), "hits": self.hits, "misses": self.misses, "batches": self.batches}
+
+    def close(self):
+        self.conn.close()
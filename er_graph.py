@@ -41,6 +41,7 @@ class Entity(Node):
         self.parent_entity = None
         self.type = NodeType.ENTITY
         self.entity_dict = None
+        self.materialized_view = None
 
         # we will keep the attributes explicitly
         self.attributes = []
@@ -205,7 +206,8 @@ class GraphEncoder(json.JSONEncoder):
                     "parent_entity": obj.parent_entity.unique_name if obj.parent_entity else None,
                     "attributes": [attr.unique_name for attr in obj.attributes],
                     "tables": list(obj.tables),
-                    "attributes_with_structure": obj.attributes_with_structure
+                    "attributes_with_structure": obj.attributes_with_structure,
+                    "materialized_view": obj.materialized_view
                 })
                 if obj.is_subclass:
                     node_data.update({
@@ -293,6 +295,7 @@ def deserialize_graph(json_str: str) -> Graph:
                 node.parent_entity = node_map[node_data["parent_entity"]]
             node.temp_attributes_list = node_data["attributes"]
             node.attributes_with_structure = node_data['attributes_with_structure']
+            node.materialized_view = node_data.get('materialized_view')
             if node.is_subclass:
                 node.partially_by_itself = node_data["partially_by_itself"]
                 node.all_by_itself = node_data["all_by_itself"]
@@ -1,22 +1,35 @@
 import argparse
+import itertools
 import json
+import os
+import time
 import psycopg2
 from psycopg2 import sql
 import cmd
 
 import logging
-import readline
 
-from sql_parser import parse
-from sql_analyzer import parse_and_analyze
+from sql_parser import parse, parse_values
+from sql_analyzer import parse_and_analyze, analyze_values
 from er_graph import Graph, deserialize_graph, serialize_graph, Node, Edge, NodeType, EdgeType
 import json
 
-from construct_create_statements import create_table_statements, figure_out_mappings
-from map_insert_statements import generate_insert_statements, format_sql_statement
-from map_select_queries import generate_sql_query
+from construct_create_statements import create_table_statements, figure_out_mappings, create_view_tables
+from map_insert_statements import match_to_schema, insert_tables, read_entity_rows
+from row_batches import RowBatch
+from reference_checks import ReferenceChecker
+from key_allocation import KeyAllocator, create_key_sequences
+from sharding import ShardedQuery, SHARDS_OBJECT, shards_of, remember_shards, shard_names, not_sharded, save_shards, partition, shard_of, placement_attribute, connect_shards, execute_on_shards
+from map_select_queries import compile_query, compile_batch
+from map_modify_statements import compile_modification, execute_modification
+from map_query_results import decode_rows, decode_json_rows
+from result_cache import ResultCache, create_table_versions, bump_table_versions
+from entity_loader import EntityLoader
+from prepared_statements import ERSession
+import instrumentation
+from instrumentation import timed
+import workload
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class ERShell(cmd.Cmd):
     prompt = 'ersh> '
@@ -28,10 +41,34 @@ class ERShell(cmd.Cmd):
         self.tables = tables
         self.types = types
         self.graph = graph
+        self.cache = None
+        self.loader = None
+        self.session = None
+        self.timing = False
+        self.before = None
+
+    # \timing (psql style) is the same as timing
+    def precmd(self, line):
+        if line.startswith("\\"):
+            line = line[1:]
+        if self.timing:
+            self.before = (time.perf_counter(), instrumentation.metrics.snapshot())
+        return line
+
+    def postcmd(self, stop, line):
+        if self.timing and self.before and not line.startswith("timing"):
+            start, snapshot = self.before
+            print(instrumentation.format_table(instrumentation.difference(instrumentation.metrics.snapshot(), snapshot)))
+            print(f"Time: {(time.perf_counter() - start) * 1000:.3f} ms")
+        self.before = None
+        return stop
 
     def default(self, arg):
-        if "select" == arg[:6]:
+        if arg.split(' ', 1)[0].lower() in ("select", "closure", "paths"):
             self.do_query(arg)
+        elif arg.split(' ', 1)[0].lower() in ("update", "delete"):
+            run_modification(self.db_name, arg, self.tables, self.types, self.graph)
+            self.changed()
         else:
             return self.do_exit(arg)
 
@@ -43,35 +80,168 @@ class ERShell(cmd.Cmd):
     def do_query(self, arg):
         """Execute a query"""
         print(arg)
-        run_query(self.db_name, arg, self.tables, self.types, self.graph)
+        run_query(self.db_name, arg, self.tables, self.types, self.graph, self.cache)
+
+    def do_update(self, arg):
+        """Update the instances of an entity: update <entity> set <attribute> = <value>, ... [where <condition>]"""
+        run_modification(self.db_name, "update " + arg, self.tables, self.types, self.graph)
+        self.changed()
+
+    def do_delete(self, arg):
+        """Delete the instances of an entity (and what depends on them): delete from <entity> [where <condition>]"""
+        run_modification(self.db_name, "delete " + arg, self.tables, self.types, self.graph)
+        self.changed()
+
+    def do_batch(self, arg):
+        """Execute several queries in one round trip: batch <query>; <query>; ..."""
+        queries = [q.strip() for q in arg.split(';') if q.strip()]
+        run_batch(self.db_name, queries, self.tables, self.types, self.graph)
+
+    def do_cache(self, arg):
+        """Cache query results: cache on [size in MB] | cache off | cache (to show statistics)"""
+        args = arg.split()
+        if args and args[0] == "on":
+            not_sharded(self.db_name, "The result cache")
+            max_mb = int(args[1]) if len(args) > 1 else 64
+            if self.cache:
+                self.cache.close()
+            self.cache = ResultCache(self.db_name, [t[0] for t in self.tables], max_mb * 1024 * 1024)
+        elif args and args[0] == "off":
+            if self.cache:
+                self.cache.close()
+            self.cache = None
+        # the loader checks its entries against the versions of the cache it was created with
+        if self.loader:
+            self.loader.close()
+            self.loader = None
+        print(self.cache.stats() if self.cache else "Result cache is off")
+
+    def do_prepare(self, arg):
+        """Prepare a statement with $1, $2, ... (or ?) parameters: prepare <name> <select or insert statement>"""
+        args = arg.split(None, 1)
+        if len(args) < 2:
+            print("Usage: prepare <name> <statement>")
+            return
+        if self.session is None:
+            not_sharded(self.db_name, "prepare")
+            self.session = ERSession(self.db_name, self.tables, self.types, self.graph)
+        statement = self.session.prepare(args[1], args[0])
+        print(f"Prepared {statement.name} ({statement.param_count} parameters)")
+        if statement.sql:
+            print(statement.sql)
+
+    def do_execute(self, arg):
+        """Execute a prepared statement: execute <name> [(<value>, <value>, ...)]"""
+        args = arg.split(None, 1)
+        if not args or self.session is None:
+            print("Usage: execute <name> [(<value>, ...)] (after prepare)")
+            return
+        params = analyze_values(parse_values(args[1])[1:-1]) if len(args) > 1 else []
+        rows = self.session.execute(args[0], *params)
+        if self.session.statements[args[0].lower()].is_insert:
+            self.changed()
+        for row in rows or []:
+            print(row)
+
+    # After a write from the shell, the instances looked up before are stale, and so may be the cached results
+    def changed(self):
+        if self.cache:
+            self.cache.refresh()
+        if self.loader:
+            self.loader.invalidate()
+
+    def do_get(self, arg):
+        """Look up entity instances by key: get <entity> <key> [<key> ...]"""
+        args = arg.split()
+        if len(args) < 2:
+            print("Usage: get <entity> <key> [<key> ...]")
+            return
+        if self.loader is None:
+            not_sharded(self.db_name, "get")
+            self.loader = EntityLoader(self.db_name, self.tables, self.graph, versions=self.cache)
+        for key, instance in zip(args[1:], self.loader.get_many(args[0], args[1:])):
+            print(instance if instance is not None else f"No {args[0]} with key {key}")
+
+    def do_timing(self, arg):
+        """Show the time spent in each stage after every command: timing [on|off] (or \\timing)"""
+        self.timing = {"on": True, "off": False}.get(arg.strip().lower(), not self.timing)
+        print(f"Timing is {'on' if self.timing else 'off'}.")
+
+    def do_metrics(self, arg):
+        """Show the stage timers and counters since the shell started: metrics [json|prometheus|reset]"""
+        arg = arg.strip().lower()
+        if arg == "json":
+            print(instrumentation.to_json())
+        elif arg == "prometheus":
+            print(instrumentation.to_prometheus(), end="")
+        elif arg == "reset":
+            instrumentation.metrics.reset()
+        else:
+            print(instrumentation.format_table())
+
+    def do_record(self, arg):
+        """Record the statements that run to a workload file (see workload.py): record on <file> | record off"""
+        args = arg.split()
+        if len(args) == 2 and args[0] == "on":
+            workload.start_recording(args[1])
+            print(f"Recording to {args[1]}")
+        elif args == ["off"]:
+            workload.stop_recording()
+            print("Recording is off")
+        else:
+            print(f"Recording to {workload.recorder.path}" if workload.recorder else "Recording is off")
+
+    def do_explain(self, arg):
+        """Show how a query is compiled and PostgreSQL's plan for it: explain [analyze] <query>"""
+        analyze = arg.split(' ', 1)[0].lower() == "analyze"
+        if analyze:
+            arg = arg.split(' ', 1)[1]
+        explain_query(self.db_name, arg, self.tables, self.types, self.graph, analyze)
 
 def load_data(db_name):
     conn = psycopg2.connect(f"dbname={db_name}")
     cursor = conn.cursor()
 
     # Query the erdb_objects table for tables, types, and graph
-    cursor.execute("SELECT name, data FROM erdb_objects WHERE name IN ('tables', 'types', 'graph')")
+    cursor.execute("SELECT name, data FROM erdb_objects WHERE name IN ('tables', 'types', 'graph', %s)", (SHARDS_OBJECT,))
     rows = cursor.fetchall()
 
     # Deserialize the JSON data
+    shards = ()
     for row in rows:
         name, data = row
         if name == "tables": tables = data
         elif name == "types": types = data
         elif name == "graph": graph = deserialize_graph(json.dumps(data))
+        elif name == SHARDS_OBJECT: shards = data
         else:   
             logging.debug(f"Unknown object: {name}")
             assert False
 
     cursor.close()
     conn.close()
+    # (so the shards always go with the catalog that was read last)
+    remember_shards(db_name, shards)
 
     return tables, types, graph
 
-def run_query(db_name, query, tables, types, graph):
-    result = parse_and_analyze(query)
+def run_query(db_name, query, tables, types, graph, cache=None):
+    start = time.perf_counter()
+    if shards_of(db_name):
+        return run_sharded_query(db_name, query, tables, graph)
+    result, sql = compile_query(query, tables, graph)
     print(result)
-    sql = generate_sql_query(tables, graph.get_node_by_name(result['table_name']), graph)
+
+    if cache:
+        rows, versions = cache.get(sql)
+        if rows is not None:
+            print("---- From the result cache:")
+            print(sql)
+            print("-------")
+            for row in rows:
+                print(row)
+            workload.record("query", query, sql, time.perf_counter() - start, len(rows), cached=True)
+            return rows
 
     print("---- Running query on database:")
     print(sql)
@@ -80,10 +250,119 @@ def run_query(db_name, query, tables, types, graph):
     # Run the query and output the results one by one
     conn = psycopg2.connect(f"dbname={db_name}")
     cursor = conn.cursor()
-    cursor.execute(sql)
-    for row in cursor.fetchall():
+    entity_name = result['table_name'].lower()
+    with timed("execute", entity=entity_name) as timer:
+        cursor.execute(sql)
+        fetched = cursor.fetchall()
+        timer.rows = len(fetched)
+    column_names = [d[0] for d in cursor.description]
+    entity = None if 'traversal' in result else graph.get_node_by_name(result['table_name'])
+    with timed("decode_rows", entity=entity_name, rows=len(fetched)):
+        rows = decode_rows(fetched, column_names, entity)
+    cursor.close()
+    conn.close()
+    if cache:
+        cache.put(sql, versions, rows)
+    workload.record("query", query, sql, time.perf_counter() - start, len(rows))
+    for row in rows:
         print(row)
-    return
+    return rows
+
+# The query runs on all the shards in parallel, and the results are merged (see sharding.py); there is no result
+# cache, since the shards are changed behind the back of this database
+def run_sharded_query(db_name, query, tables, graph):
+    start = time.perf_counter()
+    result = parse_and_analyze(query)
+    with timed("generate_sql_query", entity=result['table_name'].lower()):
+        plan = ShardedQuery(result, tables, graph)
+    print(result)
+
+    shards = shards_of(db_name)
+    print(f"---- Running query on {len(shards)} shards:")
+    print(plan.sql)
+    print("-------")
+
+    fetched, column_names = plan.run(shards)
+    entity_name = result['table_name'].lower()
+    with timed("decode_rows", entity=entity_name, rows=len(fetched)):
+        rows = decode_rows(fetched, column_names, plan.entity)
+    workload.record("query", query, plan.sql, time.perf_counter() - start, len(rows))
+    for row in rows:
+        print(row)
+    return rows
+
+# Run several queries as a single SQL statement; returns the decoded rows of each query
+def run_batch(db_name, queries, tables, types, graph):
+    not_sharded(db_name, "batch")
+    start = time.perf_counter()
+    results, sql, entities = compile_batch(queries, tables, graph)
+
+    print("---- Running batch on database:")
+    print(sql)
+    print("-------")
+
+    conn = psycopg2.connect(f"dbname={db_name}")
+    cursor = conn.cursor()
+    with timed("execute", entity="batch") as timer:
+        cursor.execute(sql)
+        records = cursor.fetchone()
+        timer.rows = sum(len(r or []) for r in records)
+    with timed("decode_rows", entity="batch", rows=timer.rows):
+        batch = [decode_json_rows(r, entity) for r, entity in zip(records, entities)]
+    cursor.close()
+    conn.close()
+    workload.record("batch", queries, sql, time.perf_counter() - start, timer.rows)
+    for query, rows in zip(queries, batch):
+        print(f"---- {query}")
+        for row in rows:
+            print(row)
+    return batch
+
+# An ER UPDATE or DELETE, as a handful of set-based statements in one transaction; returns the number of
+# instances it matched
+def run_modification(db_name, statement, tables, types, graph):
+    start = time.perf_counter()
+    query = parse_and_analyze(statement)
+    with timed("generate_sql_query", entity=query['table_name'].lower()):
+        statements, changed = compile_modification(query, tables, types, graph)
+
+    print("---- Running on database:")
+    for sql, params in statements:
+        print(sql, params if params else "")
+    print("-------")
+
+    if shards_of(db_name):
+        matched = execute_on_shards(shards_of(db_name), statements, changed, query['table_name'].lower())
+    else:
+        conn = psycopg2.connect(f"dbname={db_name}")
+        try:
+            matched = execute_modification(conn, statements, changed, query['table_name'].lower())
+        finally:
+            conn.close()
+    workload.record("modify", statement, ";\n".join(sql for sql, _ in statements), time.perf_counter() - start, matched)
+    print(f"{query['modify']} {matched}")
+    return matched
+
+def explain_query(db_name, query, tables, types, graph, analyze=False):
+    not_sharded(db_name, "explain")
+    notes = []
+    result, sql = compile_query(query, tables, graph, notes)
+
+    print("---- Compiled query:")
+    print(sql)
+    print("---- Mapping:")
+    for note in notes:
+        print(f"  {note}")
+    print("---- PostgreSQL plan:")
+
+    conn = psycopg2.connect(f"dbname={db_name}")
+    cursor = conn.cursor()
+    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {sql}" if analyze else f"EXPLAIN {sql}")
+    for row in cursor.fetchall():
+        print(row[0])
+    print("-------")
+    cursor.close()
+    conn.close()
 
 def create_database_if_not_exists(db_name):
     assert db_name != "postgres", "Cannot use the default PostgreSQL database"
@@ -128,12 +407,22 @@ def create_database_if_not_exists(db_name):
     cursor.close()
     conn.close()
 
-def init_database(db_name, load_file):
+# With shards, the tables are only created in the shards, and the database itself keeps the catalog and the key
+# sequences (see sharding.py)
+def init_database(db_name, load_file, shards=None):
     create_database_if_not_exists(db_name)
 
     conn = psycopg2.connect(f"dbname={db_name}")
     cursor = conn.cursor()
 
+    # (the statements that create the tables, which are run in the shards instead if there are any)
+    ddl = []
+    def execute_ddl(statement):
+        logging.debug(statement)
+        if not shards:
+            cursor.execute(statement)
+        ddl.append(statement)
+
     # Table to hold the metadata as JSON -- there really should only be one row in this
     cursor.execute("CREATE TABLE erdb_objects (id serial primary key, name text, data JSONB)")
 
@@ -148,20 +437,20 @@ def init_database(db_name, load_file):
     for statement in create_entity_statements:
         result = parse_and_analyze(statement)
         graph.add_entity(result)
-        logging.debug(f"Parsed: {statement}")
-        logging.debug(f"Result: {result}")
+        logging.debug("Parsed: %s", statement)
+        logging.debug("Result: %s", result)
 
     for statement in create_relationship_statements:
         result = parse_and_analyze(statement)
         graph.add_relationship(result)
-        logging.debug(f"Parsed: {statement}")
-        logging.debug(f"Result: {result}")
+        logging.debug("Parsed: %s", statement)
+        logging.debug("Result: %s", result)
 
     # Process connected_subgraphs
     for subgraph in connected_subgraphs:
         logging.debug(f"Connected Subgraph: {subgraph}")
 
-    tables, types = create_table_statements(graph, connected_subgraphs)
+    tables, types = create_table_statements(graph, connected_subgraphs, data.get("composite_storage"))
 
     # Create the types
     for x in types:
@@ -171,115 +460,281 @@ def init_database(db_name, load_file):
         #logging.debug(sql_statement)
         sql_statement = f"CREATE TYPE {x} AS"
         sql_statement += " (" + ", ".join([attr[0] + " " + attr[1] for attr in t]) + ")"
-        logging.debug(sql_statement)
-        cursor.execute(sql_statement)
+        execute_ddl(sql_statement)
 
     for t in tables:
         sql_statement = f"CREATE TABLE {t[0]}"
         sql_statement += " (" + ", ".join([attr[0] + " " + attr[1] for attr in t[1]]) + ")"
-        logging.debug(sql_statement)
-        cursor.execute(sql_statement)
+        execute_ddl(sql_statement)
+        # the tables are joined (and looked up) on their first column
+        execute_ddl(f"CREATE INDEX ON {t[0]} ({t[1][0][0]})")
 
     figure_out_mappings(graph, connected_subgraphs, tables)
 
+    # Materialized entity views, which hold the fully assembled entities
+    # (attributes_with_structure, which they are built from, is worked out when the graph is serialized)
+    serialize_graph(graph)
+    view_tables = create_view_tables(graph, tables, data.get("materialized_views", []))
+    for t in view_tables:
+        sql_statement = f"CREATE TABLE {t[0]}"
+        sql_statement += " (" + ", ".join([attr[0] + " " + attr[1] for attr in t[1]]) + ")"
+        execute_ddl(sql_statement)
+        execute_ddl(f"CREATE INDEX ON {t[0]} ({t[1][0][0]})")
+    tables += view_tables
+
+    # Version counters for the result cache
+    create_table_versions(cursor, [t[0] for t in tables])
+
+    # Sequences for generated keys
+    create_key_sequences(cursor, graph)
+
     # Serialize the objects to JSON
     tables_json = json.dumps(tables)
     types_json = json.dumps(types)
     graph_json = serialize_graph(graph)
 
-    print(json.dumps(json.loads(graph_json), indent=4))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(json.dumps(json.loads(graph_json), indent=4))
 
     # Insert the serialized data into the database
     cursor.execute("INSERT INTO erdb_objects (name, data) VALUES (%s, %s)", ("tables", tables_json))
     cursor.execute("INSERT INTO erdb_objects (name, data) VALUES (%s, %s)", ("types", types_json))
     cursor.execute("INSERT INTO erdb_objects (name, data) VALUES (%s, %s)", ("graph", graph_json))
+    if shards:
+        save_shards(cursor, shards)
+    remember_shards(db_name, shards or ())
 
     # Commit the transaction and close the connection
     conn.commit()
     cursor.close()
     conn.close()
 
-def match_to_schema_helper(values, attributes_with_structure):
-    ret = {}
-    if not isinstance(values, list):
-        assert not isinstance(attributes_with_structure, list), "Expected a scalar"
-        return {attributes_with_structure["attr_name"]: values}
-
-    assert isinstance(attributes_with_structure, list), "Expected a list"   
-
-    for x, y in zip(values, attributes_with_structure):
-        if y.get("is_multivalued", False):
-            assert isinstance(x, list), f"Expected a list for {y.attr_name}"
-            y["is_multivalued"] = False
-            arr = [match_to_schema_helper(entry, y) for entry in x] # needed to handle arrays of composite types
-            ret[y["attr_name"]] = [entry[y["attr_name"]] for entry in arr]
-            y["is_multivalued"] = True
-        elif y["attr_type"] == 'COMPOSITE':
-            ret[y["attr_name"]] = match_to_schema_helper(list(x), y["sub_attributes"])
-        else: 
-            if y["attr_type"] == 'INT':
-                ret[y["attr_name"]] = int(x)
-            else: 
-                ret[y["attr_name"]] = x
-    return ret
-
-def match_to_schema(table_name, values, entity):
-    # find the entity in the graph
-    attributes_with_structure = entity.attributes_with_structure
-    return match_to_schema_helper(values, attributes_with_structure)
-            
-
-def insert_data(db_name, load_file):
-    with open(load_file, "r") as f:
-        data = json.load(f)
-        insert_statements = data["insert_statements"]
+    # Every shard gets the tables, and the catalog (without the shards), so it can be looked at on its own
+    for shard in shards or []:
+        create_database_if_not_exists(shard)
+        shard_conn = psycopg2.connect(f"dbname={shard}")
+        shard_cursor = shard_conn.cursor()
+        shard_cursor.execute("CREATE TABLE erdb_objects (id serial primary key, name text, data JSONB)")
+        for statement in ddl:
+            shard_cursor.execute(statement)
+        create_table_versions(shard_cursor, [t[0] for t in tables])
+        for name, data in [("tables", tables_json), ("types", types_json), ("graph", graph_json)]:
+            shard_cursor.execute("INSERT INTO erdb_objects (name, data) VALUES (%s, %s)", (name, data))
+        shard_conn.commit()
+        shard_cursor.close()
+        shard_conn.close()
+
+# load_file is a JSON file with insert statements ({"insert_statements": [...]}), a .jsonl or .csv file with the
+# instances of one entity/relationship (named after the file, e.g., person.csv), or a directory written by
+# generate_data_univ.py, whose manifest.json lists the files to load in order
+# With check_references, relationship instances that refer to missing entity instances are written to rejects_dir
+# instead (see reference_checks.py)
+def insert_data(db_name, load_file, batch_size=1000, check_references=False, rejects_dir="rejects"):
+    if os.path.isdir(load_file):
+        with open(os.path.join(load_file, "manifest.json")) as f:
+            files = [os.path.join(load_file, name) for name in json.load(f)["files"]]
+    else:
+        files = [load_file]
 
     tables, types, graph = load_data(db_name)
 
     conn = psycopg2.connect(f"dbname={db_name}")
     cursor = conn.cursor()
 
-    # Insert data
-    for insert_statement in insert_statements:
-        logging.debug(f"Insert Statement: {insert_statement}")
-        parsed = parse_and_analyze(insert_statement)
-        entity = [node for node in graph.nodes if node.name.lower() == parsed["table_name"].lower()][0]
-        values_as_dict = match_to_schema(parsed["table_name"], parsed["values"], entity)
-        relevant_tables = [table for table in tables if table[0] in entity.tables]
-        insert_data = generate_insert_statements(values_as_dict, relevant_tables, types)
-        for _, _, statement, values in insert_data:
-            formatted_statement = format_sql_statement(statement, values)
-            cursor.execute(formatted_statement)
-            conn.commit()
+    # The data goes to the database itself, or to the shards (the keys always come from the database itself)
+    shards = shards_of(db_name)
+    assert not (shards and check_references), "References cannot be checked on a sharded database"
+    targets = connect_shards(shards) if shards else [(conn, cursor)]
+
+    checkers = {}
+    keys = KeyAllocator()
+    for path in files:
+        if path.endswith(".jsonl") or path.endswith(".csv"):
+            insert_rows(conn, cursor, path, tables, types, graph, batch_size, checkers if check_references else None, rejects_dir, keys, targets)
+        else:
+            insert_statements_from(conn, cursor, path, tables, types, graph, checkers if check_references else None, rejects_dir, keys, targets, batch_size)
+    for checker in checkers.values():
+        checker.close()
+    keys.sync(cursor, tables, graph, [shard_cursor for _, shard_cursor in targets])
+    conn.commit()
+    if shards:
+        for shard_conn, shard_cursor in targets:
+            shard_cursor.close()
+            shard_conn.close()
 
     cursor.close()
     conn.close()
 
+# The checker of a relationship (None for an entity, or if references are not checked)
+def reference_checker(checkers, entity, tables, graph, rejects_dir):
+    if checkers is None or not entity.is_relationship():
+        return None
+    if entity.unique_name not in checkers:
+        checkers[entity.unique_name] = ReferenceChecker(entity, tables, graph, rejects_dir)
+    return checkers[entity.unique_name]
+
+# targets: the (connection, cursor) of each shard the data goes to (by default the database of conn)
+# The statements are parsed one at a time, and the ones in a row for the same entity are collected into a RowBatch
+# (row_batches.py) that is copied and committed batch_size instances at a time, as insert_rows does
+def insert_statements_from(conn, cursor, load_file, tables, types, graph, checkers=None, rejects_dir="rejects", keys=None, targets=None, batch_size=1000):
+    targets = targets or [(conn, cursor)]
+    with open(load_file, "r") as f:
+        data = json.load(f)
+        insert_statements = data["insert_statements"]
+
+    count = 0
+    for entity, parsed in itertools.groupby(parsed_insert_statements(insert_statements, graph), key=lambda p: p[0]):
+        batch = RowBatch(entity, insert_tables(entity, tables, graph))
+        checker = reference_checker(checkers, entity, tables, graph, rejects_dir)
+        while True:
+            pending = list(itertools.islice(parsed, batch_size))
+            if not pending:
+                break
+            rows = [values_as_dict for _, _, values_as_dict in pending]
+            if keys:
+                keys.fill(cursor, entity, rows)
+            # (the references of a relationship are checked for the whole batch, as in insert_rows)
+            if checker:
+                rows = checker.check(cursor, rows)
+            inserted = {id(values_as_dict) for values_as_dict in rows}
+            # (a batch is timed as a whole, so the statements are recorded without a duration)
+            for _, insert_statement, values_as_dict in pending:
+                if id(values_as_dict) in inserted:
+                    workload.record("insert", insert_statement, rows=1)
+            count += copy_batch(batch, rows, targets)
+    logging.info("Inserted %d instances from %s", count, load_file)
+
+# (entity, statement, values as matched to the schema) for each statement
+def parsed_insert_statements(insert_statements, graph):
+    for insert_statement in insert_statements:
+        logging.debug("Insert Statement: %s", insert_statement)
+        parsed = parse_and_analyze(insert_statement)
+        entity = [node for node in graph.nodes if node.name.lower() == parsed["table_name"].lower()][0]
+        yield entity, insert_statement, match_to_schema(parsed["table_name"], parsed["values"], entity)
+
+# The rows are already in the shape of the entity, so there is nothing to parse; they are collected into a columnar
+# batch (row_batches.py), which is copied into the entity's tables and committed batch_size rows at a time (on a
+# sharded database, each batch is split up by shard, see sharding.py)
+def insert_rows(conn, cursor, path, tables, types, graph, batch_size, checkers=None, rejects_dir="rejects", keys=None, targets=None):
+    targets = targets or [(conn, cursor)]
+    name = os.path.basename(path).rsplit(".", 1)[0]
+    entity = graph.get_node_by_name(name)
+    assert entity, f"No entity or relationship named {name} (from {path})"
+    batch = RowBatch(entity, insert_tables(entity, tables, graph))
+    checker = reference_checker(checkers, entity, tables, graph, rejects_dir)
+
+    count = 0
+    rows = read_entity_rows(path, entity)
+    while True:
+        # (the references of a relationship are checked for the whole batch before it is collected)
+        pending = list(itertools.islice(rows, batch_size))
+        if not pending:
+            break
+        if keys:
+            keys.fill(cursor, entity, pending)
+        if checker:
+            pending = checker.check(cursor, pending)
+        # (a batch is timed as a whole, so the instances are recorded without a duration)
+        for values_as_dict in pending:
+            workload.record("insert_values", None, rows=1, entity=name, values=values_as_dict)
+        count += copy_batch(batch, pending, targets)
+    logging.info("Inserted %d instances of %s from %s", count, name, path)
+
+# Copies the rows into the tables of the (empty) batch, each shard's rows in one transaction, which also bumps the
+# versions of the tables; returns how many were inserted
+def copy_batch(batch, rows, targets):
+    count = 0
+    name = batch.entity.unique_name
+    for (target_conn, target_cursor), shard_rows in zip(targets, partition(batch.entity, rows, len(targets))):
+        with timed("batch_rows", entity=name) as timer:
+            batch.extend(shard_rows)
+            timer.rows = len(batch)
+        if not len(batch):
+            continue
+        batch.copy_to(target_cursor)
+        with timed("commit", entity=name):
+            bump_table_versions(target_cursor, set(batch.table_names()))
+            target_conn.commit()
+        count += len(batch)
+        batch.clear()
+    return count
 
 
 def main():
     parser = argparse.ArgumentParser(description="ER Shell")
-    parser.add_argument("command", choices=["init", "shell", "insert"], help="Command to execute")
+    parser.add_argument("command", choices=["init", "shell", "insert", "serve", "export"], help="Command to execute")
     parser.add_argument("db_name", help="Database name")
-    parser.add_argument("load_file", nargs="?", help="CREATE file for initialization as JSON")
+    parser.add_argument("load_file", nargs="?", help="CREATE file for initialization as JSON (the entity, for export)")
+    parser.add_argument("export_format", nargs="?", default="jsonl", choices=["jsonl", "csv", "parquet"], help="Output format for export")
+    parser.add_argument("--host", default="localhost", help="Address for serve to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port for serve to listen on")
+    parser.add_argument("--pool-size", type=int, default=20, help="Number of backend connections for serve")
+    parser.add_argument("--cache-mb", type=int, default=0, help="Size of the result cache for serve (0 to turn it off)")
+    parser.add_argument("--out", help="File to export to (default: <entity>.<format>, - for stdout)")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for export, each exporting a key range into a file of its own")
+    parser.add_argument("--batch-size", type=int, default=10000, help="Instances fetched at a time by export")
+    parser.add_argument("--shards", help="For init: spread the data over this many shards (<db_name>_shard0, ...), or over these comma-separated databases")
+    parser.add_argument("--check-references", action="store_true", help="Check that the instances a relationship refers to exist, a batch at a time, before inserting it")
+    parser.add_argument("--rejects", default="rejects", help="Directory for the relationship instances that fail --check-references (<relationship>.jsonl)")
+    parser.add_argument("--metrics", help="Write the stage timers and counters of an init/insert to this file (JSON, or Prometheus text if it ends in .prom)")
+    parser.add_argument("--record", help="Append the statements that run (insert, shell, serve) to this workload file (see workload.py)")
+    parser.add_argument("--profile", metavar="PREFIX", help="Profile the command, writing PREFIX.collapsed (for flame graphs) and PREFIX.summary.txt (see profiling.py)")
+    parser.add_argument("--profile-mode", default="sample", choices=["sample", "cprofile"], help="Sample the stack, or profile every call with cProfile")
+    parser.add_argument("--profile-interval", type=float, default=5, help="Milliseconds between stack samples")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Logging level (DEBUG shows every parsed statement and mapping)")
 
     args = parser.parse_args()
-
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.record:
+        workload.start_recording(args.record)
+
+    if not args.profile:
+        run_command(args)
+        return
+    # (serve is profiled until it is stopped with Ctrl-C or SIGTERM)
+    import profiling
+    import signal
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    profiler = profiling.start_profiling(args.profile_mode, args.profile_interval, all_threads=args.command == "serve")
+    start = time.perf_counter()
+    try:
+        run_command(args)
+    finally:
+        profiling.stop_profiling(profiler, args.profile, time.perf_counter() - start)
+
+def run_command(args):
     if args.command == "init" or args.command == "insert":
         if not args.load_file:
             print("A file with create table statements is required for initialization")
             return
         if args.command == "init":
-            init_database(args.db_name, args.load_file)
+            init_database(args.db_name, args.load_file, shard_names(args.db_name, args.shards) if args.shards else None)
         else: 
-            insert_data(args.db_name, args.load_file)
+            insert_data(args.db_name, args.load_file, check_references=args.check_references, rejects_dir=args.rejects)
         print(f"Database {args.db_name} initialized with data from {args.load_file}")
+        if args.metrics:
+            instrumentation.write_metrics(args.metrics)
     elif args.command == "shell":
+        # line editing and history; only the shell needs it
+        import readline
         tables, types, graph = load_data(args.db_name)
         shell = ERShell(args.db_name, tables, types, graph)
         shell.cmdloop()
         #queries = ["select * from (instructor join section on teaches) join course on course_id", "select * from person", "select * from instructor"]
         #run_query(args.db_name, queries[2], tables, types, graph)
+    elif args.command == "serve":
+        from erbium_server import serve
+        not_sharded(args.db_name, "serve")
+        tables, types, graph = load_data(args.db_name)
+        serve(args.db_name, tables, types, graph, args.host, args.port, args.pool_size, args.cache_mb)
+    elif args.command == "export":
+        if not args.load_file:
+            print("The entity to export is required")
+            return
+        from entity_export import export_entity
+        not_sharded(args.db_name, "export")
+        tables, types, graph = load_data(args.db_name)
+        export_entity(args.db_name, tables, graph, args.load_file, args.export_format, args.out, args.workers, args.batch_size)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import logging
+
+from er_graph import deserialize_graph
+from map_select_queries import QueryPlanCache
+from map_query_results import decode_rows
+
+##############################################################################################################
+### An asyncio API for running ER queries concurrently, on top of asyncpg (pip install asyncpg)
+###
+### Queries are compiled with the same mappers as erbium.py (and the compiled SQL is cached), and run on a pool of
+### connections. Many queries can be in flight at the same time; the ones that don't get a connection right away
+### wait for one. Cancelling a task that is running a query cancels the query in PostgreSQL as well.
+###
+###     async with AsyncErbium("univ") as db:
+###         persons, courses = await db.fetch_entities("person", "course")
+###         rows = await db.query("select city, count(*) from person group by city", timeout=1.0)
+##############################################################################################################
+
+class AsyncErbium:
+    def __init__(self, db_name, min_size=10, max_size=50, max_in_flight=1000, plan_cache_size=1000, **connect_kwargs):
+        self.db_name = db_name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.connect_kwargs = connect_kwargs
+        self.plan_cache_size = plan_cache_size
+        self.plans = None
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.pool = None
+        self.tables, self.types, self.graph = None, None, None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def connect(self):
+        try:
+            import asyncpg
+        except ImportError:
+            raise ImportError("asyncpg is needed for the asyncio API: pip install asyncpg")
+        self.pool = await asyncpg.create_pool(database=self.db_name, min_size=self.min_size, max_size=self.max_size,
+                                              init=self.init_connection, **self.connect_kwargs)
+        await self.load_data()
+
+    # asyncpg returns JSONB as text; decode it as psycopg2 does (for the catalog, JSONB composites and batches)
+    @staticmethod
+    async def init_connection(conn):
+        for type_name in ["json", "jsonb"]:
+            await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    # Same as erbium.load_data, but over the pool
+    async def load_data(self):
+        rows = await self.pool.fetch("SELECT name, data FROM erdb_objects WHERE name IN ('tables', 'types', 'graph')")
+        for name, data in rows:
+            if name == "tables": self.tables = data
+            elif name == "types": self.types = data
+            elif name == "graph": self.graph = deserialize_graph(json.dumps(data))
+            else:
+                logging.debug(f"Unknown object: {name}")
+                assert False
+        self.plans = QueryPlanCache(self.tables, self.graph, self.plan_cache_size)
+
+    # Run one ER query, and return the decoded rows
+    # timeout (in seconds) covers waiting to be let in and for a connection as well as running the query
+    async def query(self, query, timeout=None):
+        sql, entity = self.plans.compile(query)
+        rows = await asyncio.wait_for(self._fetch(sql), timeout)
+        if not rows:
+            return []
+        return decode_rows(rows, list(rows[0].keys()), entity)
+
+    async def _fetch(self, sql):
+        async with self.in_flight:
+            async with self.pool.acquire() as conn:
+                return await conn.fetch(sql)
+
+    # Run several independent queries concurrently; the results are returned in the same order
+    # With return_exceptions=True, a failed (or timed out) query returns its exception instead of failing all of them
+    async def gather(self, *queries, timeout=None, return_exceptions=False):
+        return await asyncio.gather(*[self.query(q, timeout) for q in queries], return_exceptions=return_exceptions)
+
+    # Fetch several entities (all of their instances) concurrently
+    async def fetch_entities(self, *entities, timeout=None, return_exceptions=False):
+        return await self.gather(*[f"select * from {e}" for e in entities], timeout=timeout, return_exceptions=return_exceptions)
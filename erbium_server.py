@@ -0,0 +1,234 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from psycopg2.pool import ThreadedConnectionPool
+
+from map_select_queries import QueryPlanCache, compile_batch
+from map_query_results import decode_rows, decode_json_rows
+from result_cache import ResultCache
+from entity_loader import EntityLoader
+import instrumentation
+from instrumentation import timed
+import workload
+
+##############################################################################################################
+### A long-running, multi-client query server: python3 erbium.py serve <dbname> [--host HOST] [--port PORT]
+###
+### The catalog (tables, types, graph) is loaded once, compiled queries are shared between all the clients, and
+### requests are handled concurrently (one thread per request) over a shared pool of backend connections.
+###
+###     POST /query   {"query": "select * from person"}  ->  {"sql": "...", "rows": [{...}, ...]}
+###     POST /batch   {"queries": ["select ...", ...]}      ->  {"sql": "...", "results": [[{...}, ...], ...]}
+###     POST /get     {"entity": "person", "keys": [1, 2]}  ->  {"rows": [{...}, null]}
+###     GET  /health                                      ->  {"status": "ok"}
+###     GET  /metrics                                     ->  stage timers and counters (Prometheus text)
+###
+### e.g.: curl -d '{"query": "select count(*) from person"}' http://localhost:8765/query
+###
+### A request that cannot be parsed or compiled (a syntax error, an unknown entity or attribute) gets a 400; a
+### failure while running it (in PostgreSQL or here) gets a 500.
+##############################################################################################################
+
+# The request is at fault: it cannot be parsed, or does not fit the schema
+class BadRequest(Exception):
+    pass
+
+def compiled(compile, *args):
+    try:
+        return compile(*args)
+    except Exception as e:
+        raise BadRequest(f"{type(e).__name__}: {e}") from e
+
+class ERServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, db_name, tables, types, graph, pool_size=20, cache_mb=0):
+        super().__init__(address, ERRequestHandler)
+        self.db_name = db_name
+        self.tables = tables
+        self.types = types
+        self.graph = graph
+        self.plans = QueryPlanCache(tables, graph)
+        self.pool = ThreadedConnectionPool(1, pool_size, f"dbname={db_name}")
+        # ThreadedConnectionPool fails (rather than waits) when all the connections are in use
+        self.connections_available = threading.BoundedSemaphore(pool_size)
+        self.cache = ResultCache(db_name, [t[0] for t in tables], cache_mb * 1024 * 1024) if cache_mb else None
+        # lookups by key from concurrent requests are batched together
+        self.loader = EntityLoader(db_name, tables, graph, versions=self.cache)
+
+    def run_query(self, query):
+        start = time.perf_counter()
+        sql, entity = compiled(self.plans.compile, query)
+        if self.cache:
+            rows, versions = self.cache.get(sql)
+            if rows is not None:
+                workload.record("query", query, sql, time.perf_counter() - start, len(rows), cached=True)
+                return sql, rows
+        with self.connections_available:
+            conn = self.pool.getconn()
+            try:
+                cursor = conn.cursor()
+                with timed("execute", entity=entity.unique_name if entity else "traversal") as timer:
+                    cursor.execute(sql)
+                    rows = cursor.fetchall()
+                    timer.rows = len(rows)
+                column_names = [d[0] for d in cursor.description]
+                cursor.close()
+                conn.rollback()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn)
+        with timed("decode_rows", entity=entity.unique_name if entity else "traversal", rows=len(rows)):
+            rows = decode_rows(rows, column_names, entity)
+        if self.cache:
+            self.cache.put(sql, versions, rows)
+        workload.record("query", query, sql, time.perf_counter() - start, len(rows))
+        return sql, rows
+
+    # All the queries run as one SQL statement (see map_select_queries.compile_batch)
+    def run_batch(self, queries):
+        start = time.perf_counter()
+        results, sql, entities = compiled(compile_batch, queries, self.tables, self.graph)
+        with self.connections_available:
+            conn = self.pool.getconn()
+            try:
+                cursor = conn.cursor()
+                with timed("execute", entity="batch") as timer:
+                    cursor.execute(sql)
+                    batch = cursor.fetchone()
+                    timer.rows = sum(len(records or []) for records in batch)
+                cursor.close()
+                conn.rollback()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn)
+        batch = [decode_json_rows(records, entity) for records, entity in zip(batch, entities)]
+        workload.record("batch", queries, sql, time.perf_counter() - start, sum(len(rows) for rows in batch))
+        return sql, batch
+
+    def get_entities(self, entity_name, keys):
+        plan = compiled(lambda: self.loader.plan(self.loader.entity(entity_name)))
+        compiled(lambda: [plan['coerce'](key) for key in keys])
+        return self.loader.get_many(entity_name, keys)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.closeall()
+        self.loader.close()
+        if self.cache:
+            self.cache.close()
+
+class ERRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, body):
+        data = json.dumps(body, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "db_name": self.server.db_name})
+        elif self.path == "/metrics":
+            data = instrumentation.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path == "/get":
+            self.do_get_entities()
+            return
+        if self.path == "/batch":
+            self.do_batch()
+            return
+        if self.path != "/query":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            query = request["query"]
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": 'Expected a JSON body like {"query": "select * from person"}'})
+            return
+        try:
+            sql, rows = self.server.run_query(query)
+        except BadRequest as e:
+            logging.debug(f"Query rejected: {query}: {e}")
+            workload.record("query", query, error=str(e))
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            logging.exception(f"Query failed: {query}")
+            workload.record("query", query, error=f"{type(e).__name__}: {e}")
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.send_json(200, {"sql": sql, "rows": rows})
+
+    def do_batch(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            queries = request["queries"]
+            assert isinstance(queries, list) and queries
+        except (ValueError, KeyError, TypeError, AssertionError):
+            self.send_json(400, {"error": 'Expected a JSON body like {"queries": ["select * from person", "select * from course"]}'})
+            return
+        try:
+            sql, results = self.server.run_batch(queries)
+        except BadRequest as e:
+            logging.debug(f"Batch rejected: {queries}: {e}")
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            logging.exception(f"Batch failed: {queries}")
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.send_json(200, {"sql": sql, "results": results})
+
+    def do_get_entities(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            entity, keys = request["entity"], request["keys"]
+            assert isinstance(keys, list)
+        except (ValueError, KeyError, TypeError, AssertionError):
+            self.send_json(400, {"error": 'Expected a JSON body like {"entity": "person", "keys": [1, 2]}'})
+            return
+        try:
+            rows = self.server.get_entities(entity, keys)
+        except BadRequest as e:
+            logging.debug(f"Lookup rejected: {entity} {keys}: {e}")
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            logging.exception(f"Lookup failed: {entity} {keys}")
+            self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.send_json(200, {"rows": rows})
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} - {format % args}")
+
+def serve(db_name, tables, types, graph, host="localhost", port=8765, pool_size=20, cache_mb=0):
+    server = ERServer((host, port), db_name, tables, types, graph, pool_size, cache_mb)
+    print(f"Serving {db_name} on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,117 +1,270 @@
+import argparse
+import csv
+import json
+import os
 import random
-from faker import Faker
+import shutil
+import time
+from multiprocessing import Pool
 
-# Function to generate random test data
-def generate_test_data(num_persons=20, num_courses=20, num_sections=10, num_students=8,
-        num_instructors=8, avg_phone_numbers=10, max_students_per_section=5, max_instructors_per_section=2):
+##############################################################################################################
+### Test data for the university schema (see example.json), at any scale:
+###
+###     python3 generate_data_univ.py <out_dir> [--scale SF] [--seed N] [--workers N] [--format insert-json|jsonl|csv]
+###
+### The number of instances of each entity/relationship is proportional to the scale factor (see BASE_COUNTS), and
+### every key range is split into chunks that are generated by a pool of worker processes. Each chunk has its own
+### random generator, seeded from the seed, the entity and the chunk number, so the same seed and scale factor
+### always produce the same data, however many workers are used.
+###
+### Output (in out_dir), which "python3 erbium.py insert <dbname> <out_dir>" loads:
+###   insert-json: insert_statements.json, with the ER insert statements ({"insert_statements": [...]})
+###   jsonl:       <entity>.jsonl, one JSON object per instance
+###   csv:         <entity>.csv, one row per instance; composite attributes are split into name__child columns
+###                and multivalued attributes are JSON arrays
+###   manifest.json lists the files in the order they should be loaded, with the scale factor, seed and counts
+##############################################################################################################
+
+# Instances per unit of scale factor (scale 0.002 is about the size of example.json)
+BASE_COUNTS = {
+    "person": 10000,
+    "course": 1000,
+    "section": 5000,
+    "instructor": 1000,
+    "student": 10000,
+}
+MAX_PHONE_NUMBERS = 5
+MAX_STUDENTS_PER_SECTION = 5
+MAX_INSTRUCTORS_PER_SECTION = 2
+MAX_PREREQS = 3
+CHUNK_SIZE = 10000
+
+# The order in which things are generated and loaded, and the names used in the insert statements
+ORDER = ["person", "course", "section", "instructor", "student", "takes", "teaches", "advisor", "prereq"]
+STATEMENT_NAMES = {"person": "Person", "course": "Course", "section": "Section", "instructor": "Instructor", "student": "Student",
+                   "takes": "Takes", "teaches": "Teaches", "advisor": "Advisor", "prereq": "Prereq"}
+EXTENSIONS = {"insert-json": "json", "jsonl": "jsonl", "csv": "csv"}
+
+def counts_for(scale):
+    counts = {name: max(1, int(round(n * scale))) for name, n in BASE_COUNTS.items()}
+    counts["section"] = max(counts["section"], counts["course"])
+    return counts
+
+# Persons, instructors and students share the person_id key space (instructors and students are persons as well)
+def key_ranges(counts):
+    persons, instructors = counts["person"], counts["instructor"]
+    return {
+        "person": (0, persons),
+        "instructor": (persons, persons + instructors),
+        "student": (persons + instructors, persons + instructors + counts["student"]),
+        "course": (0, counts["course"]),
+        "section": (0, counts["section"]),
+    }
+
+# The chunks of work: (name, chunk number, first index, last index + 1); relationships are generated per section
+# (takes, teaches), per student (advisor) and per course (prereq)
+def make_tasks(counts):
+    ranges = key_ranges(counts)
+    over = {"takes": "section", "teaches": "section", "advisor": "student", "prereq": "course"}
+    tasks = []
+    for name in ORDER:
+        start, end = ranges[over.get(name, name)]
+        for chunk, lo in enumerate(range(start, end, CHUNK_SIZE)):
+            tasks.append((name, chunk, lo, min(lo + CHUNK_SIZE, end)))
+    return tasks
+
+##############################################################################################################
+### Values
+##############################################################################################################
+# Faker is slow, so each worker draws pools of names and addresses from it once (with the same seed), and the
+# instances pick from those
+vocabulary = None
+
+def build_vocabulary(seed):
+    from faker import Faker
     fake = Faker()
+    fake.seed_instance(seed)
+    return {
+        "first_names": [fake.first_name() for _ in range(1000)],
+        "last_names": [fake.last_name() for _ in range(1000)],
+        "streets": [fake.street_address() for _ in range(5000)],
+        "cities": [fake.city() for _ in range(1000)],
+        "titles": [fake.catch_phrase() for _ in range(2000)],
+    }
+
+def init_worker(seed):
+    global vocabulary
+    vocabulary = build_vocabulary(seed)
+
+PHONE_FORMATS = ["{a}-{b}-{c:04d}", "({a}){b}-{c:04d}", "{a}.{b}.{c:04d}", "+1-{a}-{b}-{c:04d}", "001-{a}-{b}-{c:04d}x{d}"]
+
+def phone_number(rng):
+    return rng.choice(PHONE_FORMATS).format(a=rng.randint(200, 999), b=rng.randint(200, 999), c=rng.randint(0, 9999), d=rng.randint(1, 99999))
+
+def person_values(rng, person_id):
+    return {
+        "person_id": person_id,
+        "name": {"firstname": rng.choice(vocabulary["first_names"]), "lastname": rng.choice(vocabulary["last_names"])},
+        "street": rng.choice(vocabulary["streets"]),
+        "city": rng.choice(vocabulary["cities"]),
+        "phone_numbers": [phone_number(rng) for _ in range(rng.randint(1, MAX_PHONE_NUMBERS))],
+    }
+
+# The section with index j: courses get their sections in turn, so (course_id, sec_id) is always unique
+def section_key(j, counts):
+    return j % counts["course"], 1000 + j // counts["course"]
+
+# The instances (as dicts, in the order of the attributes of the entity/relationship) for one chunk
+def generate_rows(name, lo, hi, counts, rng):
+    ranges = key_ranges(counts)
+    for i in range(lo, hi):
+        if name == "person":
+            yield person_values(rng, i)
+        elif name == "instructor":
+            yield dict(person_values(rng, i), rank=rng.choice(["Assistant", "Associate", "Full"]))
+        elif name == "student":
+            yield dict(person_values(rng, i), tot_credits=rng.randint(0, 120))
+        elif name == "course":
+            yield {"course_id": i, "title": rng.choice(vocabulary["titles"]), "credits": str(rng.randint(1, 5))}
+        elif name == "section":
+            course_id, sec_id = section_key(i, counts)
+            yield {"course_id": course_id, "sec_id": sec_id, "semester": rng.choice(["Fall", "Spring", "Summer"]), "year": rng.randint(2020, 2024)}
+        elif name in ["takes", "teaches"]:
+            course_id, sec_id = section_key(i, counts)
+            people = ranges["student"] if name == "takes" else ranges["instructor"]
+            most = MAX_STUDENTS_PER_SECTION if name == "takes" else MAX_INSTRUCTORS_PER_SECTION
+            for person_id in rng.sample(range(*people), min(rng.randint(1, most), people[1] - people[0])):
+                row = {"person_id": person_id, "course_id": course_id, "sec_id": sec_id}
+                if name == "takes":
+                    row["grade"] = rng.choice(["A", "B", "C", "D", "F", "W"])
+                yield row
+        elif name == "advisor":
+            yield {"instructor_id": rng.randrange(*ranges["instructor"]), "student_id": i}
+        elif name == "prereq":
+            for prereq_id in rng.sample(range(counts["course"]), min(rng.randint(0, MAX_PREREQS), counts["course"])):
+                if prereq_id != i:
+                    yield {"course_id": i, "prereq_id": prereq_id}
+
+##############################################################################################################
+### Formats
+##############################################################################################################
+# An ER literal, as in the insert statements: 'text' (with \ escapes), numbers, (composite values) and [lists]
+def er_literal(value):
+    if isinstance(value, dict):
+        return "(" + ", ".join(er_literal(v) for v in value.values()) + ")"
+    if isinstance(value, list):
+        return "[" + ", ".join(er_literal(v) for v in value) + "]"
+    if isinstance(value, str):
+        return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+    return str(value)
+
+def insert_statement(name, row):
+    return f"INSERT INTO {STATEMENT_NAMES[name]} VALUES ({', '.join(er_literal(v) for v in row.values())});"
+
+# Composite attributes become name__child columns, multivalued attributes JSON arrays
+def flatten_row(row, prefix=""):
+    ret = {}
+    for k, v in row.items():
+        if isinstance(v, dict):
+            ret.update(flatten_row(v, f"{prefix}{k}__"))
+        elif isinstance(v, list):
+            ret[prefix + k] = json.dumps(v)
+        else:
+            ret[prefix + k] = v
+    return ret
+
+def generate_chunk(task):
+    name, chunk, lo, hi, counts, seed, fmt, parts_dir = task
+    rng = random.Random(f"{seed}:{name}:{chunk}")
+    path = os.path.join(parts_dir, f"{name}.{chunk:06d}")
+    n = 0
+    fieldnames = None
+    with open(path, "w", newline="") as f:
+        writer = None
+        for row in generate_rows(name, lo, hi, counts, rng):
+            if fmt == "insert-json":
+                f.write(json.dumps(insert_statement(name, row)))
+                f.write("\n")
+            elif fmt == "jsonl":
+                f.write(json.dumps(row))
+                f.write("\n")
+            else:
+                flat = flatten_row(row)
+                if writer is None:
+                    fieldnames = list(flat)
+                    writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writerow(flat)
+            n += 1
+    return name, chunk, path, n, fieldnames
+
+# Put the parts together, in order
+def merge_parts(results, fmt, out_dir):
+    files = []
+    if fmt == "insert-json":
+        path = os.path.join(out_dir, "insert_statements.json")
+        with open(path, "w") as out:
+            out.write('{"insert_statements": [\n')
+            first = True
+            for _, _, part, _, _ in results:
+                with open(part) as f:
+                    for line in f:
+                        if not first:
+                            out.write(",")
+                        out.write(line)
+                        first = False
+            out.write("]}\n")
+        return ["insert_statements.json"]
+
+    for name in ORDER:
+        parts = [part for n, _, part, _, _ in results if n == name]
+        path = os.path.join(out_dir, f"{name}.{EXTENSIONS[fmt]}")
+        with open(path, "w", newline="") as out:
+            if fmt == "csv":
+                fieldnames = next((f for n, _, _, _, f in results if n == name and f), None)
+                if fieldnames is None:
+                    continue
+                csv.writer(out).writerow(fieldnames)
+            for part in parts:
+                with open(part) as f:
+                    shutil.copyfileobj(f, out)
+        files.append(os.path.basename(path))
+    return files
+
+def generate(out_dir, scale=1.0, seed=0, workers=None, fmt="jsonl"):
+    assert fmt in EXTENSIONS, f"Unknown format {fmt}"
+    counts = counts_for(scale)
+    parts_dir = os.path.join(out_dir, "parts")
+    os.makedirs(parts_dir, exist_ok=True)
+
+    tasks = [task + (counts, seed, fmt, parts_dir) for task in make_tasks(counts)]
+    start = time.perf_counter()
+    with Pool(workers, initializer=init_worker, initargs=(seed,)) as pool:
+        results = pool.map(generate_chunk, tasks, chunksize=1)
+    files = merge_parts(results, fmt, out_dir)
+    shutil.rmtree(parts_dir)
+    elapsed = time.perf_counter() - start
+
+    rows = {}
+    for name, _, _, n, _ in results:
+        rows[name] = rows.get(name, 0) + n
+    manifest = {"format": fmt, "scale": scale, "seed": seed, "counts": rows, "files": files}
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate test data for the university schema")
+    parser.add_argument("out_dir", help="Directory to write the data to")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale factor (1 is about 50,000 instances)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (the same seed gives the same data)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument("--format", choices=list(EXTENSIONS), default="jsonl", help="Output format")
+    args = parser.parse_args()
+
+    manifest, elapsed = generate(args.out_dir, args.scale, args.seed, args.workers, args.format)
+    total = sum(manifest["counts"].values())
+    print(json.dumps(manifest["counts"]))
+    print(f"{total} instances in {elapsed:.1f}s ({total / elapsed * 60:,.0f} per minute) in {args.out_dir}")
 
-    # Generate Persons
-    persons = []
-    for i in range(num_persons):
-        person = {
-            'person_id': i,
-            'name': (fake.first_name(), fake.last_name()),
-            'street': fake.street_address(),
-            'city': fake.city(),
-            'phone_numbers': [fake.phone_number() for _ in range(random.randint(1, avg_phone_numbers * 2))]
-        }
-        persons.append(person)
-        print(f"INSERT INTO Person ({i}, {person['name'][0], person['name'][1]}, '{person['street']}', '{person['city']}', {person['phone_numbers']});")
-
-    # Generate Courses
-    courses = []
-    for i in range(num_courses):
-        course = {
-            'title': fake.catch_phrase(),
-            'credits': str(random.randint(1, 5))
-        }
-        sql_statement = "INSERT INTO Course VALUES (%s, '%s', '%s');" % (i, course['title'], course['credits'])
-        courses.append({'course_id': i, 'title': course['title'], 'credits': course['credits']})
-        print(sql_statement)
-
-
-    # Generate Sections
-    sections = []
-    existing_sections = set()  # Set to keep track of existing course_id and sec_id combinations
-
-    for _ in range(num_sections):
-        while True:
-            section = {
-                'course_id': random.choice(courses)['course_id'],
-                'sec_id': random.randint(1000, 9000),
-                'semester': random.choice(['Fall', 'Spring', 'Summer']),
-                'year': random.randint(2020, 2024)
-            }
-
-            # Check if this course_id and sec_id combination already exists in our local set
-            if (section['course_id'], section['sec_id']) not in existing_sections:
-                # If it doesn't exist, add it to our set and insert it into the database
-                existing_sections.add((section['course_id'], section['sec_id']))
-                sections.append(section)
-
-                # Extract values from the section dictionary
-                course_id = section['course_id']
-                sec_id = section['sec_id']
-                semester = section['semester']
-                year = section['year']
-                
-                # Format the SQL statement as a string
-                sql_statement = f"INSERT INTO Section VALUES ({course_id}, {sec_id}, '{semester}', {year});"
-                
-                # Print the SQL statement
-                print(sql_statement)
-                break  # Exit the while loop and move to the next section
-
-    # Generate Instructors
-    instructors = []
-    for i in range(len(persons), len(persons) + num_instructors):
-        instructor = {
-            'person_id': i,
-            'name': (fake.first_name(), fake.last_name()),
-            'street': fake.street_address(),
-            'city': fake.city(),
-            'phone_numbers': [fake.phone_number() for _ in range(random.randint(1, avg_phone_numbers * 2))],
-            'rank': random.choice(['Assistant', 'Associate', 'Full'])
-        }
-        persons.append(instructor)
-        instructors.append(instructor)
-        print(f"INSERT INTO Instructor ({i}, {instructor['name'][0], instructor['name'][1]}, '{instructor['street']}', '{instructor['city']}', {instructor['phone_numbers']}, {instructor['rank']});")
-
-    # Generate Instructors
-    students = []
-    for i in range(len(persons), len(persons) + num_students):
-        student = {
-            'person_id': i,
-            'name': (fake.first_name(), fake.last_name()),
-            'street': fake.street_address(),
-            'city': fake.city(),
-            'phone_numbers': [fake.phone_number() for _ in range(random.randint(1, avg_phone_numbers * 2))],
-            'tot_credits': random.randint(0, 120)
-        }
-        persons.append(student)
-        students.append(student)
-        print(f"INSERT INTO Student ({i}, {student['name'][0], student['name'][1]}, '{student['street']}', '{student['city']}', {student['phone_numbers']}, {student['tot_credits']});")
-
-    # Generate Takes
-    for section in sections:
-        for student in random.sample(students, random.randint(1, max_students_per_section)):
-            print(f"INSERT INTO Takes ({student['person_id']}, {section['course_id']}, {section['sec_id']}, '{random.choice(['A', 'B', 'C', 'D', 'F', 'W'])}');")
-
-    # Generate Teaches
-    for section in sections:
-        for instructor in random.sample(instructors, random.randint(1, max_instructors_per_section)):
-            print(f"INSERT INTO Teaches ({instructor['person_id']}, {section['course_id']}, {section['sec_id']});")
-
-    # Generate Advisor
-    for student in students:
-        print(f"INSERT INTO Advisor ({random.choice(instructors)['person_id']}, {student['person_id']});")
-
-    # Generate Prereq
-    for course in courses:
-        for prereq in random.sample(courses, random.randint(0, 3)):
-            if course['course_id'] != prereq['course_id']:
-                print(f"INSERT INTO Prereq ({course['course_id']}, {prereq['course_id']});") 
-
-# Generate test data
-generate_test_data()
+if __name__ == "__main__":
+    main()
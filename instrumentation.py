@@ -0,0 +1,122 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+##############################################################################################################
+### Timers and counters for the stages of loading data and running queries, e.g.,
+###
+###     with timed("execute", table="rel0", rows=1):
+###         cursor.execute(statement, values)
+###     with timed("execute", entity="person") as timer:
+###         cursor.execute(sql)
+###         timer.rows = len(cursor.fetchall())
+###
+### The stages are:
+###   parse (pyparsing), analyze (the rest of parse_and_analyze), match_to_schema, generate_insert_statements,
+###   batch_rows (filling a columnar batch), check_references (see reference_checks.py),
+###   allocate_keys (see key_allocation.py), format_sql_statement, generate_sql_query (compiling a query), execute (PostgreSQL), merge_shards (see sharding.py),
+###   decode_rows and commit
+### Each (stage, entity, table) has a count, a total time and a number of rows, from which rows/sec is worked out.
+### The counters are process-wide, and can be exported as JSON or in the Prometheus text format.
+##############################################################################################################
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}      # (stage, entity, table) -> [calls, seconds, rows]
+
+    def record(self, stage, seconds, entity=None, table=None, rows=0):
+        key = (stage, entity or "", table or "")
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = self.counters[key] = [0, 0.0, 0]
+            counter[0] += 1
+            counter[1] += seconds
+            counter[2] += rows
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {key: list(counter) for key, counter in self.counters.items()}
+
+metrics = Metrics()
+
+class Timer:
+    __slots__ = ["rows"]
+
+    def __init__(self, rows):
+        self.rows = rows
+
+# thread id -> the stages the thread is in, innermost last (for the sampling profiler, see profiling.py)
+active_stages = {}
+
+def current_stage(thread_id):
+    stages = active_stages.get(thread_id)
+    return stages[-1] if stages else None
+
+# The rows can also be set inside the block (timer.rows = ...), when they are only known at the end
+@contextmanager
+def timed(stage, entity=None, table=None, rows=0):
+    timer = Timer(rows)
+    stages = active_stages.setdefault(threading.get_ident(), [])
+    stages.append(stage)
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        metrics.record(stage, time.perf_counter() - start, entity, table, timer.rows)
+        stages.pop()
+        # (threads come and go, e.g., one per server request, so a thread's entry goes with its outermost stage)
+        if not stages:
+            del active_stages[threading.get_ident()]
+
+# What happened between two snapshots (e.g., during one shell command)
+def difference(after, before):
+    ret = {}
+    for key, (calls, seconds, rows) in after.items():
+        b = before.get(key, [0, 0.0, 0])
+        if calls > b[0]:
+            ret[key] = [calls - b[0], seconds - b[1], rows - b[2]]
+    return ret
+
+def as_records(snapshot):
+    records = []
+    for (stage, entity, table), (calls, seconds, rows) in sorted(snapshot.items()):
+        records.append({"stage": stage, "entity": entity, "table": table, "calls": calls, "seconds": round(seconds, 6),
+                        "rows": rows, "rows_per_second": round(rows / seconds, 1) if rows and seconds else None})
+    return records
+
+def to_json(snapshot=None):
+    return json.dumps(as_records(metrics.snapshot() if snapshot is None else snapshot), indent=4)
+
+def to_prometheus(snapshot=None):
+    snapshot = metrics.snapshot() if snapshot is None else snapshot
+    lines = []
+    for name, index, kind, help_text in [("erbium_stage_calls_total", 0, "counter", "Number of times a stage ran"),
+                                         ("erbium_stage_seconds_total", 1, "counter", "Time spent in a stage"),
+                                         ("erbium_stage_rows_total", 2, "counter", "Rows handled by a stage")]:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (stage, entity, table), counter in sorted(snapshot.items()):
+            lines.append(f'{name}{{stage="{stage}",entity="{entity}",table="{table}"}} {counter[index]}')
+    return "\n".join(lines) + "\n"
+
+# A table for the shell, slowest stages first
+def format_table(snapshot=None):
+    snapshot = metrics.snapshot() if snapshot is None else snapshot
+    if not snapshot:
+        return "(nothing timed)"
+    lines = [f"{'stage':<28}{'entity':<14}{'table':<12}{'calls':>8}{'ms':>12}{'rows':>10}{'rows/s':>12}"]
+    for record in sorted(as_records(snapshot), key=lambda r: -r["seconds"]):
+        lines.append(f"{record['stage']:<28}{record['entity']:<14}{record['table']:<12}{record['calls']:>8}"
+                     f"{record['seconds'] * 1000:>12.3f}{record['rows']:>10}{record['rows_per_second'] or '':>12}")
+    return "\n".join(lines)
+
+def write_metrics(path):
+    with open(path, "w") as f:
+        f.write(to_prometheus() if path.endswith(".prom") else to_json())
@@ -0,0 +1,108 @@
+import threading
+from typing import Any, Dict, List
+
+from instrumentation import timed
+
+##############################################################################################################
+### Generated keys for entity instances that are inserted without one
+###
+### Every inheritance hierarchy (a regular entity and its subclasses) has a PostgreSQL sequence,
+### erbium_ids_<entity>, created by init_database. The sequence goes up by ID_BLOCK_SIZE, so one nextval()
+### reserves a whole block of keys (1..1000, 1001..2000, ...): a loader hands the keys of a block out itself,
+### and loaders running in parallel never get the same block. Unused keys of a block are skipped, not reused.
+###
+### A key is generated where an instance has none: a missing (or null) key in a .jsonl/.csv row, or DEFAULT in an
+### ER insert, e.g., INSERT INTO person VALUES (DEFAULT, ('Laura', 'Jackson'), ...). The key is put into the
+### instance before it is mapped, so it goes into every table of the entity (and the materialized views), and a
+### subclass instance takes its key from the sequence of its hierarchy, so it is the same in the tables of the
+### parent. A weak entity is keyed by its parent's key, which has to be given; prepared inserts return the keys
+### they used, so the instances of weak entities (and relationships) can refer to new instances.
+###
+### Keys given explicitly are kept. After a load with explicit keys, sync() moves the sequence past the largest
+### key, so that generated keys do not run into them.
+##############################################################################################################
+
+ID_BLOCK_SIZE = 1000
+
+def hierarchy_root(entity):
+    while entity.is_subclass:
+        entity = entity.parent_entity
+    return entity
+
+def sequence_name(entity):
+    return f"erbium_ids_{hierarchy_root(entity).unique_name}"
+
+def key_attribute(entity):
+    return entity.attributes_with_structure[0]['attr_name']
+
+def create_key_sequences(cursor, graph, block_size=ID_BLOCK_SIZE):
+    for node in graph.nodes:
+        if node.is_entity() and not node.is_subclass and not node.is_weak_entity:
+            cursor.execute(f"CREATE SEQUENCE IF NOT EXISTS {sequence_name(node)} INCREMENT BY {int(block_size)} MINVALUE 1 START WITH 1")
+
+class KeyAllocator:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocks = {}        # sequence -> [next key, end of the block]
+        self.increments = {}    # sequence -> block size
+        self.explicit = {}      # sequence -> root entity, for the hierarchies that got explicit keys
+
+    def block_size(self, cursor, sequence):
+        if sequence not in self.increments:
+            cursor.execute("SELECT increment_by FROM pg_sequences WHERE schemaname = current_schema() AND sequencename = %s", (sequence,))
+            row = cursor.fetchone()
+            assert row, f"No sequence {sequence} (the database was initialized without generated keys)"
+            self.increments[sequence] = row[0]
+        return self.increments[sequence]
+
+    # n new keys for instances of entity; as many blocks as needed are reserved in one statement
+    def allocate(self, cursor, entity, n) -> List[int]:
+        assert not entity.is_weak_entity, f"The key of {entity.unique_name} is the key of its {entity.parent_entity.unique_name}, and has to be given"
+        sequence = sequence_name(entity)
+        keys = []
+        with self.lock, timed("allocate_keys", entity=entity.unique_name, rows=n):
+            block = self.blocks.setdefault(sequence, [0, 0])
+            take = min(n, block[1] - block[0])
+            keys += range(block[0], block[0] + take)
+            block[0] += take
+            if len(keys) < n:
+                size = self.block_size(cursor, sequence)
+                blocks = -(-(n - len(keys)) // size)
+                cursor.execute(f"SELECT nextval('{sequence}') FROM generate_series(1, %s)", (blocks,))
+                for (start,) in cursor.fetchall():
+                    take = min(n - len(keys), size)
+                    keys += range(start, start + take)
+                    # (only the last block can have keys left over)
+                    block[:] = [start + take, start + size]
+        return keys
+
+    # Fill in the keys the rows (dicts in the shape that match_to_schema returns) are missing
+    def fill(self, cursor, entity, rows: List[Dict[str, Any]]):
+        if not entity.is_entity():
+            return
+        key = key_attribute(entity)
+        missing = [row for row in rows if row.get(key) is None]
+        if len(missing) < len(rows):
+            self.explicit[sequence_name(entity)] = hierarchy_root(entity)
+        if missing:
+            for row, value in zip(missing, self.allocate(cursor, entity, len(missing))):
+                row[key] = value
+
+    # Move the sequences of the hierarchies that got explicit keys past the largest key in their tables (in the
+    # databases behind data_cursors, e.g., the shards, if the data is not in the database itself)
+    def sync(self, cursor, tables, graph, data_cursors=None):
+        for sequence, root in self.explicit.items():
+            maxima = [f"(SELECT max({columns[0][0]}) FROM {table_name})"
+                      for node in graph.nodes if node.is_entity() and not node.is_weak_entity and hierarchy_root(node) is root
+                      for table_name, columns in tables if table_name in node.tables]
+            # (a hierarchy that is not mapped to any tables has no keys to move past)
+            if not maxima:
+                continue
+            largest = []
+            for data_cursor in data_cursors or [cursor]:
+                data_cursor.execute(f"SELECT GREATEST({', '.join(maxima)})")
+                largest.append(data_cursor.fetchone()[0])
+            largest = [key for key in largest if key is not None]
+            if largest:
+                cursor.execute(f"SELECT setval('{sequence}', GREATEST((SELECT last_value FROM {sequence}), %s))", (max(largest),))
+        self.explicit = {}
@@ -1,6 +1,10 @@
+import csv
 import json
 from typing import List, Tuple, Dict, Any
 import psycopg2
+from psycopg2.extras import Json
+
+from instrumentation import timed
 
 def flatten_composite(value: Any, type_name: str, custom_types: Dict[str, List[Tuple[str, str]]]) -> Tuple[List[Any], str]:
     if type_name not in custom_types:
@@ -27,6 +31,10 @@ def flatten_composite(value: Any, type_name: str, custom_types: Dict[str, List[T
 
     return flat_values, f"ROW({', '.join(placeholders)})::{type_name}"
 
+# (composite attributes stored as JSONB, see construct_create_statements.composite_columns)
+def jsonb_value(value):
+    return None if value is None else Json(value)
+
 def generate_insert_statements(values, tables: List[Tuple[str, List[Tuple[str, str]]]], custom_types: Dict[str, List[Tuple[str, str]]]) -> List[str]:
     insert_statements = []
 
@@ -50,11 +58,14 @@ def generate_insert_statements(values, tables: List[Tuple[str, List[Tuple[str, s
 def generate_insert_statement_for_one_table(table_name: str, attributes: List[Tuple[str, str]], values: Dict[str, Any], custom_types: Dict[str, List[Tuple[str, str]]]) -> List[str]:
     temp_values = {}
     placeholders = {}
-    print(attributes)
     for attr_name, attr_type, attr_unique_name in attributes:
         if attr_name in values:
+            if attr_type == 'JSONB':
+                temp_values[attr_name] = [jsonb_value(values[attr_name])]
+                placeholders[attr_name] = '%s::jsonb'
+
             # Custom type without an array
-            if attr_type in custom_types:  
+            elif attr_type in custom_types:  
                 flat_values, placeholder = flatten_composite(values[attr_name], attr_type, custom_types)
                 temp_values[attr_name] = flat_values
                 placeholders[attr_name] = placeholder
@@ -68,22 +79,31 @@ def generate_insert_statement_for_one_table(table_name: str, attributes: List[Tu
                     for item in values[attr_name]:
                         flat_values, placeholder = flatten_composite(item, base_type, custom_types)
                         sub_values.extend(flat_values)
-                        sub_placeholders.append(f"ROW({', '.join(placeholder)})::{base_type}")
+                        sub_placeholders.append(placeholder)
                     temp_values[attr_name] = sub_values
                     placeholders[attr_name] = f"ARRAY[{', '.join(sub_placeholders)}]"
+                elif attr_type == 'JSONB[]':
+                    temp_values[attr_name] = [jsonb_value(v) for v in values[attr_name]]
+                    placeholders[attr_name] = f"ARRAY[{', '.join(['%s::jsonb'] * len(temp_values[attr_name]))}]"
                 else: 
                     temp_values[attr_name] = values[attr_name]
                     placeholders[attr_name] = f"ARRAY[{', '.join(['%s'] * len(temp_values[attr_name]))}]"
+                if not values[attr_name]:
+                    # PostgreSQL can't tell the type of an empty array
+                    placeholders[attr_name] += f"::{attr_type}"
             else:
                 # Here we have a simple attribute, but the value could be a list
                 temp_values[attr_name] = [values[attr_name]]
                 placeholders[attr_name] = '%s'
         elif '__' in attr_name:  # Check for flattened composite attributes
-            parent, child = attr_name.split('__', 1)
+            # (name__child, or name__child__grandchild for nested composites)
+            parent, *path = attr_name.split('__')
             if parent in values and isinstance(values[parent], dict):
-                if child in values[parent]:
-                    temp_values[attr_name] = [values[parent][child]]
-                    placeholders[attr_name] = '%s'
+                value = values[parent]
+                for child in path:
+                    value = value.get(child) if isinstance(value, dict) else None
+                temp_values[attr_name] = [value]
+                placeholders[attr_name] = '%s'
     
     assert temp_values
 
@@ -97,6 +117,83 @@ def generate_insert_statement_for_one_table(table_name: str, attributes: List[Tu
     else: 
         return None
 
+# The tables that an insert into the entity writes to: the entity's own tables, and the materialized views it
+# shows up in, i.e., its own view and the views of its ancestors (e.g., an instructor also shows up in the view
+# of person) as long as the entity is stored in all of the ancestor's tables
+def insert_tables(entity, tables, graph):
+    relevant_tables = [table for table in tables if table[0] in entity.tables]
+    for view_entity in graph.nodes:
+        if view_entity.is_entity() and view_entity.materialized_view and set(view_entity.tables) <= set(entity.tables):
+            relevant_tables += [table for table in tables if table[0] == view_entity.materialized_view]
+    return relevant_tables
+
+# Match the (nested) values of an ER insert statement to the entity's attributes_with_structure,
+# e.g., (1, ('Laura', 'Jackson'), ...) -> {'person_id': 1, 'name': {'firstname': 'Laura', 'lastname': 'Jackson'}, ...}
+def match_to_schema_helper(values, attributes_with_structure):
+    ret = {}
+    if not isinstance(values, list):
+        assert not isinstance(attributes_with_structure, list), "Expected a scalar"
+        if attributes_with_structure["attr_type"] == 'COMPOSITE' and isinstance(values, tuple):
+            # an element of an array of composites
+            return {attributes_with_structure["attr_name"]: match_to_schema_helper(list(values), attributes_with_structure["sub_attributes"])}
+        return {attributes_with_structure["attr_name"]: values}
+
+    assert isinstance(attributes_with_structure, list), "Expected a list"   
+
+    for x, y in zip(values, attributes_with_structure):
+        if x is None:
+            # (DEFAULT: a key to be generated, see key_allocation.py, or NULL)
+            ret[y["attr_name"]] = [] if y.get("is_multivalued", False) else None
+        elif y.get("is_multivalued", False):
+            assert isinstance(x, list), f"Expected a list for {y.attr_name}"
+            y["is_multivalued"] = False
+            arr = [match_to_schema_helper(entry, y) for entry in x] # needed to handle arrays of composite types
+            ret[y["attr_name"]] = [entry[y["attr_name"]] for entry in arr]
+            y["is_multivalued"] = True
+        elif y["attr_type"] == 'COMPOSITE':
+            ret[y["attr_name"]] = match_to_schema_helper(list(x), y["sub_attributes"])
+        else: 
+            if y["attr_type"] == 'INT':
+                ret[y["attr_name"]] = int(x)
+            else: 
+                ret[y["attr_name"]] = x
+    return ret
+
+def match_to_schema(table_name, values, entity):
+    # find the entity in the graph
+    attributes_with_structure = entity.attributes_with_structure
+    with timed("match_to_schema", entity=entity.unique_name):
+        return match_to_schema_helper(values, attributes_with_structure)
+
+# The instances in a .jsonl file (one JSON object per line) or a .csv file (one row per instance, with composite
+# attributes split into name__child columns and multivalued attributes as JSON arrays), e.g., as written by
+# generate_data_univ.py, as dicts in the shape that match_to_schema returns
+def read_entity_rows(path, entity):
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            for flat in csv.DictReader(f):
+                yield unflatten_row(flat, entity.attributes_with_structure)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def unflatten_row(flat, attributes_with_structure, prefix=""):
+    ret = {}
+    for y in attributes_with_structure:
+        column = prefix + y["attr_name"]
+        if y.get("is_multivalued", False):
+            ret[y["attr_name"]] = json.loads(flat[column]) if flat.get(column) else []
+        elif y["attr_type"] == 'COMPOSITE':
+            ret[y["attr_name"]] = unflatten_row(flat, y["sub_attributes"], column + "__")
+        elif flat.get(column) in [None, '']:
+            ret[y["attr_name"]] = None
+        elif y["attr_type"] == 'INT':
+            ret[y["attr_name"]] = int(flat[column])
+        else:
+            ret[y["attr_name"]] = flat[column]
+    return ret
+
 def format_sql_statement(sql: str, values: Tuple[Any, ...]) -> str:
     # Use psycopg2's mogrify function to properly format the SQL statement
     # We create a dummy connection that we won't actually use to connect
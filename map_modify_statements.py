@@ -0,0 +1,276 @@
+import re
+from typing import List, Tuple, Dict, Any
+
+from map_select_queries import generate_sql_query, locate_attributes, attributes_in_condition
+from map_insert_statements import flatten_composite, match_to_schema_helper, jsonb_value
+from result_cache import bump_table_versions
+from instrumentation import timed
+
+##############################################################################################################
+### This module translates ER-level UPDATE and DELETE statements (see sql_analyzer.analyze_update/analyze_delete)
+### into set-based SQL over the tables the entity was mapped to:
+###
+###   1. the keys of the instances that match the condition (a passed through WHERE over the reassembled entity,
+###      as in a SELECT) are put into a temporary table, erbium_keys_<entity>, which is dropped at commit
+###   2. UPDATE: one UPDATE per table that holds any of the assigned attributes (including the materialized views
+###      the instances show up in), restricted to those keys; a normalized multivalued attribute is replaced with
+###      a DELETE and an INSERT ... SELECT over unnest() of the new values
+###      DELETE: one DELETE per table of the instances, i.e., of the entity and of its subclasses that share the key
+###      (a person may also be an instructor or a student; deleting a student leaves the person), their materialized
+###      views, the tables of the relationships they take part in, and, in turn, of the weak entities that depend on
+###      them (whose keys are put into a temporary table of their own first)
+###
+### So however many instances match, it is a handful of statements, which all run in one transaction.
+### compile_modification returns the statements as a list of (sql, params), with the tables they change.
+##############################################################################################################
+
+def keys_table(entity):
+    return f"erbium_keys_{entity.unique_name}"
+
+def create_keys(table_name, select):
+    return f"CREATE TEMP TABLE {table_name} ON COMMIT DROP AS {select}"
+
+# (table name, select) if the statement creates a temporary table of keys (see sharding.execute_on_shards)
+def created_keys(sql):
+    match = re.match(r"CREATE TEMP TABLE (erbium_keys_\w+) ON COMMIT DROP AS (.*)$", sql, re.S)
+    return match.groups() if match else None
+
+def main_table(tables, entity):
+    table = [table for table in tables if table[0] in entity.tables][0]
+    return table[0], table[1][0][0]
+
+# The key column of a table is its first column (see init_database, which indexes it)
+def table_key(tables, table_name):
+    return [table for table in tables if table[0] == table_name][0][1][0][0]
+
+def table_columns(tables, table_name):
+    return [table for table in tables if table[0] == table_name][0][1]
+
+# The entity's whole inheritance hierarchy (as long as the subclasses share the key of their parent)
+def key_family(graph, entity):
+    return key_subclasses(graph, key_ancestors(entity)[-1])
+
+# The entity and its parents that share its key, from the entity up
+def key_ancestors(entity):
+    ancestors = [entity]
+    while ancestors[-1].is_subclass and not ancestors[-1].all_by_itself:
+        ancestors.append(ancestors[-1].parent_entity)
+    return ancestors
+
+# The entity and its subclasses (and theirs) that share its key
+def key_subclasses(graph, entity):
+    family = [entity]
+    for node in family:
+        family += [n for n in graph.nodes if n.is_entity() and n.is_subclass and n.parent_entity is node
+                   and not n.all_by_itself and n not in family]
+    return family
+
+def view_tables(family):
+    return [entity.materialized_view for entity in family if entity.materialized_view]
+
+# Statement 1: the keys of the instances that match the condition (an instance of a subclass has to be in all of
+# its tables, as in a SELECT, so the reassembled entity is used even without a condition)
+def select_keys(tables, entity, graph, condition):
+    needed = attributes_in_condition(condition, locate_attributes(tables, entity)) if condition else []
+    source = f"SELECT erbium_key AS key FROM ({generate_sql_query(tables, entity, graph, attributes=needed, with_key=True)}) AS {entity.unique_name}"
+    if condition:
+        source += f" WHERE {condition}"
+    return create_keys(keys_table(entity), f"SELECT DISTINCT key FROM ({source}) AS matching")
+
+def in_keys(column, entity):
+    return f"{column} IN (SELECT key FROM {keys_table(entity)})"
+
+##############################################################################################################
+### UPDATE
+##############################################################################################################
+# The attribute (from attributes_with_structure) at the end of a path, e.g., ['name', 'lastname']
+def attribute_at(entity, path):
+    attrs = entity.attributes_with_structure
+    for i, name in enumerate(path):
+        attr = next((a for a in attrs if a['attr_name'] == name), None)
+        assert attr, f"Unknown attribute {'.'.join(path[:i + 1])} for {entity.unique_name}"
+        if i < len(path) - 1:
+            assert attr['attr_type'] == 'COMPOSITE' and not attr.get('is_multivalued', False), \
+                f"{'.'.join(path[:i + 1])} is not a composite attribute"
+            attrs = attr['sub_attributes']
+    return attr
+
+# The SQL for a value to be stored in a column of type column_type: (placeholder, params)
+def column_value(value, column_type, custom_types):
+    if column_type == 'JSONB':
+        return "%s::jsonb", [jsonb_value(value)]
+    if column_type == 'JSONB[]':
+        return "%s::jsonb[]", [[jsonb_value(v) for v in value]]
+    if column_type in custom_types:
+        flat_values, placeholder = flatten_composite(value, column_type, custom_types)
+        return placeholder, flat_values
+    if column_type.endswith('[]'):
+        base_type = column_type[:-2]
+        if base_type in custom_types:
+            placeholders, params = [], []
+            for item in value:
+                flat_values, placeholder = flatten_composite(item, base_type, custom_types)
+                placeholders.append(placeholder)
+                params += flat_values
+            return f"ARRAY[{', '.join(placeholders)}]::{column_type}", params
+        return f"%s::{column_type}", [list(value)]
+    return "%s", [value]
+
+# The value at the end of a path in a (nested) composite value, e.g., name__fakename__middlename
+def nested_value(value, path):
+    for name in path:
+        value = None if value is None else value.get(name)
+    return value
+
+# The type of a field of a composite type (for SET column.field = ...)
+def field_type(column_type, fields, custom_types):
+    for name in fields:
+        column_type = dict(custom_types[column_type])[name]
+    return column_type
+
+def compile_update(query, tables, custom_types, graph):
+    entity = graph.get_node_by_name(query['table_name'])
+    assert entity and entity.is_entity(), f"Unknown entity {query['table_name']}"
+    _, key = main_table(tables, entity)
+
+    # the new values, in the shape that match_to_schema gives them
+    assignments = []
+    for path, value in query['assignments']:
+        assert path[0] != key, f"The key {key} of {entity.unique_name} cannot be updated"
+        attr = attribute_at(entity, path)
+        assignments.append((path, match_to_schema_helper([value], [attr])[attr['attr_name']]))
+
+    # (an attribute may be stored in more than one table, e.g., with the attributes of the parent entity copied
+    # into the table of a subclass)
+    family = key_family(graph, entity)
+    statements = [(select_keys(tables, entity, graph, query['condition']), [])]
+    changed = []
+    for table_name in dict.fromkeys([t for member in family for t in member.tables] + view_tables(family)):
+        columns = table_columns(tables, table_name)
+        table_key_column = columns[0][0]
+        set_clause, params = [], []
+        # (the fields of a JSONB composite that are set, one jsonb_set() around the other, as a column is set once)
+        jsonb_fields = {}
+        for path, value in assignments:
+            flattened = '__'.join(path)
+            for column_name, column_type, _ in columns[1:]:
+                if column_name == path[0] and len(path) > 1 and column_type == 'JSONB':
+                    expression, values = jsonb_fields.get(column_name, (f"COALESCE({column_name}, '{{}}')", []))
+                    jsonb_fields[column_name] = (f"jsonb_set({expression}, %s, %s::jsonb)",
+                                                 values + ["{" + ",".join(path[1:]) + "}", jsonb_value(value) or 'null'])
+                elif column_name == path[0] and len(path) > 1:
+                    # a field of a composite type
+                    placeholder, values = column_value(value, field_type(column_type, path[1:], custom_types), custom_types)
+                    set_clause.append(f"{column_name}.{'.'.join(path[1:])} = {placeholder}")
+                    params += values
+                elif column_name == flattened and len(columns) == 2 and isinstance(value, list) and not column_type.endswith('[]'):
+                    # a normalized multivalued attribute: replace its rows
+                    placeholder, values = column_value(value, column_type + '[]', custom_types)
+                    statements.append((f"DELETE FROM {table_name} WHERE {in_keys(table_key_column, entity)}", []))
+                    statements.append((f"INSERT INTO {table_name} ({table_key_column}, {column_name}) SELECT keys.key, v "
+                                       f"FROM {keys_table(entity)} AS keys CROSS JOIN unnest({placeholder}) AS v", values))
+                    changed.append(table_name)
+                elif column_name == flattened:
+                    placeholder, values = column_value(value, column_type, custom_types)
+                    set_clause.append(f"{column_name} = {placeholder}")
+                    params += values
+                elif column_name.startswith(flattened + '__'):
+                    # a flattened composite attribute (or a part of it)
+                    placeholder, values = column_value(nested_value(value, column_name[len(flattened) + 2:].split('__')), column_type, custom_types)
+                    set_clause.append(f"{column_name} = {placeholder}")
+                    params += values
+        for column_name, (expression, values) in jsonb_fields.items():
+            set_clause.append(f"{column_name} = {expression}")
+            params += values
+        if set_clause:
+            statements.append((f"UPDATE {table_name} SET {', '.join(set_clause)} WHERE {in_keys(table_key_column, entity)}", params))
+            changed.append(table_name)
+    assert changed, f"None of the assigned attributes are stored for {entity.unique_name}"
+    return statements, changed
+
+##############################################################################################################
+### DELETE
+##############################################################################################################
+# The columns of a relationship's table that hold the key of a participating entity: named after the entity
+# ({entity}_id) or after its key, or, for a recursive relationship, after the roles
+def reference_columns(tables, relationship, entity):
+    table_name = list(relationship.tables)[0]
+    names = [column[0] for column in table_columns(tables, table_name)]
+    if relationship.recursive_relationship_roles:
+        return [a['attr_name'] for a in relationship.attributes_with_structure[:2] if a['attr_name'] in names]
+    return [c for c in [f"{entity.unique_name}_id", main_table(tables, entity)[1]] if c in names][:1]
+
+def delete_instances(tables, graph, entity, statements, deletes, entity_tables, keyed):
+    keyed.add(entity)
+    family = key_subclasses(graph, entity)
+    # (the tables that the entity shares with its parents stay: the instances are still instances of those)
+    parent_tables = {t for parent in key_ancestors(entity)[1:] for t in parent.tables}
+    for member in family:
+        for table_name in member.tables:
+            if table_name not in parent_tables:
+                deletes.setdefault(table_name, []).append(in_keys(table_key(tables, table_name), entity))
+    for table_name in view_tables(family):
+        deletes.setdefault(table_name, []).append(in_keys(table_key(tables, table_name), entity))
+
+    for node in graph.nodes:
+        if node.is_relationship() and (node.entity1 in family or node.entity2 in family):
+            for member in [m for m in family if m in (node.entity1, node.entity2)]:
+                table_name = list(node.tables)[0]
+                for column in reference_columns(tables, node, member):
+                    if table_name in entity_tables:
+                        # the relationship is stored with another entity: only the link goes
+                        deletes.setdefault((table_name, column), []).append(in_keys(column, entity))
+                    else:
+                        deletes.setdefault(table_name, []).append(in_keys(column, entity))
+
+        # weak entities: their keys (by the key of their parent) first, and then the same for them
+        if node.is_entity() and node.is_weak_entity and node.parent_entity in family:
+            table_name, weak_key = main_table(tables, node)
+            parent_column = main_table(tables, node.parent_entity)[1]
+            if parent_column in [c[0] for c in table_columns(tables, table_name)] and node not in keyed:
+                statements.append((create_keys(keys_table(node), f"SELECT DISTINCT {weak_key} AS key "
+                                                                 f"FROM {table_name} WHERE {in_keys(parent_column, entity)}"), []))
+                delete_instances(tables, graph, node, statements, deletes, entity_tables, keyed)
+
+def compile_delete(query, tables, graph):
+    entity = graph.get_node_by_name(query['table_name'])
+    assert entity and entity.is_entity(), f"Unknown entity {query['table_name']}"
+    statements = [(select_keys(tables, entity, graph, query['condition']), [])]
+    entity_tables = {t for node in graph.nodes if node.is_entity() for t in node.tables}
+
+    deletes = {}
+    delete_instances(tables, graph, entity, statements, deletes, entity_tables, set())
+    for target, conditions in deletes.items():
+        if isinstance(target, tuple):
+            table_name, column = target
+            statements.append((f"UPDATE {table_name} SET {column} = NULL WHERE {' OR '.join(conditions)}", []))
+        else:
+            statements.append((f"DELETE FROM {target} WHERE {' OR '.join(dict.fromkeys(conditions))}", []))
+    return statements, list(dict.fromkeys(t[0] if isinstance(t, tuple) else t for t in deletes))
+
+def compile_modification(query: Dict[str, Any], tables, custom_types, graph) -> Tuple[List[Tuple[str, List[Any]]], List[str]]:
+    if query['modify'] == 'UPDATE':
+        return compile_update(query, tables, custom_types, graph)
+    return compile_delete(query, tables, graph)
+
+# Runs the statements in one transaction (bumping the versions of the changed tables); returns how many
+# instances matched
+def execute_modification(conn, statements, changed, entity_name=None):
+    cursor = conn.cursor()
+    try:
+        with timed("execute", entity=entity_name) as timer:
+            for i, (sql, params) in enumerate(statements):
+                # (no params, no %-formatting: the condition may have a LIKE 'x%')
+                cursor.execute(sql, params or None)
+                if i == 0:
+                    matched = cursor.rowcount
+            timer.rows = matched
+        with timed("commit", entity=entity_name):
+            bump_table_versions(cursor, set(changed))
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return matched
@@ -0,0 +1,254 @@
+import datetime
+from typing import List, Dict, Tuple, Any
+from itertools import chain
+
+##############################################################################################################
+### This module maps the rows returned by PostgreSQL back to the structure of the entity (attributes_with_structure),
+### i.e., composite attributes become (nested) dicts and multivalued attributes become lists.
+###
+### Composite attributes come back either as "name__child" columns (if they were flattened), or as the text
+### representation of the PostgreSQL composite type, e.g., "(Laura,Jackson)"; arrays of composite types come
+### back as e.g. '{"(a,b)","(c,d)"}'. Composites stored as JSONB come back as dicts (and lists of them) already.
+###
+### The fields of composite text and of JSON, and the BOOLEAN and DATE attributes (which are stored as TEXT, see
+### construct_create_statements.get_attribute_type), are text; they are converted to the declared type
+### (SCALAR_DECODERS), so an instance comes back the same however it is stored.
+##############################################################################################################
+
+# Split the text representation of a composite value "(...)" or an array "{...}" into its fields
+# NULLs are returned as None: an empty field in a composite value, or an unquoted NULL in an array
+def split_composite_text(text: str) -> List[Any]:
+    open_char, close_char = text[0], text[-1]
+    assert (open_char, close_char) in [('(', ')'), ('{', '}')], f"Not a composite value or an array: {text}"
+    fields = []
+    i, n = 1, len(text) - 1
+    if open_char == '{' and n == 1:
+        return fields
+    while True:
+        if text[i] == '"':
+            i += 1
+            buf = []
+            while True:
+                c = text[i]
+                if c == '\\':
+                    buf.append(text[i + 1])
+                    i += 2
+                elif c == '"' and text[i + 1] == '"':
+                    buf.append('"')
+                    i += 2
+                elif c == '"':
+                    i += 1
+                    break
+                else:
+                    buf.append(c)
+                    i += 1
+            fields.append(''.join(buf))
+        else:
+            j = text.find(',', i, n)
+            j = n if j == -1 else j
+            raw = text[i:j]
+            if (open_char == '(' and raw == '') or (open_char == '{' and raw == 'NULL'):
+                fields.append(None)
+            else:
+                fields.append(raw)
+            i = j
+        if i >= n:
+            break
+        assert text[i] == ','
+        i += 1
+    return fields
+
+# (the spellings of PostgreSQL's boolean output and input, and Python's, as a True copied into a TEXT column)
+def decode_boolean(text: str) -> bool:
+    text = text.strip().lower()
+    assert text in ['t', 'true', 'y', 'yes', 'on', '1', 'f', 'false', 'n', 'no', 'off', '0'], f"Not a boolean: {text}"
+    return text in ['t', 'true', 'y', 'yes', 'on', '1']
+
+# (ISO, as PostgreSQL outputs dates by default, and as JSON has them)
+def decode_date(text: str) -> datetime.date:
+    return datetime.date.fromisoformat(text.strip()[:10])
+
+# Declared type -> conversion of its text
+SCALAR_DECODERS = {'INT': int, 'BOOLEAN': decode_boolean, 'DATE': decode_date}
+
+def decode_scalar(value, attr):
+    if value is None:
+        return None
+    if attr["attr_type"] == 'COMPOSITE':
+        if isinstance(value, str):
+            value = split_composite_text(value)
+        if isinstance(value, dict):
+            subs = {sub["attr_name"]: sub for sub in attr.get("sub_attributes", [])}
+            return {name: decode_value(v, subs[name]) if name in subs else v for name, v in value.items()}
+        return {sub["attr_name"]: decode_value(v, sub) for sub, v in zip(attr.get("sub_attributes", []), value)}
+    decode = SCALAR_DECODERS.get(attr["attr_type"].upper())
+    if decode is not None and isinstance(value, str):
+        return decode(value)
+    return value
+
+def decode_value(value, attr):
+    if value is None:
+        return None
+    if attr.get("is_multivalued", False):
+        if isinstance(value, str) and value.startswith('{') and value.endswith('}'):
+            value = split_composite_text(value)
+        if isinstance(value, list):
+            return [decode_scalar(v, attr) for v in value]
+        # a single value of an unnested multivalued attribute
+    return decode_scalar(value, attr)
+
+# Figure out, once for the whole result, how to rebuild each attribute from the columns
+# Returns a list of (kind, key, attr, column index or {child name: column index}); columns that are not attributes
+# of the entity (e.g., aggregates) are passed through as they are
+def build_decoder(column_names: List[str], entity=None) -> List[Tuple[str, str, Any, Any]]:
+    attributes = {attr["attr_name"]: attr for attr in (entity.attributes_with_structure if entity else [])}
+    plan = []
+    flattened = {}
+    for i, name in enumerate(column_names):
+        parent = name.split('__', 1)[0]
+        if '__' in name and parent in attributes and attributes[parent]["attr_type"] == 'COMPOSITE':
+            if parent not in flattened:
+                flattened[parent] = {}
+                plan.append(('flattened', parent, attributes[parent], flattened[parent]))
+            flattened[parent][name.split('__', 1)[1]] = i
+        elif name in attributes:
+            plan.append(('attribute', name, attributes[name], i))
+        else:
+            plan.append(('column', name, None, i))
+    return plan
+
+# The (nested) sub-attribute of a composite attribute that a flattened column holds, e.g., fakename__middlename
+def sub_attribute(attr, path: str):
+    for name in path.split('__'):
+        attr = next(sub for sub in attr["sub_attributes"] if sub["attr_name"] == name)
+    return attr
+
+def nest_flattened(values: Dict[str, Any]) -> Dict[str, Any]:
+    # "fakename__middlename" -> {"fakename": {"middlename": ...}}
+    ret = {}
+    for path, v in values.items():
+        d = ret
+        parts = path.split('__')
+        for part in parts[:-1]:
+            d = d.setdefault(part, {})
+        d[parts[-1]] = v
+    return ret
+
+# Decode the rows into one dict per row, e.g., {"person_id": 0, "name": {"firstname": ..., "lastname": ...}, "phone_numbers": [...]}
+def decode_rows(rows: List[Tuple], column_names: List[str], entity=None) -> List[Dict[str, Any]]:
+    plan = build_decoder(column_names, entity)
+    ret = []
+    for row in rows:
+        decoded = {}
+        for kind, key, attr, where in plan:
+            if kind == 'column':
+                decoded[key] = row[where]
+            elif kind == 'attribute':
+                decoded[key] = decode_value(row[where], attr)
+            else:
+                decoded[key] = decode_scalar(nest_flattened({child: row[i] for child, i in where.items()}), attr)
+        ret.append(decoded)
+    return ret
+
+# Decode rows that came back as JSON objects (e.g., from json_agg, see map_select_queries.compile_batch)
+# Composite types are JSON objects already, and arrays are JSON arrays
+def decode_json_rows(records: List[Dict[str, Any]], entity=None) -> List[Dict[str, Any]]:
+    if not records:
+        return []
+    column_names = list(records[0])
+    return decode_rows([tuple(r[c] for c in column_names) for r in records], column_names, entity)
+
+##############################################################################################################
+### Columnar output: the rows are transposed once, and each attribute is then converted as a whole column
+### Flattened composite attributes become struct columns (Arrow) or one array per child ("name.firstname", NumPy)
+##############################################################################################################
+def decode_columns(rows: List[Tuple], column_names: List[str], entity=None, output: str = "arrow"):
+    assert output in ["arrow", "numpy"], f"Unknown output format {output}"
+    if output == "arrow":
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("pyarrow is needed for Arrow output: pip install pyarrow")
+    else:
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("numpy is needed for NumPy output: pip install numpy")
+
+    columns = list(zip(*rows)) if rows else [() for _ in column_names]
+    plan = build_decoder(column_names, entity)
+
+    # Rebuild the children of composite attributes as columns of their own
+    def composite_children(attr, values):
+        fields = [split_composite_text(v) if isinstance(v, str)
+                  else [v.get(sub["attr_name"]) for sub in attr["sub_attributes"]] if isinstance(v, dict)
+                  else (v or [None] * len(attr["sub_attributes"])) for v in values]
+        children = list(zip(*fields)) if fields else [() for _ in attr["sub_attributes"]]
+        return {sub["attr_name"]: [decode_value(v, sub) for v in child] for sub, child in zip(attr["sub_attributes"], children)}
+
+    def to_array(values, attr=None):
+        if output == "arrow":
+            return pa.array(values)
+        if attr and attr.get("is_multivalued", False):
+            # one list per entry; np.array() would turn lists of equal lengths into a 2-d array
+            arr = np.empty(len(values), dtype=object)
+            for i, v in enumerate(values):
+                arr[i] = v
+            return arr
+        if attr and attr["attr_type"].upper() == 'INT' and None not in values:
+            return np.array(values, dtype=np.int64)
+        return np.array(values, dtype=object)
+
+    def to_list_array(values, attr):
+        # values are lists already (or array text, for arrays of composite types)
+        lists = [split_composite_text(v) if isinstance(v, str) else v for v in values]
+        if output == "numpy" or attr["attr_type"] == 'COMPOSITE':
+            return to_array([decode_value(v, attr) for v in values], attr)
+        offsets = [0]
+        for v in lists:
+            offsets.append(offsets[-1] + len(v or []))
+        flat = [decode_scalar(v, attr) for v in chain.from_iterable(v or [] for v in lists)]
+        return pa.ListArray.from_arrays(pa.array(offsets, type=pa.int32()), pa.array(flat))
+
+    names, arrays = [], []
+    for kind, key, attr, where in plan:
+        if kind == 'column':
+            names.append(key)
+            arrays.append(to_array(list(columns[where])))
+        elif kind == 'attribute' and attr.get("is_multivalued", False):
+            names.append(key)
+            arrays.append(to_list_array(list(columns[where]), attr))
+        elif kind == 'attribute' and attr["attr_type"] == 'COMPOSITE':
+            children = composite_children(attr, columns[where])
+            if output == "arrow":
+                names.append(key)
+                arrays.append(pa.StructArray.from_arrays([pa.array(v) for v in children.values()], names=list(children)))
+            else:
+                for child, values in children.items():
+                    names.append(f"{key}.{child}")
+                    arrays.append(to_array(values))
+        elif kind == 'attribute':
+            names.append(key)
+            arrays.append(to_array([decode_scalar(v, attr) for v in columns[where]], attr))
+        else:
+            children = {child.replace('__', '.'): [decode_value(v, sub_attribute(attr, child)) for v in columns[i]] for child, i in where.items()}
+            if output == "arrow":
+                names.append(key)
+                arrays.append(pa.StructArray.from_arrays([pa.array(v) for v in children.values()], names=list(children)))
+            else:
+                for child, values in children.items():
+                    names.append(f"{key}.{child}")
+                    arrays.append(to_array(values))
+
+    if output == "arrow":
+        return pa.RecordBatch.from_arrays(arrays, names=names)
+    return dict(zip(names, arrays))
+
+# Fetch the results of an executed query in batches, and return them as Arrow record batches or dicts of NumPy arrays
+def fetch_batches(cursor, entity=None, output: str = "arrow", batch_size: int = 10000):
+    column_names = [d[0] for d in cursor.description]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield decode_columns(rows, column_names, entity, output)
@@ -1,55 +1,398 @@
 import re
+import threading
+from collections import OrderedDict
 from typing import List, Dict, Tuple, Any
+from sql_analyzer import parse_and_analyze
+from sql_parser import Param
+from instrumentation import timed
 
-def generate_sql_query(tables: List[Tuple[str, List[List[str]]]], entity, graph):
-    # relevant_tables is the list of tables we would use for "inserts" -- so let's start with that
-    relevant_tables = [table for table in tables if table[0] in entity.tables]
+AGGREGATE_FUNCTIONS = ["COUNT", "SUM", "AVG", "MIN", "MAX"]
 
-    # construct attribute lists for the relevant tables since we will need them often
+# For each (top-level) attribute of the entity, figure out which table it lives in and which columns it maps to
+# A composite attribute may have been split up into multiple "name__child" columns, and a multivalued attribute
+# may have been normalized into a table of its own (with just the key and the attribute)
+# The storage of a composite attribute (see construct_create_statements.composite_columns) is one of flattened,
+# row and jsonb
+def locate_attributes(tables: List[Tuple[str, List[List[str]]]], entity, table_names=None) -> Dict[str, Dict[str, Any]]:
+    if table_names is None:
+        table_names = entity.tables
+    relevant_tables = [table for table in tables if table[0] in table_names]
     relevant_table_attribute_lists = {}
+    relevant_table_attribute_types = {}
     for table in relevant_tables:
         relevant_table_attribute_lists[table[0]] = [column[0] for column in table[1]]
+        relevant_table_attribute_types[table[0]] = [column[1] for column in table[1]]
+
+    locations = {}
+    for attr in entity.attributes_with_structure:
+        attr_name = attr["attr_name"]
+        found = [t for t in relevant_table_attribute_lists if attr_name in relevant_table_attribute_lists[t]]
+        location = {'tables': found[:1], 'columns': [attr_name], 'sources': [f"{t}.{attr_name}" for t in found[:1]], 'normalized': False,
+                    'is_multivalued': attr.get("is_multivalued", False), 'is_composite': attr["attr_type"] == 'COMPOSITE', 'storage': None}
+        if location['is_composite'] and found:
+            column_type = relevant_table_attribute_types[found[0]][relevant_table_attribute_lists[found[0]].index(attr_name)]
+            location['storage'] = 'jsonb' if column_type.startswith('JSONB') else 'row'
+        if location['is_composite'] and not found:
+            # look for attr_name__ in the attribute lists
+            location['storage'] = 'flattened'
+            location['columns'] = []
+            for t in relevant_table_attribute_lists:
+                for a in relevant_table_attribute_lists[t]:
+                    if f"{attr_name}__" in a:
+                        location['columns'].append(a)
+                        location['sources'].append(f"{t}.{a}")
+                        if t not in location['tables']:
+                            location['tables'].append(t)
+        elif location['is_multivalued']:
+            # if the attribute has been normalized away, then it is in its own table which doesn't have []
+            assert found, f"Attribute {attr_name} not found in any table"
+            location['normalized'] = len(relevant_table_attribute_lists[found[0]]) == 2 and not relevant_table_attribute_types[found[0]][1].endswith('[]')
+        locations[attr_name] = location
+    return locations
 
-    attributes_with_structure = entity.attributes_with_structure
+# attributes: the top-level attributes to return (all of them by default); tables that only hold a normalized
+#   multivalued attribute that is not asked for are not joined in
+# unnest: a multivalued attribute to return one value per row, instead of as an array
+# notes: if a list is passed, explanations of where the attributes, joins and aggregations come from are added to it
+# with_key: also return the key of the main table, as erbium_key
+def generate_sql_query(tables: List[Tuple[str, List[List[str]]]], entity, graph, attributes=None, unnest=None, notes=None, with_key=False):
+    if notes is None:
+        notes = []
 
-    select_clause = []
+    # relevant_tables is the list of tables we would use for "inserts" -- so let's start with that
+    table_names = entity.tables
+    if entity.materialized_view:
+        # the view holds the fully assembled entity, so there is nothing to join or to aggregate
+        table_names = [entity.materialized_view]
+        notes.append(f"{entity.unique_name}: read from materialized view {entity.materialized_view}")
+    relevant_tables = [table for table in tables if table[0] in table_names]
+
+    locations = locate_attributes(tables, entity, table_names)
+    if attributes is None:
+        attributes = list(locations)
+    skipped_tables = {locations[a]['tables'][0] for a in locations if locations[a]['normalized'] and a not in attributes}
+    skipped_tables.discard(relevant_tables[0][0])
+
+    select_clause = [f"{relevant_tables[0][0]}.{relevant_tables[0][1][0][0]} AS erbium_key"] if with_key else []
     from_clause = [relevant_tables[0][0]] # TODO We are assuming that the first table is the main table
+    notes.append(f"{entity.unique_name}: reassembled from {', '.join(t[0] for t in relevant_tables if t[0] not in skipped_tables)}"
+                 f" (relN holds connected subgraph N)")
+    # the instances without any value of the unnested attribute are kept (with a NULL value)
+    unnested_table = locations[unnest]['tables'][0] if unnest and locations[unnest]['normalized'] else None
     for table in relevant_tables[1:]:
-        from_clause.append(f"JOIN {table[0]} ON {relevant_tables[0][0]}.{relevant_tables[0][1][0][0]} = {table[0]}.{table[1][0][0]}")
+        if table[0] not in skipped_tables:
+            join = "LEFT JOIN" if table[0] == unnested_table else "JOIN"
+            from_clause.append(f"{join} {table[0]} ON {relevant_tables[0][0]}.{relevant_tables[0][1][0][0]} = {table[0]}.{table[1][0][0]}")
+            provides = [a for a in attributes if table[0] in locations[a]['tables']]
+            notes.append(f"join {table[0]} on {table[1][0][0]}: " +
+                         (f"for {', '.join(provides)}" if provides else "restricts to the entities that are in it"))
+        elif table[0] in skipped_tables:
+            notes.append(f"{table[0]} is not joined in: none of its attributes are needed")
 
-    for attr in attributes_with_structure: 
-        attr_name = attr["attr_name"]
-        # if composite, check if it may have been split into multiple columns
-        found = [t for t in relevant_table_attribute_lists if attr_name in relevant_table_attribute_lists[t]]
-        if attr["attr_type"] == 'COMPOSITE': 
-            if found:
-                # not split up
-                select_clause.append(f"{found[0]}.{attr_name} AS {attr_name}")
-            else: 
-                # look for attr_name__ in the attribute lists
-                split_parts = []
-                for t in relevant_table_attribute_lists:
-                    for a in relevant_table_attribute_lists[t]:
-                        if f"{attr_name}__" in a:
-                            split_parts.append(a)
-                select_clause.extend([f"{t} AS {t}" for t in split_parts])
-        elif attr["is_multivalued"]:
-            # if the attribute has been normalized away, then it is in its own table which doesn't have [] 
-            assert found
-            if len(relevant_table_attribute_lists[found[0]]) == 2:
+    for attr_name in locations:
+        if attr_name not in attributes:
+            continue
+        location = locations[attr_name]
+        kind = ""
+        if location['normalized']:
+            kind = " (normalized multivalued attribute)"
+        elif location['is_multivalued']:
+            kind = " (array)"
+        if location['is_composite']:
+            kind = {'flattened': " (flattened composite)", 'row': " (composite type)", 'jsonb': " (JSONB)"}[location['storage']] + kind
+        notes.append(f"attribute {attr_name} <- {', '.join(location['sources'])}{kind}")
+        if location['storage'] == 'flattened':
+            select_clause.extend([f"{t} AS {t}" for t in location['columns']])
+        elif location['is_multivalued'] and attr_name == unnest:
+            if location['normalized']:
+                select_clause.append(f"{location['tables'][0]}.{attr_name} AS {attr_name}")
+            else:
+                from_clause.append(f"LEFT JOIN LATERAL unnest({location['tables'][0]}.{attr_name}) AS {attr_name}_values({attr_name}) ON TRUE")
+                select_clause.append(f"{attr_name}_values.{attr_name} AS {attr_name}")
+            notes.append(f"one row per value of {attr_name}" + ("" if location['normalized'] else " (unnest of the array)"))
+        elif location['is_multivalued']:
+            if location['normalized']:
                 select_clause.append(f"ARRAY_AGG({attr_name}) AS {attr_name}")
             else: 
                 select_clause.append(f"{attr_name} AS {attr_name}")
         else:
-            select_clause.append(f"{found[0]}.{attr_name} AS {attr_name}")
+            select_clause.append(f"{location['tables'][0]}.{attr_name} AS {attr_name}")
 
     select_clause_str = ", ".join(select_clause)
     from_clause_str = " ".join(from_clause)
 
-    # check if group by is needed
+    # check if group by is needed; always grouped by the key of the main table (which does not have to be
+    # projected), so that the instances are kept apart whichever attributes are asked for
     if "AGG" in select_clause_str:
-        group_by_clause = [c.split()[0] for c in select_clause if "AGG" not in c]
+        group_by_clause = [f"{relevant_tables[0][0]}.{relevant_tables[0][1][0][0]}"]
+        group_by_clause += [c.split()[0] for c in select_clause if "AGG" not in c and c.split()[0] not in group_by_clause]
         group_by_clause_str = ", ".join(group_by_clause)
+        notes.append(f"ARRAY_AGG + GROUP BY {group_by_clause_str}: to put the normalized multivalued attributes back together")
         return f"SELECT {select_clause_str} FROM {from_clause_str} GROUP BY {group_by_clause_str}"
     else: 
         return f"SELECT {select_clause_str} FROM {from_clause_str}"
+
+# locations: if passed, a COUNT over a flattened composite attribute is expanded to its columns (it counts the
+#   values that have any part set, as there is no single column to count)
+def aggregate_expression(aggregate, locations=None):
+    assert aggregate['aggregate'] in AGGREGATE_FUNCTIONS
+    distinct = "DISTINCT " if aggregate['distinct'] else ""
+    location = (locations or {}).get(aggregate['attr_name'])
+    if location and location['storage'] == 'flattened':
+        assert aggregate['aggregate'] == 'COUNT', \
+            f"Cannot compute {aggregate['aggregate']} over composite attribute {aggregate['attr_name']}"
+        any_set = " OR ".join(f"{c} IS NOT NULL" for c in location['columns'])
+        counted = f"DISTINCT ROW({', '.join(location['columns'])})" if aggregate['distinct'] else "*"
+        return f"COUNT({counted}) FILTER (WHERE {any_set})"
+    return f"{aggregate['aggregate']}({distinct}{aggregate['attr_name']})"
+
+def aggregate_alias(aggregate):
+    if aggregate.get('alias'):
+        return aggregate['alias']
+    if aggregate['attr_name'] == '*':
+        return aggregate['aggregate'].lower()
+    return f"{aggregate['aggregate'].lower()}_{aggregate['attr_name']}"
+
+# Attributes that are mentioned in a (passed through) WHERE condition
+def attributes_in_condition(condition, locations):
+    words = set(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", re.sub(r"'(?:[^'\\]|\\.)*'", "", condition)))
+    return [a for a in locations if a in words or any(c in words for c in locations[a]['columns'])]
+
+def is_plain_select(query: Dict[str, Any]):
+    return not query.get('columns') and not query.get('condition') and not query.get('group_by') and not query.get('order_by') \
+        and query.get('limit') is None and query.get('offset') is None
+
+# Figure out which attributes a SELECT needs from the reassembled entity, so the rest can be left out of it,
+# and which multivalued attribute (if any) has to be unnested; returns (needed, unnest)
+def select_requirements(locations, entity, query: Dict[str, Any]):
+    columns = query.get('columns')
+    condition = query.get('condition')
+    group_by = query.get('group_by', [])
+    order_by = query.get('order_by', [])
+    aggregates = [c for c in columns or [] if 'aggregate' in c] + [e for e, _ in order_by if isinstance(e, dict)]
+    aliases = [aggregate_alias(c) for c in columns or [] if 'aggregate' in c]
+
+    referenced = [c['attr_name'] for c in columns or []] + group_by + [e for e, _ in order_by if not isinstance(e, dict)]
+    referenced += [a['attr_name'] for a in aggregates]
+    for name in referenced:
+        assert name == '*' or name in locations or name in aliases, f"Unknown attribute {name} for {entity.unique_name}"
+    if columns is None:
+        needed = list(locations)
+    else:
+        needed = [a for a in locations if a in referenced]
+        if condition:
+            needed += [a for a in attributes_in_condition(condition, locations) if a not in needed]
+        if not needed:
+            needed = [list(locations)[0]]
+
+    # Aggregating (or grouping) over a multivalued attribute works on its individual values
+    unnested = {a for a in [x['attr_name'] for x in aggregates] + group_by if a in locations and locations[a]['is_multivalued']}
+    assert len(unnested) <= 1, "Only one multivalued attribute can be aggregated over at a time"
+    unnest = unnested.pop() if unnested else None
+    if unnest:
+        assert not [a for a in needed if a != unnest and locations[a]['is_multivalued']], \
+            f"Cannot return other multivalued attributes when aggregating over {unnest}"
+        # (the other aggregates would be computed over one row per value, not per instance)
+        if unnest in [x['attr_name'] for x in aggregates]:
+            others = [aggregate_expression(x) for x in aggregates if x['attr_name'] != unnest]
+            assert not others, f"Cannot compute {', '.join(others)} together with aggregates over {unnest}"
+    return needed, unnest
+
+# Compile an analyzed SELECT (see sql_analyzer.analyze_select) into SQL
+# The entity is first reassembled from its tables (generate_sql_query), and the filters, aggregates, 
+# ORDER BY and LIMIT are then applied on top of that, so all of it runs in PostgreSQL
+# base: the name of a (WITH) query that already reassembles the entity with everything this query needs
+def generate_select_query(tables: List[Tuple[str, List[List[str]]]], entity, graph, query: Dict[str, Any], notes=None, base=None):
+    columns = query.get('columns')
+    condition = query.get('condition')
+    group_by = query.get('group_by', [])
+    order_by = query.get('order_by', [])
+    limit, offset = query.get('limit'), query.get('offset')
+
+    if is_plain_select(query) and base is None:
+        return generate_sql_query(tables, entity, graph, notes=notes)
+    if notes is None:
+        notes = []
+
+    locations = locate_attributes(tables, entity)
+    aggregates = [c for c in columns or [] if 'aggregate' in c] + [e for e, _ in order_by if isinstance(e, dict)]
+    needed, unnest = select_requirements(locations, entity, query)
+
+    def expand(name):
+        return locations[name]['columns'] if name in locations else [name]
+
+    select_clause = []
+    for c in columns or ['*']:
+        if c == '*':
+            select_clause.append('*')
+        elif 'aggregate' in c:
+            assert c['attr_name'] == '*' or not locations[c['attr_name']]['is_composite'] or c['aggregate'] == 'COUNT', \
+                f"Cannot compute {c['aggregate']} over composite attribute {c['attr_name']}"
+            select_clause.append(f"{aggregate_expression(c, locations)} AS {aggregate_alias(c)}")
+        else:
+            select_clause.extend(expand(c['attr_name']))
+
+    if aggregates and not group_by:
+        plain = [c['attr_name'] for c in columns or [] if 'aggregate' not in c]
+        assert not plain, f"Attributes {plain} must appear in GROUP BY"
+
+    if base is None:
+        sql = f"SELECT {', '.join(select_clause)} FROM ({generate_sql_query(tables, entity, graph, attributes=needed, unnest=unnest, notes=notes)}) AS {entity.unique_name}"
+    else:
+        sql = f"SELECT {', '.join(select_clause)} FROM {base} AS {entity.unique_name}"
+    if condition:
+        sql += f" WHERE {condition}"
+        notes.append(f"WHERE {condition}: applied to the reassembled {entity.unique_name}")
+    if group_by:
+        sql += " GROUP BY " + ", ".join(c for name in group_by for c in expand(name))
+    if aggregates:
+        notes.append(f"{', '.join(aggregate_expression(a) for a in aggregates)}" +
+                     (f" per {', '.join(group_by)}" if group_by else "") + ": computed in PostgreSQL")
+    if order_by:
+        order_clause = []
+        for expr, direction in order_by:
+            if isinstance(expr, dict):
+                order_clause.append(f"{aggregate_expression(expr, locations)} {direction}")
+            else:
+                order_clause.extend(f"{c} {direction}" for c in expand(expr))
+        sql += " ORDER BY " + ", ".join(order_clause)
+    if limit is not None:
+        sql += f" LIMIT {limit}"
+    if offset is not None:
+        sql += f" OFFSET {offset}"
+    return sql
+
+def quote_literal(value):
+    if isinstance(value, Param):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+# Compile a CLOSURE/PATHS query (see sql_analyzer.analyze_traversal) over a recursive relationship into a single
+# WITH RECURSIVE query against the relationship's table
+#
+# The two columns of the table are named after the roles (recursive_relationship_roles); we follow the edges from
+# the first role to the second one (e.g., from a course to its prereqs), or the other way around if reversed
+def generate_traversal_query(tables: List[Tuple[str, List[List[str]]]], relationship, query: Dict[str, Any], notes=None):
+    assert relationship.is_relationship() and relationship.recursive_relationship_roles, \
+        f"{relationship.unique_name} is not a recursive relationship"
+    table_name = list(relationship.tables)[0]
+    table_columns = [column[0] for table in tables if table[0] == table_name for column in table[1]]
+    source, target = [attr["attr_name"] for attr in relationship.attributes_with_structure[:2]]
+    assert source in table_columns and target in table_columns
+    if query['reverse']:
+        source, target = target, source
+
+    start = quote_literal(query['start'])
+    max_depth = query['max_depth']
+    if notes is not None:
+        notes.append(f"{relationship.unique_name}: WITH RECURSIVE over {table_name}, following {source} -> {target}"
+                     + (f", up to depth {max_depth}" if max_depth is not None else ""))
+
+    if query['traversal'] == 'PATHS':
+        # Every path is kept separately; a path is not extended to an entity it already went through
+        cycle_check = f"{table_name}.{target} <> ALL(traversal.path)"
+        depth_check = f" AND traversal.depth < {max_depth}" if max_depth is not None else ""
+        return (f"WITH RECURSIVE traversal(source, target, depth, path) AS ("
+                f"SELECT {source}, {target}, 1, ARRAY[{source}, {target}] FROM {table_name} WHERE {source} = {start} "
+                f"UNION ALL "
+                f"SELECT traversal.source, {table_name}.{target}, traversal.depth + 1, traversal.path || {table_name}.{target} "
+                f"FROM traversal JOIN {table_name} ON {table_name}.{source} = traversal.target "
+                f"WHERE {cycle_check}{depth_check}) "
+                f"SELECT source AS {source}, target AS {target}, depth, path FROM traversal ORDER BY depth, path")
+    elif max_depth is None:
+        # UNION (rather than UNION ALL) stops as soon as no new entities are found, so cycles are not a problem
+        return (f"WITH RECURSIVE traversal({target}) AS ("
+                f"SELECT {target} FROM {table_name} WHERE {source} = {start} "
+                f"UNION "
+                f"SELECT {table_name}.{target} FROM traversal JOIN {table_name} ON {table_name}.{source} = traversal.{target}) "
+                f"SELECT {target} FROM traversal ORDER BY {target}")
+    else:
+        return (f"WITH RECURSIVE traversal({target}, depth) AS ("
+                f"SELECT {target}, 1 FROM {table_name} WHERE {source} = {start} "
+                f"UNION "
+                f"SELECT {table_name}.{target}, traversal.depth + 1 FROM traversal JOIN {table_name} ON {table_name}.{source} = traversal.{target} "
+                f"WHERE traversal.depth < {max_depth}) "
+                f"SELECT DISTINCT {target} FROM traversal ORDER BY {target}")
+
+# Compile an analyzed query (SELECT or CLOSURE/PATHS) into SQL
+def compile_analyzed(result: Dict[str, Any], tables: List[Tuple[str, List[List[str]]]], graph, notes=None):
+    with timed("generate_sql_query", entity=result['table_name'].lower()):
+        if 'traversal' in result:
+            return generate_traversal_query(tables, graph.get_node_by_name(result['table_name']), result, notes)
+        return generate_select_query(tables, graph.get_node_by_name(result['table_name']), graph, result, notes)
+
+# Parse, analyze and compile a query (SELECT or CLOSURE/PATHS) into SQL
+def compile_query(query: str, tables: List[Tuple[str, List[List[str]]]], graph, notes=None):
+    result = parse_and_analyze(query)
+    return result, compile_analyzed(result, tables, graph, notes)
+
+# Compile a batch of queries into a single SQL statement, so they all run in one round trip
+# Each query's result comes back as a JSON array in a column of its own (q0, q1, ...); queries over the same entity
+# share the reassembled entity (a WITH query), with the attributes all of them need, as long as they need the same
+# normalized multivalued attributes (which restrict the entities that are returned) and unnest the same one
+# Returns (results, sql, entities), with entity None for traversals
+def compile_batch(queries: List[str], tables: List[Tuple[str, List[List[str]]]], graph, notes=None):
+    if notes is None:
+        notes = []
+    results = [parse_and_analyze(q) for q in queries]
+    entities = [None if 'traversal' in r else graph.get_node_by_name(r['table_name']) for r in results]
+
+    # Work out the shared bases first
+    bases = OrderedDict()   # (entity, normalized attributes, unnest) -> attributes needed
+    keys = []
+    for result, entity in zip(results, entities):
+        if entity is None:
+            keys.append(None)
+            continue
+        locations = locate_attributes(tables, entity)
+        needed, unnest = select_requirements(locations, entity, result)
+        key = (entity.unique_name, tuple(a for a in needed if locations[a]['normalized']), unnest)
+        bases.setdefault(key, set()).update(needed)
+        keys.append(key)
+
+    with_clause = []
+    base_names = {}
+    for i, ((entity_name, _, unnest), needed) in enumerate(bases.items()):
+        entity = graph.get_node_by_name(entity_name)
+        base_names[(entity_name, _, unnest)] = f"base{i}_{entity_name}"
+        attributes = [a for a in locate_attributes(tables, entity) if a in needed]
+        with_clause.append(f"{base_names[(entity_name, _, unnest)]} AS ({generate_sql_query(tables, entity, graph, attributes=attributes, unnest=unnest, notes=notes)})")
+        shared_by = sum(1 for k in keys if k == (entity_name, _, unnest))
+        if shared_by > 1:
+            notes.append(f"{base_names[(entity_name, _, unnest)]}: {entity_name} is reassembled once for {shared_by} queries")
+
+    select_clause = []
+    for i, (result, entity, key) in enumerate(zip(results, entities, keys)):
+        if entity is None:
+            sql = generate_traversal_query(tables, graph.get_node_by_name(result['table_name']), result, notes)
+        else:
+            sql = generate_select_query(tables, entity, graph, result, notes, base=base_names[key])
+        select_clause.append(f"(SELECT json_agg(q{i}) FROM ({sql}) AS q{i}) AS q{i}")
+
+    sql = f"SELECT {', '.join(select_clause)}"
+    if with_clause:
+        sql = f"WITH {', '.join(with_clause)} " + sql
+    return results, sql, entities
+
+# An LRU cache of compiled queries, so that repeated queries skip parsing and mapping
+# Returns (sql, entity), where entity is None for traversals; safe to share between threads
+class QueryPlanCache:
+    def __init__(self, tables, graph, size=1000):
+        self.tables = tables
+        self.graph = graph
+        self.size = size
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+
+    def compile(self, query):
+        with self.lock:
+            if query in self.plans:
+                self.plans.move_to_end(query)
+                return self.plans[query]
+        result, sql = compile_query(query, self.tables, self.graph)
+        entity = None if 'traversal' in result else self.graph.get_node_by_name(result['table_name'])
+        with self.lock:
+            self.plans[query] = (sql, entity)
+            if len(self.plans) > self.size:
+                self.plans.popitem(last=False)
+        return sql, entity
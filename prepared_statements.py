@@ -0,0 +1,182 @@
+import re
+import itertools
+import time
+from typing import Dict
+
+import psycopg2
+
+from sql_parser import Param
+from sql_analyzer import parse_and_analyze
+from map_select_queries import compile_analyzed
+from map_insert_statements import generate_insert_statements, match_to_schema, insert_tables
+from map_query_results import decode_rows
+from result_cache import bump_table_versions
+from key_allocation import KeyAllocator, key_attribute
+from instrumentation import timed
+import workload
+
+##############################################################################################################
+### Prepared ER statements with bind parameters ($1, $2, ... or ?), e.g.,
+###
+###     session = ERSession("univ", tables, types, graph)
+###     by_city = session.prepare("select person_id, name from person where city = $1 limit $2")
+###     rows = by_city.execute("Smithfurt", 10)
+###     add_course = session.prepare("insert into course values (?, ?, ?)")
+###     add_course.execute_many([(100, 'Databases', '4'), (101, 'Compilers', '4')])
+###     add_person = session.prepare("insert into person values (DEFAULT, (?, ?), ?, ?, [])")
+###     [person_id] = add_person.execute('Laura', 'Jackson', 'Main St', 'Smithfurt')
+###
+### A statement is parsed, analyzed and mapped once. A SELECT (or CLOSURE/PATHS) is compiled into SQL with the
+### parameters left in, and PREPAREd in PostgreSQL, so executing it reuses the parsed statement and its plan. An
+### INSERT keeps its analyzed values, with the parameters in them, and the entity and tables it writes to; executing
+### it fills in the values and runs the (parameterized) inserts into the tables, and returns the keys of the
+### instances (which are generated for DEFAULT, see key_allocation.py).
+###
+### Note that psycopg2 has no protocol-level binding: it quotes the values into the EXECUTE (or INSERT) text on the
+### client, as it does for any %s. What preparing saves is the parsing and planning, not the quoting.
+##############################################################################################################
+
+STRING_LITERAL = r"('(?:[^'\\]|\\.)*')"
+
+# Number the "?" placeholders ($1, $2, ...), leaving the ones in string literals alone
+def number_placeholders(statement: str) -> str:
+    parts = re.split(STRING_LITERAL, statement)
+    if not any('?' in part for part in parts[::2]):
+        return statement
+    assert not any(re.search(r"\$[0-9]", part) for part in parts[::2]), "Cannot mix ? and $n placeholders"
+    count = itertools.count(1)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\?", lambda m: f"${next(count)}", parts[i])
+    return "".join(parts)
+
+def count_params(statement: str) -> int:
+    parts = re.split(STRING_LITERAL, statement)
+    indexes = [int(i) for part in parts[::2] for i in re.findall(r"\$([0-9]+)", part)]
+    return max(indexes, default=0)
+
+# Replace the parameters in (nested) analyzed values with the bound values
+def bind_values(values, params):
+    if isinstance(values, Param):
+        return params[values.index - 1]
+    if isinstance(values, list):
+        return [bind_values(v, params) for v in values]
+    if isinstance(values, tuple):
+        return tuple(bind_values(v, params) for v in values)
+    return values
+
+class PreparedStatement:
+    def __init__(self, session, name: str, statement: str):
+        self.session = session
+        self.name = name
+        self.statement = number_placeholders(statement)
+        self.param_count = count_params(self.statement)
+        self.analyzed = parse_and_analyze(self.statement)
+        self.is_insert = 'values' in self.analyzed and 'columns' not in self.analyzed
+
+        if self.is_insert:
+            graph = session.graph
+            self.entity = [node for node in graph.nodes if node.is_entity() and node.name.lower() == self.analyzed["table_name"].lower()][0]
+            self.tables = insert_tables(self.entity, session.tables, graph)
+            self.sql = None
+        else:
+            self.entity = None if 'traversal' in self.analyzed else session.graph.get_node_by_name(self.analyzed['table_name'])
+            self.sql = compile_analyzed(self.analyzed, session.tables, session.graph)
+            cursor = session.conn.cursor()
+            cursor.execute(f"PREPARE {name} AS {self.sql}")
+            cursor.close()
+            session.conn.commit()
+
+    def check_params(self, params):
+        assert len(params) == self.param_count, f"{self.name} takes {self.param_count} parameters, {len(params)} given"
+
+    # Returns the decoded rows for a query, and the key of the instance for an insert
+    def execute(self, *params):
+        self.check_params(params)
+        if self.is_insert:
+            return self.execute_many([params])
+        conn = self.session.conn
+        cursor = conn.cursor()
+        start = time.perf_counter()
+        try:
+            entity_name = self.analyzed['table_name'].lower()
+            with timed("execute", entity=entity_name) as timer:
+                if params:
+                    cursor.execute(f"EXECUTE {self.name} ({', '.join(['%s'] * len(params))})", params)
+                else:
+                    cursor.execute(f"EXECUTE {self.name}")
+                fetched = cursor.fetchall()
+                timer.rows = len(fetched)
+            column_names = [d[0] for d in cursor.description]
+            with timed("decode_rows", entity=entity_name, rows=len(fetched)):
+                rows = decode_rows(fetched, column_names, self.entity)
+        finally:
+            cursor.close()
+            conn.rollback()
+        workload.record("prepared", self.statement, self.sql, time.perf_counter() - start, len(rows), params=list(params))
+        return rows
+
+    # Insert one entity per tuple of parameters, all in one transaction; returns their keys
+    def execute_many(self, param_rows):
+        assert self.is_insert, "execute_many is only for inserts"
+        conn = self.session.conn
+        cursor = conn.cursor()
+        touched = set()
+        keys = []
+        try:
+            for params in param_rows:
+                start = time.perf_counter()
+                self.check_params(params)
+                values_as_dict = match_to_schema(self.analyzed["table_name"], bind_values(self.analyzed["values"], params), self.entity)
+                self.session.keys.fill(cursor, self.entity, [values_as_dict])
+                keys.append(values_as_dict.get(key_attribute(self.entity)))
+                with timed("generate_insert_statements", entity=self.entity.unique_name):
+                    insert_data = generate_insert_statements(values_as_dict, self.tables, self.session.types)
+                for table_name, _, statement, values in insert_data:
+                    with timed("execute", entity=self.entity.unique_name, table=table_name, rows=1):
+                        cursor.execute(statement, values)
+                    touched.add(table_name)
+                workload.record("prepared", self.statement, seconds=time.perf_counter() - start, rows=1, params=list(params))
+            bump_table_versions(cursor, touched)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        return keys
+
+    def deallocate(self):
+        if not self.is_insert:
+            cursor = self.session.conn.cursor()
+            cursor.execute(f"DEALLOCATE {self.name}")
+            cursor.close()
+            self.session.conn.commit()
+
+# Prepared statements belong to a connection, so a session holds one; it is not meant to be shared between threads
+class ERSession:
+    def __init__(self, db_name, tables, types, graph):
+        self.tables = tables
+        self.types = types
+        self.graph = graph
+        self.conn = psycopg2.connect(f"dbname={db_name}")
+        self.statements: Dict[str, PreparedStatement] = {}
+        self.keys = KeyAllocator()
+        self.counter = itertools.count()
+
+    def prepare(self, statement: str, name: str = None) -> PreparedStatement:
+        name = (name or f"erdb_stmt_{next(self.counter)}").lower()
+        assert re.fullmatch(r"[a-z_][a-z0-9_]*", name), f"Not a valid statement name: {name}"
+        if name in self.statements:
+            self.deallocate(name)
+        self.statements[name] = PreparedStatement(self, name, statement)
+        return self.statements[name]
+
+    def execute(self, name: str, *params):
+        assert name.lower() in self.statements, f"No prepared statement named {name}"
+        return self.statements[name.lower()].execute(*params)
+
+    def deallocate(self, name: str):
+        self.statements.pop(name.lower()).deallocate()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,176 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+import instrumentation
+
+##############################################################################################################
+### Profiling any erbium.py command: python3 erbium.py <command> ... --profile <prefix> [--profile-mode sample|cprofile]
+###
+###   sample (the default): a thread takes a stack sample every --profile-interval ms (of the main thread, or of all
+###       the request threads for serve); the time spent in PostgreSQL (inside an "execute" or "commit" stage, see
+###       instrumentation.py) shows up as a [postgresql] frame
+###   cprofile: deterministic profiling with cProfile; <prefix>.prof can be loaded with pstats/snakeviz
+###
+### Both write <prefix>.collapsed, in the "frame;frame;frame count" format of flamegraph.pl/speedscope (for
+### cprofile, the "stacks" are just module group;function, weighted by the time spent in the function itself, in
+### microseconds), and <prefix>.summary.txt, with the time per ErbiumDB module group (parser, analyzer, graph,
+### mapper, DB I/O, ...) and the top functions, which is also printed when the command ends.
+##############################################################################################################
+
+MODULE_GROUPS = [
+    ("parser", ["sql_parser.py", os.sep + "pyparsing" + os.sep]),
+    ("analyzer", ["sql_analyzer.py"]),
+    ("graph", ["er_graph.py", "construct_create_statements.py"]),
+    ("mapper", ["map_insert_statements.py", "map_select_queries.py", "map_query_results.py", "prepared_statements.py",
+                "entity_loader.py"]),
+    ("db i/o", [os.sep + "psycopg2" + os.sep, "psycopg2.", "result_cache.py", "[postgresql]"]),
+    ("erbium", ["erbium.py", "erbium_server.py", "generate_data_univ.py", "instrumentation.py", "workload.py"]),
+]
+IDLE_FUNCTIONS = {"wait", "select", "accept", "poll", "get", "serve_forever", "_recv_into", "readinto", "readline"}
+
+# (built-in functions have no file, so their names are matched as well)
+def module_group(filename, function=""):
+    for group, patterns in MODULE_GROUPS:
+        if any(p in filename or p in function for p in patterns):
+            return group
+    return "other"
+
+def frame_name(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+##############################################################################################################
+### Sampling
+##############################################################################################################
+class SamplingProfiler:
+    def __init__(self, interval=0.005, all_threads=False):
+        self.interval = interval
+        self.all_threads = all_threads
+        self.stacks = Counter()         # tuple of (filename, frame name), root first -> samples
+        self.samples = 0
+        self.ticks = 0
+        self.elapsed = 0
+        self.running = False
+        self.thread = None
+        self.main_thread_id = threading.main_thread().ident
+
+    # The sampler needs the GIL to look at the other threads, so they are made to give it up more often than the
+    # default 5ms; otherwise most samples would land where they wait for PostgreSQL
+    def start(self):
+        self.running = True
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self.switch_interval, self.interval / 10))
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name="erbium-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        sys.setswitchinterval(self.switch_interval)
+
+    def run(self):
+        own_id = threading.get_ident()
+        while self.running:
+            frames = sys._current_frames()
+            for thread_id, frame in frames.items():
+                if thread_id == own_id or (not self.all_threads and thread_id != self.main_thread_id):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append((frame.f_code.co_filename, frame_name(frame.f_code)))
+                    frame = frame.f_back
+                stack.reverse()
+                if self.all_threads and stack and stack[-1][1].split(":")[1] in IDLE_FUNCTIONS:
+                    continue
+                if instrumentation.current_stage(thread_id) in ["execute", "commit"]:
+                    stack.append(("[postgresql]", "[postgresql]"))
+                self.stacks[tuple(stack)] += 1
+                self.samples += 1
+            self.ticks += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        return [(";".join(name for _, name in stack), count) for stack, count in self.stacks.most_common()]
+
+    # (self time, total time) per function, and self time per group, in seconds: a sample stands for the wall time
+    # between two samples, which is longer than the interval
+    def totals(self):
+        own, inclusive, groups_own = Counter(), Counter(), Counter()
+        for stack, count in self.stacks.items():
+            filename, name = stack[-1]
+            own[name] += count
+            groups_own[module_group(filename)] += count
+            for _, name in set(stack):
+                inclusive[name] += count
+        scale = self.elapsed / self.ticks if self.ticks else self.interval
+        return ({k: v * scale for k, v in own.items()}, {k: v * scale for k, v in inclusive.items()},
+                {k: v * scale for k, v in groups_own.items()})
+
+##############################################################################################################
+### cProfile
+##############################################################################################################
+class DeterministicProfiler:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def stats(self):
+        return pstats.Stats(self.profile).stats     # (file, line, function) -> (calls, ncalls, tottime, cumtime, callers)
+
+    def collapsed(self):
+        lines = []
+        for (filename, _, function), (_, _, tottime, _, _) in self.stats().items():
+            if tottime > 0:
+                lines.append((f"{module_group(filename, function)};{os.path.basename(filename)}:{function}", int(tottime * 1e6)))
+        return sorted(lines, key=lambda x: -x[1])
+
+    def totals(self):
+        own, inclusive, groups_own = Counter(), Counter(), Counter()
+        for (filename, _, function), (_, _, tottime, cumtime, _) in self.stats().items():
+            name = f"{os.path.basename(filename)}:{function}"
+            own[name] += tottime
+            inclusive[name] = max(inclusive[name], cumtime)
+            groups_own[module_group(filename, function)] += tottime
+        return own, inclusive, groups_own
+
+##############################################################################################################
+def start_profiling(mode="sample", interval_ms=5, all_threads=False):
+    profiler = SamplingProfiler(interval_ms / 1000, all_threads) if mode == "sample" else DeterministicProfiler()
+    profiler.start()
+    return profiler
+
+def summary(profiler, elapsed, top=25):
+    own, inclusive, groups = profiler.totals()
+    total = sum(groups.values()) or 1
+    lines = [f"Profiled {elapsed:.3f}s ({'%d samples' % profiler.samples if isinstance(profiler, SamplingProfiler) else 'cProfile'})",
+             "", f"{'module group':<14}{'seconds':>10}{'%':>8}"]
+    for group, seconds in sorted(groups.items(), key=lambda x: -x[1]):
+        lines.append(f"{group:<14}{seconds:>10.3f}{seconds / total * 100:>8.1f}")
+    lines += ["", f"{'function':<60}{'self s':>10}{'total s':>10}"]
+    for name, seconds in sorted(own.items(), key=lambda x: -x[1])[:top]:
+        lines.append(f"{name[:59]:<60}{seconds:>10.3f}{inclusive.get(name, 0):>10.3f}")
+    return "\n".join(lines)
+
+def stop_profiling(profiler, prefix, elapsed):
+    profiler.stop()
+    with open(f"{prefix}.collapsed", "w") as f:
+        for stack, count in profiler.collapsed():
+            f.write(f"{stack} {count}\n")
+    if isinstance(profiler, DeterministicProfiler):
+        profiler.profile.dump_stats(f"{prefix}.prof")
+    text = summary(profiler, elapsed)
+    with open(f"{prefix}.summary.txt", "w") as f:
+        f.write(text + "\n")
+    print(text, file=sys.stderr)
+    print(f"Profile written to {prefix}.collapsed and {prefix}.summary.txt", file=sys.stderr)
@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+from typing import Any, Dict, List
+
+from map_select_queries import generate_sql_query
+from instrumentation import timed
+
+##############################################################################################################
+### Referential checks for relationship loads (erbium.py insert ... --check-references)
+###
+### The instances of a relationship name the instances of the entities it is between by their keys: the first
+### attributes of the relationship (see GraphEncoder), e.g., takes (person_id, course_id, sec_id, grade) refers to
+### a student by person_id and to a section by (course_id, sec_id). Without the check, they are written as they
+### are. With it, each batch is checked with one anti-join per referenced entity, over the distinct keys in the
+### batch (sent as arrays and unnested):
+###
+###     SELECT k0 FROM unnest(%s::INTEGER[]) AS refs(k0)
+###     WHERE NOT EXISTS (SELECT 1 FROM (<the entity, reassembled as in a select>) AS e WHERE e.erbium_key = refs.k0)
+###
+### (a recursive relationship such as prereq checks both of its ends in the same query). The instances that refer
+### to a missing instance are left out of the batch and appended to <rejects>/<relationship>.jsonl, as they were
+### read plus the entities they were missing ("erbium_missing"), so that they can be fixed and loaded again.
+###
+### A weak entity is checked against its main table, by the parts of its key that the mapping stores (a
+### discriminator without a column of its own cannot be checked).
+##############################################################################################################
+
+class ReferenceTarget:
+    def __init__(self, entity, source, columns):
+        self.entity = entity
+        self.source = source            # SQL for the instances of the entity
+        self.columns = columns          # [(column of source, type)], one per part of the key
+        self.endpoints = []             # [attribute names of the relationship], one per end of the relationship
+        self.attr_types = {}            # attribute name -> attr_type (from attributes_with_structure)
+
+    # The key a row refers to through some of its attributes; keys read from a file may be strings, so they are
+    # converted to the types of the attributes first (as in unflatten_row), to compare with the database's
+    def key_of(self, row, names):
+        return tuple(key_value(row.get(name), self.attr_types.get(name)) for name in names)
+
+    # The distinct keys that the rows refer to
+    def keys(self, rows):
+        return {self.key_of(row, names) for row in rows for names in self.endpoints}
+
+    def anti_join(self):
+        refs = ", ".join(f"k{i}" for i in range(len(self.columns)))
+        arrays = ", ".join(f"%s::{column_type}[]" for _, column_type in self.columns)
+        matches = " AND ".join(f"e.{column} = refs.k{i}" for i, (column, _) in enumerate(self.columns))
+        return (f"SELECT {refs} FROM unnest({arrays}) AS refs({refs}) "
+                f"WHERE NOT EXISTS (SELECT 1 FROM ({self.source}) AS e WHERE {matches})")
+
+def key_value(value, attr_type):
+    if value in [None, '']:
+        return None
+    return int(value) if attr_type == 'INT' else value
+
+def entity_table(tables, entity):
+    return [table for table in tables if table[0] in entity.tables][0]
+
+def reference_target(tables, graph, entity, names):
+    table_name, columns = entity_table(tables, entity)
+    if not entity.is_weak_entity:
+        return ReferenceTarget(entity, generate_sql_query(tables, entity, graph, attributes=[], with_key=True),
+                               [("erbium_key", columns[0][1])]), names
+    # (the key of a weak entity is the key of its parent and its discriminator)
+    stored = {column[0]: column[1] for column in columns}
+    key = [a['attr_name'] for a in entity.attributes_with_structure[:2]]
+    parts = [i for i, name in enumerate(key) if name in stored]
+    assert parts, f"None of the key of {entity.unique_name} is stored in {table_name}"
+    return ReferenceTarget(entity, f"SELECT * FROM {table_name}", [(key[i], stored[key[i]]) for i in parts]), \
+        [names[i] for i in parts]
+
+# The entities a relationship refers to, with the attributes that refer to them (merged by entity)
+def reference_targets(relationship, tables, graph) -> List[ReferenceTarget]:
+    targets = {}
+    attr_types = {a['attr_name']: a['attr_type'] for a in relationship.attributes_with_structure}
+    attributes = list(attr_types)
+    start = 0
+    for entity in (relationship.entity1, relationship.entity2):
+        width = 2 if entity.is_weak_entity else 1
+        target, names = reference_target(tables, graph, entity, attributes[start:start + width])
+        target = targets.setdefault(entity.unique_name, target)
+        target.endpoints.append(names)
+        target.attr_types.update({name: attr_types[name] for name in names})
+        start += width
+    return list(targets.values())
+
+class ReferenceChecker:
+    def __init__(self, relationship, tables, graph, rejects_dir="rejects"):
+        self.relationship = relationship
+        self.targets = reference_targets(relationship, tables, graph)
+        self.rejects_path = os.path.join(rejects_dir, f"{relationship.unique_name}.jsonl")
+        self.rejects = None
+        self.rejected = 0
+
+    # Returns the rows whose references all exist; the others are written to the rejects file
+    def check(self, cursor, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        missing = {}
+        with timed("check_references", entity=self.relationship.unique_name, rows=len(rows)):
+            for target in self.targets:
+                keys = list(target.keys(rows))
+                cursor.execute(target.anti_join(), [[key[i] for key in keys] for i in range(len(target.columns))])
+                missing[target] = set(cursor.fetchall())
+        valid = []
+        for row in rows:
+            reasons = [target.entity.unique_name for target in self.targets
+                       if any(target.key_of(row, names) in missing[target] for names in target.endpoints)]
+            if reasons:
+                self.reject(row, reasons)
+            else:
+                valid.append(row)
+        return valid
+
+    def reject(self, row, reasons):
+        if self.rejects is None:
+            os.makedirs(os.path.dirname(self.rejects_path) or ".", exist_ok=True)
+            self.rejects = open(self.rejects_path, "a")
+        self.rejects.write(json.dumps(dict(row, erbium_missing=reasons), default=str))
+        self.rejects.write("\n")
+        self.rejected += 1
+
+    def close(self):
+        if self.rejects is not None:
+            self.rejects.close()
+            logging.warning("Rejected %d instances of %s (see %s)", self.rejected, self.relationship.unique_name, self.rejects_path)
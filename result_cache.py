@@ -0,0 +1,129 @@
+import json
+import re
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Any, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+##############################################################################################################
+### An (optional) in-memory cache of query results, keyed by the compiled SQL
+###
+### Each table has a version counter in erdb_table_versions, which the insert (and DDL) paths bump in the same
+### transaction as the change. Bumping a version also sends a notification, which the cache picks up without
+### a round trip to PostgreSQL; a cached result is only returned if none of the tables it read from have changed
+### since. The cache is bounded by (an estimate of) the memory it holds, and evicts the least recently used results.
+### Notifications arrive asynchronously, so a process that has just committed a change itself calls refresh(),
+### which reads the versions back, before it looks anything up again.
+##############################################################################################################
+
+VERSIONS_CHANNEL = "erdb_table_versions"
+
+def create_table_versions(cursor, table_names: List[str]):
+    cursor.execute("CREATE TABLE erdb_table_versions (table_name text primary key, version bigint NOT NULL DEFAULT 0)")
+    cursor.executemany("INSERT INTO erdb_table_versions (table_name) VALUES (%s)", [(t,) for t in table_names])
+    # the tables have all been recreated
+    cursor.execute("SELECT pg_notify(%s, '*')", (VERSIONS_CHANNEL,))
+
+# Must be called in the same transaction as the changes to the tables
+def bump_table_versions(cursor, table_names: List[str]):
+    cursor.execute("UPDATE erdb_table_versions SET version = version + 1 WHERE table_name = ANY(%s) RETURNING table_name, version", (list(table_names),))
+    cursor.execute("SELECT pg_notify(%s, %s)", (VERSIONS_CHANNEL, json.dumps(dict(cursor.fetchall()))))
+
+def estimate_size(rows) -> int:
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for v in (row.values() if isinstance(row, dict) else row):
+            size += sys.getsizeof(v)
+            if isinstance(v, (list, dict)):
+                size += sum(sys.getsizeof(x) for x in (v.values() if isinstance(v, dict) else v))
+    return size
+
+class ResultCache:
+    def __init__(self, db_name, table_names: List[str], max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()   # sql -> (versions of the tables read, rows, size)
+        self.size = 0
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+        self.table_pattern = re.compile(r"\b(" + "|".join(re.escape(t) for t in sorted(table_names, key=len, reverse=True)) + r")\b")
+
+        self.listener = psycopg2.connect(f"dbname={db_name}")
+        self.listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self.listener.cursor()
+        cursor.execute(f"LISTEN {VERSIONS_CHANNEL}")
+        self.load_versions()
+
+    def load_versions(self):
+        cursor = self.listener.cursor()
+        cursor.execute("SELECT table_name, version FROM erdb_table_versions")
+        self.versions = dict(cursor.fetchall())
+        cursor.close()
+
+    # Pick up the notifications that have arrived (this does not wait for the server)
+    def poll(self):
+        self.listener.poll()
+        while self.listener.notifies:
+            notify = self.listener.notifies.pop(0)
+            if notify.payload == '*':
+                self.entries.clear()
+                self.size = 0
+                self.load_versions()
+            else:
+                self.versions.update(json.loads(notify.payload))
+
+    # After a change committed by this process: read the versions back rather than wait for the notification
+    def refresh(self):
+        with self.lock:
+            self.poll()
+            self.load_versions()
+
+    # The current versions of some tables, for other caches that want to be invalidated the same way
+    def table_versions(self, table_names: List[str]) -> Dict[str, int]:
+        with self.lock:
+            self.poll()
+            return {t: self.versions.get(t) for t in table_names}
+
+    def is_current(self, versions: Dict[str, int]) -> bool:
+        return all(self.versions.get(t) == v for t, v in versions.items())
+
+    # Returns (rows, versions): rows is None on a miss, in which case versions should be passed back to put()
+    # along with the rows, so that a result computed while one of its tables changed is not cached
+    def get(self, sql: str) -> Tuple[Optional[Any], Dict[str, int]]:
+        with self.lock:
+            self.poll()
+            entry = self.entries.get(sql)
+            if entry and self.is_current(entry[0]):
+                self.entries.move_to_end(sql)
+                self.hits += 1
+                return entry[1], entry[0]
+            if entry:
+                self.size -= entry[2]
+                del self.entries[sql]
+            self.misses += 1
+            return None, {t: self.versions.get(t) for t in set(self.table_pattern.findall(sql))}
+
+    def put(self, sql: str, versions: Dict[str, int], rows):
+        size = estimate_size(rows)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.poll()
+            if not self.is_current(versions):
+                return
+            if sql in self.entries:
+                self.size -= self.entries[sql][2]
+            self.entries[sql] = (versions, rows, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self.listener.close()
@@ -0,0 +1,241 @@
+import io
+import json
+from array import array
+from typing import Any, Dict, List, Tuple
+
+from instrumentation import timed
+
+##############################################################################################################
+### Columnar batches of entity/relationship instances for the insert mapper
+###
+### Instead of a dict per instance, and an INSERT (with its own value lists, placeholders and SQL string) per
+### instance and table, a RowBatch keeps the instances of one entity in one buffer per attribute, following the
+### entity's attributes_with_structure:
+###   - INT attributes: an array('q') of the values, with a bytearray null mask
+###   - other scalar attributes: a list of the values (references to the values as they were read, no copies)
+###   - composite attributes: a buffer per sub-attribute, with a null mask
+###   - multivalued attributes: the elements of all the instances in one child buffer, with array('L') offsets
+###     (instance i has the elements offsets[i]..offsets[i+1]), as in Arrow
+###
+### A batch is written to each of the entity's tables with a single COPY, whose rows are rendered straight from
+### the buffers into the COPY text stream. The columns are matched to the attributes as generate_insert_statements
+### does: by name, name__child for flattened composites, and a two-column table whose second column is a
+### non-array multivalued attribute is a normalized table, which gets a row per element. Composites stored as
+### JSONB are rendered as JSON (JsonBuffer) rather than as record literals.
+##############################################################################################################
+
+class ScalarBuffer:
+    def __init__(self, attr_type):
+        self.is_int = attr_type == 'INT'
+        self.values = array('q') if self.is_int else []
+        self.nulls = bytearray()
+
+    def __len__(self):
+        return len(self.nulls)
+
+    def append(self, value):
+        self.nulls.append(value is None)
+        if self.is_int:
+            self.values.append(0 if value is None else int(value))
+        else:
+            self.values.append(value)
+
+    def value(self, i):
+        return None if self.nulls[i] else self.values[i]
+
+    def text(self, i):
+        if self.nulls[i]:
+            return None
+        return str(self.values[i])
+
+class StructBuffer:
+    def __init__(self, sub_attributes):
+        # (in the order of the fields of the composite type, see create_composite_type)
+        self.children = {attr['attr_name']: make_buffer(attr) for attr in sub_attributes}
+        self.nulls = bytearray()
+
+    def __len__(self):
+        return len(self.nulls)
+
+    def append(self, value):
+        self.nulls.append(value is None)
+        for name, child in self.children.items():
+            child.append(None if value is None else value.get(name))
+
+    def value(self, i):
+        return None if self.nulls[i] else {name: child.value(i) for name, child in self.children.items()}
+
+    def text(self, i):
+        if self.nulls[i]:
+            return None
+        return "(" + ",".join(record_field(child.text(i)) for child in self.children.values()) + ")"
+
+class ListBuffer:
+    def __init__(self, attr):
+        self.elements = make_buffer(dict(attr, is_multivalued=False))
+        self.offsets = array('L', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # (a missing list is an empty array, as in unflatten_row)
+    def append(self, value):
+        for element in value or []:
+            self.elements.append(element)
+        self.offsets.append(len(self.elements))
+
+    def element_range(self, i):
+        return range(self.offsets[i], self.offsets[i + 1])
+
+    def value(self, i):
+        return [self.elements.value(j) for j in self.element_range(i)]
+
+    def text(self, i):
+        return "{" + ",".join(array_element(self.elements.text(j)) for j in self.element_range(i)) + "}"
+
+# A composite (JSONB) or an array of them (JSONB[]) as JSON, for the values of another buffer
+class JsonBuffer:
+    def __init__(self, buffer, array=False):
+        self.buffer = buffer
+        self.array = array
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def value(self, i):
+        return self.buffer.value(i)
+
+    def text(self, i):
+        value = self.buffer.value(i)
+        if value is None:
+            return None
+        if self.array:
+            return "{" + ",".join(array_element(json.dumps(v)) for v in value) + "}"
+        return json.dumps(value)
+
+# The elements of a multivalued composite as JSON, for a normalized JSONB table
+class JsonListBuffer:
+    def __init__(self, buffer):
+        self.elements = JsonBuffer(buffer.elements)
+        self.element_range = buffer.element_range
+
+def make_buffer(attr):
+    if attr.get('is_multivalued', False):
+        return ListBuffer(attr)
+    if attr['attr_type'] == 'COMPOSITE':
+        return StructBuffer(attr['sub_attributes'])
+    return ScalarBuffer(attr['attr_type'])
+
+##############################################################################################################
+### PostgreSQL text formats
+##############################################################################################################
+def needs_quotes(value, special):
+    return value == "" or any(c in special or c.isspace() for c in value)
+
+def quote(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+# A field of a record literal: (a,"b c",) -- NULL is an empty field
+def record_field(value):
+    if value is None:
+        return ""
+    return quote(value) if needs_quotes(value, '(),"\\') else value
+
+# An element of an array literal: {a,"b c",NULL}
+def array_element(value):
+    if value is None:
+        return "NULL"
+    return quote(value) if needs_quotes(value, '{},"\\') or value.upper() == "NULL" else value
+
+def copy_field(value):
+    if value is None:
+        return "\\N"
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+##############################################################################################################
+### Batches
+##############################################################################################################
+class RowBatch:
+    def __init__(self, entity, tables: List[Tuple[str, List[Tuple[str, str, str]]]]):
+        self.entity = entity
+        self.tables = tables
+        self.clear()
+
+    def clear(self):
+        self.buffers = {attr['attr_name']: make_buffer(attr) for attr in self.entity.attributes_with_structure}
+        self.layouts = [self.layout(table_name, columns) for table_name, columns in self.tables]
+        self.rows = 0
+
+    def __len__(self):
+        return self.rows
+
+    # The buffer behind a column, if the instances have a value for it
+    def column_buffer(self, column_name):
+        if column_name in self.buffers:
+            return self.buffers[column_name]
+        parts = column_name.split('__')
+        buffer = self.buffers.get(parts[0])
+        for part in parts[1:]:
+            if not isinstance(buffer, StructBuffer):
+                return None
+            buffer = buffer.children.get(part)
+        return buffer
+
+    def layout(self, table_name, columns):
+        buffers = [(name, self.column_buffer(name), column_type) for name, column_type, _ in columns]
+        buffers = [(name, buffer, column_type) for name, buffer, column_type in buffers if buffer is not None]
+        assert buffers, f"No values for any of the columns of {table_name}"
+        normalized = (len(columns) == 2 and len(buffers) == 2 and isinstance(buffers[1][1], ListBuffer)
+                      and not columns[1][1].endswith('[]'))
+        rendered = []
+        for _, buffer, column_type in buffers:
+            if column_type == 'JSONB':
+                buffer = JsonListBuffer(buffer) if normalized else JsonBuffer(buffer)
+            elif column_type == 'JSONB[]':
+                buffer = JsonBuffer(buffer, array=True)
+            rendered.append(buffer)
+        return table_name, [name for name, _, _ in buffers], rendered, normalized
+
+    def append(self, values: Dict[str, Any]):
+        for name, buffer in self.buffers.items():
+            buffer.append(values.get(name))
+        self.rows += 1
+
+    def extend(self, rows):
+        for values in rows:
+            self.append(values)
+
+    def table_names(self):
+        return [table_name for table_name, _, _, _ in self.layouts]
+
+    def table_rows(self, layout):
+        _, _, buffers, normalized = layout
+        return len(buffers[1].elements) if normalized else self.rows
+
+    # The COPY text of one table (a row per instance, or per element for a normalized table)
+    def copy_text(self, layout):
+        _, _, buffers, normalized = layout
+        out = io.StringIO()
+        if normalized:
+            key, elements = buffers[0], buffers[1]
+            for i in range(self.rows):
+                key_text = copy_field(key.text(i))
+                for j in elements.element_range(i):
+                    out.write(f"{key_text}\t{copy_field(elements.elements.text(j))}\n")
+        else:
+            for i in range(self.rows):
+                out.write("\t".join(copy_field(buffer.text(i)) for buffer in buffers))
+                out.write("\n")
+        out.seek(0)
+        return out
+
+    # COPY the batch into its tables; returns {table name: rows written}
+    def copy_to(self, cursor) -> Dict[str, int]:
+        written = {}
+        for layout in self.layouts:
+            table_name, column_names, _, _ = layout
+            rows = self.table_rows(layout)
+            with timed("execute", entity=self.entity.unique_name, table=table_name, rows=rows):
+                cursor.copy_expert(f"COPY {table_name} ({', '.join(column_names)}) FROM STDIN", self.copy_text(layout))
+            written[table_name] = rows
+        return written
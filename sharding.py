@@ -0,0 +1,318 @@
+import json
+import logging
+import re
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Any, Dict, List, Tuple
+
+import psycopg2
+
+from map_select_queries import compile_analyzed, locate_attributes, aggregate_expression, aggregate_alias
+from map_modify_statements import created_keys
+from result_cache import bump_table_versions
+from instrumentation import timed
+
+##############################################################################################################
+### Sharding: the instances are spread over several PostgreSQL databases (the shards), e.g.,
+###
+###     python3 erbium.py init univ example.json --shards 4         (univ_shard0 .. univ_shard3)
+###     python3 erbium.py init univ example.json --shards db1,db2   (any databases, on one or more servers)
+###
+### The database named on the command line is the coordinator: it has the catalog (erdb_objects, which lists the
+### shards under "shards") and the sequences for generated keys, and no data. Every shard has the same tables.
+###
+### Placement: an instance goes to the shard given by the hash of its first attribute, which is the key of the
+### root of its hierarchy: an entity's own key, the key of the parent for subclasses (so an instructor is on the
+### same shard as the person) and weak entities (a section is with its course), and the key of the first entity
+### for a relationship. Multivalued attributes and materialized views are written with the instance, so an entity
+### can always be reassembled on each shard on its own.
+###
+### Queries are scatter-gather: the same SQL runs on all the shards in parallel, and the results are merged.
+###   - filters (WHERE) always run on the shards
+###   - ORDER BY ... LIMIT n OFFSET m: every shard returns its first n + m rows in order, which are merged
+###   - aggregates and GROUP BY: every shard computes partial aggregates per group (COUNT, SUM, MIN, MAX, and SUM
+###     and COUNT for AVG), which are combined per group; ORDER BY, LIMIT and OFFSET are then applied to the groups
+### COUNT(DISTINCT ...) and the like cannot be combined from partial results, and are not supported; nor are
+### traversals (CLOSURE/PATHS), whose paths go across shards.
+##############################################################################################################
+
+SHARDS_OBJECT = "shards"
+
+# The shards for --shards: a number of shards (named after the coordinator) or a list of database names
+def shard_names(db_name, spec) -> List[str]:
+    if spec.isdigit():
+        return [f"{db_name}_shard{i}" for i in range(int(spec))]
+    return [name.strip() for name in spec.split(",") if name.strip()]
+
+def save_shards(cursor, shards):
+    cursor.execute("INSERT INTO erdb_objects (name, data) VALUES (%s, %s)", (SHARDS_OBJECT, json.dumps(shards)))
+
+# The shards of each database, as read with its catalog (load_data) or written by init, so they are never older
+# than the tables and the graph that are in use
+known_shards: Dict[str, Tuple[str, ...]] = {}
+
+def remember_shards(db_name, shards):
+    known_shards[db_name] = tuple(shards)
+
+# The shards of a database (none if it is not sharded)
+def shards_of(db_name) -> Tuple[str, ...]:
+    if db_name not in known_shards:
+        conn = psycopg2.connect(f"dbname={db_name}")
+        cursor = conn.cursor()
+        cursor.execute("SELECT data FROM erdb_objects WHERE name = %s", (SHARDS_OBJECT,))
+        row = cursor.fetchone()
+        cursor.close()
+        conn.close()
+        remember_shards(db_name, row[0] if row else ())
+    return known_shards[db_name]
+
+def not_sharded(db_name, what):
+    assert not shards_of(db_name), f"{what} is not supported on a sharded database"
+
+##############################################################################################################
+### Placement
+##############################################################################################################
+# (crc32 rather than hash(), which is different in every process)
+def shard_of(value, count):
+    return zlib.crc32(str(value).encode()) % count
+
+def placement_attribute(node):
+    return node.attributes_with_structure[0]['attr_name']
+
+# The rows (dicts in the shape that match_to_schema returns) per shard
+def partition(node, rows, count) -> List[List[Dict[str, Any]]]:
+    if count == 1:
+        return [rows]
+    parts = [[] for _ in range(count)]
+    name = placement_attribute(node)
+    for row in rows:
+        parts[shard_of(row.get(name), count)].append(row)
+    return parts
+
+def connect_shards(shards):
+    connections = [psycopg2.connect(f"dbname={shard}") for shard in shards]
+    return [(conn, conn.cursor()) for conn in connections]
+
+##############################################################################################################
+### Scatter-gather queries
+##############################################################################################################
+# How the partial aggregates computed on the shards are combined
+PARTIALS = {"COUNT": ["COUNT"], "SUM": ["SUM"], "MIN": ["MIN"], "MAX": ["MAX"], "AVG": ["SUM", "COUNT"]}
+
+def combine(function, a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if function in ["COUNT", "SUM"]:
+        return a + b
+    return min(a, b) if function == "MIN" else max(a, b)
+
+def final_value(aggregate, partials):
+    if aggregate == "AVG":
+        total, count = partials
+        # (as in PostgreSQL, the average of integers is a numeric)
+        return None if not count else (Decimal(total) if isinstance(total, int) else total) / count
+    return partials[0]
+
+def hashable(value):
+    return tuple(hashable(v) for v in value) if isinstance(value, list) else value
+
+# NULLs come last in ascending order and first in descending order, as in PostgreSQL
+def sort_rows(rows, keys):
+    for lookup, direction in reversed(keys):
+        rows.sort(key=lambda row: (lookup(row) is None, lookup(row) if lookup(row) is not None else 0), reverse=direction == "DESC")
+    return rows
+
+class ShardedQuery:
+    def __init__(self, result, tables, graph):
+        assert 'traversal' not in result, "CLOSURE and PATHS are not supported on a sharded database"
+        self.result = result
+        self.entity = graph.get_node_by_name(result['table_name'])
+        self.locations = locate_attributes(tables, self.entity)
+        columns = result.get('columns')
+        order_by = result.get('order_by', [])
+        group_by = result.get('group_by', [])
+        limit, offset = result.get('limit'), result.get('offset')
+        assert all(isinstance(n, (int, type(None))) for n in [limit, offset]), "Parameters are not supported on a sharded database"
+
+        self.aggregates = [c for c in columns or [] if 'aggregate' in c] + [e for e, _ in order_by if isinstance(e, dict)]
+        self.grouped = bool(self.aggregates or group_by)
+        self.hidden = []
+        if self.grouped:
+            # the groups (even those that are not returned) and the partial aggregates
+            self.partials = OrderedDict()
+            shard_columns = [{'attr_name': name} for name in group_by]
+            for aggregate in self.aggregates:
+                assert not aggregate['distinct'], f"{aggregate_expression(aggregate)} is not supported on a sharded database"
+                expression = aggregate_expression(aggregate)
+                if expression in self.partials:
+                    continue
+                self.partials[expression] = (aggregate['aggregate'], [])
+                for function in PARTIALS[aggregate['aggregate']]:
+                    alias = f"erbium_p{len(shard_columns)}"
+                    shard_columns.append({'aggregate': function, 'attr_name': aggregate['attr_name'], 'distinct': False, 'alias': alias})
+                    self.partials[expression][1].append((function, alias))
+            shard_query = dict(result, columns=shard_columns, order_by=[], limit=None, offset=None)
+            self.group_columns = [c for name in group_by for c in self.expand(name)]
+        else:
+            # every shard returns as many rows as the whole query might need, in order
+            shard_columns = columns
+            if columns is not None:
+                selected = [c['attr_name'] for c in columns]
+                for name, _ in order_by:
+                    if name not in selected and name in self.locations:
+                        shard_columns = shard_columns + [{'attr_name': name}]
+                        self.hidden += self.expand(name)
+            shard_query = dict(result, columns=shard_columns, offset=None,
+                               limit=None if limit is None else limit + (offset or 0))
+        self.sql = compile_analyzed(shard_query, tables, graph)
+
+    def expand(self, name):
+        return self.locations[name]['columns'] if name in self.locations else [name]
+
+    def run_on_shard(self, shard):
+        conn = psycopg2.connect(f"dbname={shard}")
+        cursor = conn.cursor()
+        try:
+            with timed("execute", entity=self.entity.unique_name, table=shard) as timer:
+                cursor.execute(self.sql)
+                rows = cursor.fetchall()
+                timer.rows = len(rows)
+            return [d[0] for d in cursor.description], rows
+        finally:
+            cursor.close()
+            conn.close()
+
+    # Returns (rows, column names), as a query on a single database would
+    def run(self, shards):
+        with ThreadPoolExecutor(len(shards)) as pool:
+            results = list(pool.map(self.run_on_shard, shards))
+        with timed("merge_shards", entity=self.entity.unique_name, rows=sum(len(rows) for _, rows in results)):
+            return self.merge(results)
+
+    def sort_keys(self):
+        keys = []
+        for expr, direction in self.result.get('order_by', []):
+            names = [aggregate_expression(expr)] if isinstance(expr, dict) else self.expand(expr)
+            keys += [((lambda row, name=name: row[name]), direction) for name in names]
+        return keys
+
+    def merge(self, results):
+        column_names = results[0][0]
+        if self.grouped:
+            rows, column_names = self.merge_groups(results)
+        else:
+            rows = [dict(zip(names, row)) for names, shard_rows in results for row in shard_rows]
+        sort_rows(rows, self.sort_keys())
+        offset, limit = self.result.get('offset') or 0, self.result.get('limit')
+        rows = rows[offset:] if limit is None else rows[offset:offset + limit]
+        column_names = [name for name in column_names if name not in self.hidden]
+        return [tuple(row[name] for name in column_names) for row in rows], column_names
+
+    def merge_groups(self, results):
+        groups = OrderedDict()
+        for names, shard_rows in results:
+            for row in shard_rows:
+                values = dict(zip(names, row))
+                key = tuple(hashable(values[name]) for name in self.group_columns)
+                group = groups.get(key)
+                if group is None:
+                    groups[key] = values
+                else:
+                    for _, partials in self.partials.values():
+                        for function, alias in partials:
+                            group[alias] = combine(function, group[alias], values[alias])
+
+        column_names = []
+        for c in self.result.get('columns') or []:
+            column_names += [aggregate_alias(c)] if 'aggregate' in c else self.expand(c['attr_name'])
+        rows = []
+        for group in groups.values():
+            for expression, (aggregate, partials) in self.partials.items():
+                group[expression] = final_value(aggregate, [group[alias] for _, alias in partials])
+            for c in self.result.get('columns') or []:
+                if 'aggregate' in c:
+                    group[aggregate_alias(c)] = group[aggregate_expression(c)]
+            rows.append(group)
+        return rows, column_names
+
+##############################################################################################################
+### Changes (see map_modify_statements.py)
+##############################################################################################################
+# The compiled statements run on every shard, in one distributed transaction. The instances that match are on any
+# of the shards, and the relationships that refer to them may be on others, so the keys of the instances (and of
+# their weak entities) are gathered from all the shards first, and the same keys are then used on all of them:
+# instead of the temporary tables of keys, the statements get the keys as an array (PostgreSQL cannot prepare a
+# transaction that has used temporary tables).
+#
+# The transaction is committed with two-phase commit (PREPARE TRANSACTION on every shard, then COMMIT PREPARED),
+# so the shards need max_prepared_transactions > 0. If a shard fails before all of them are prepared, all of them
+# roll back; if the coordinator fails between the two phases, the transactions that are left prepared keep their
+# locks until they are committed by hand (COMMIT PREPARED '<gid>', see pg_prepared_xacts), which is logged.
+def execute_on_shards(shards, statements, changed, entity_name=None):
+    connections = connect_shards(shards)
+    gid = f"erbium_{uuid.uuid4().hex}"
+    begun = []
+    prepared = False
+    matched = 0
+    try:
+        for (conn, _), shard in zip(connections, shards):
+            conn.tpc_begin(conn.xid(0, gid, shard))
+            begun.append(conn)
+        with timed("execute", entity=entity_name) as timer:
+            gathered = {}
+            for i, (sql, params) in enumerate(statements):
+                keys_table = created_keys(sql)
+                if keys_table is None:
+                    for _, cursor in connections:
+                        cursor.execute(with_keys(sql, gathered), params or None)
+                    continue
+                table_name, select = keys_table
+                keys = set()
+                for _, cursor in connections:
+                    cursor.execute(with_keys(select, gathered), params or None)
+                    keys.update(row[0] for row in cursor.fetchall())
+                if i == 0:
+                    matched = len(keys)
+                    if not keys:
+                        break
+                gathered[table_name] = connections[0][1].mogrify("%s", (sorted(keys),)).decode() if keys else None
+            timer.rows = matched
+        if not matched:
+            for conn in begun:
+                conn.tpc_rollback()
+            return 0
+        with timed("commit", entity=entity_name):
+            for conn, cursor in connections:
+                bump_table_versions(cursor, set(changed))
+                conn.tpc_prepare()
+            prepared = True
+            for conn, _ in connections:
+                conn.tpc_commit()
+    except Exception:
+        if prepared:
+            logging.error("Transaction %s is prepared on (some of) the shards %s and needs COMMIT PREPARED", gid, ", ".join(shards))
+        else:
+            for conn in begun:
+                conn.tpc_rollback()
+        raise
+    finally:
+        for conn, cursor in connections:
+            cursor.close()
+            conn.close()
+    return matched
+
+# Puts the gathered keys (an ARRAY[...] literal, or None if there are none) into a statement in place of the
+# temporary tables of keys (see map_modify_statements.in_keys)
+def with_keys(sql, gathered):
+    for table_name, keys in gathered.items():
+        if keys is None:
+            sql = re.sub(rf"\w+ IN \(SELECT key FROM {table_name}\)", "FALSE", sql)
+        else:
+            sql = sql.replace(f"IN (SELECT key FROM {table_name})", f"= ANY({keys})")
+            sql = sql.replace(f"FROM {table_name} AS keys", f"FROM unnest({keys}) AS keys(key)")
+    return sql
@@ -1,8 +1,9 @@
 from enum import Enum
 from typing import List, Tuple, Union, Dict
-from sql_parser import parse
+from sql_parser import parse, Param, Default
 from pyparsing import ParseResults
 import logging
+from instrumentation import timed
 
 #####################################
 ######## CREATE RELATIONSHIP
@@ -10,11 +11,17 @@ import logging
 def analyze_attribute(attr):
       is_primary_key = 'PRIMARY KEY' in list(attr) 
       is_discriminator = 'DISCRIMINATOR' in list(attr)
-      is_multivalued = (len(attr) == 3 and attr[2] == '[]')
+      is_multivalued = (len(attr) == 3 and attr[2] == '[]') or (attr[1] == 'COMPOSITE' and attr[-1] == '[]')
       sub_attributes = []
       if attr[1] == 'COMPOSITE':
-          for i in range(3, len(attr)-1):
-            sub_attributes.append({'attr_name': attr[i][0], 'attr_type': attr[i][1]})
+          # (name COMPOSITE ( sub, ... ) [])
+          for i in range(3, len(attr) - (2 if is_multivalued else 1)):
+            # composites can be nested (create_composite_type creates the types recursively)
+            if attr[i][1] == 'COMPOSITE':
+                sub_attributes.append(analyze_attribute(attr[i]))
+            else:
+                sub_attributes.append({'attr_name': attr[i][0], 'attr_type': attr[i][1],
+                                       'is_multivalued': len(attr[i]) == 3 and attr[i][2] == '[]'})
       attr_name = attr[0]
       attr_type = attr[1]
       return {
@@ -96,9 +103,11 @@ def convert_entity_parse_results(parse_results) -> Dict[str, Union[str, EntityTy
 ######## INSERT STATEMENT
 ######################################
 def analyze_value(value):
-    if isinstance(value, str):
+    if isinstance(value, Default):
+        return None
+    elif isinstance(value, str):
         return value
-    elif isinstance(value, (int, float)):
+    elif isinstance(value, (int, float, Param)):
         return value
     elif isinstance(value, ParseResults):
         if value[0] == '(' and value[-1] == ')':
@@ -120,9 +129,11 @@ def analyze_insert(parsed_insert):
     }
 
 def convert_value(value):
-    if isinstance(value, str):
+    if isinstance(value, Default):
+        return None
+    elif isinstance(value, str):
         return value
-    elif isinstance(value, (int, float)):
+    elif isinstance(value, (int, float, Param)):
         return value
     elif isinstance(value, ParseResults):
         if value[0] == '(' and value[-1] == ')':
@@ -143,18 +154,88 @@ def analyze_alter(p):
 #####################################
 ######## SELECT
 ######################################
+def analyze_aggregate(agg):
+    return {
+        'aggregate': agg['function'].upper(),
+        'attr_name': agg['argument'][0],
+        'distinct': 'distinct' in agg
+    }
+
+def analyze_select_column(column):
+    if 'function' in column:
+        result = analyze_aggregate(column)
+        result['alias'] = column['alias'][0] if 'alias' in column else None
+        return result
+    return {'attr_name': column[0]}
+
+# LIMIT, OFFSET and MAX DEPTH may be bind parameters
+def as_int(value):
+    return value if isinstance(value, Param) else int(value)
+
 def analyze_select(p):
     lp = list(p)
-    return {'table_name': lp[3]}
+    columns = None if p['columns'][0] == '*' else [analyze_select_column(c) for c in p['columns']]
+
+    order_by = []
+    for item in p.get('order_by', []):
+        expr = item['expr'][0]
+        direction = item['direction'] if 'direction' in item else 'ASC'
+        order_by.append((analyze_aggregate(expr) if isinstance(expr, ParseResults) else expr, direction.upper()))
+
+    return {
+        'table_name': lp[lp.index('FROM') + 1],
+        'columns': columns,
+        'condition': p['condition'].strip() if 'condition' in p else None,
+        'group_by': list(p['group_by']) if 'group_by' in p else [],
+        'order_by': order_by,
+        'limit': as_int(p['limit']) if 'limit' in p else None,
+        'offset': as_int(p['offset']) if 'offset' in p else None
+    }
+
+#####################################
+######## UPDATE / DELETE
+######################################
+# assignments: (attribute path, e.g., ['name', 'lastname'], value) pairs, with the values as in analyze_insert
+def analyze_update(p):
+    return {
+        'modify': 'UPDATE',
+        'table_name': p['table_name'][0],
+        'assignments': [(a[0].split('.'), analyze_value(a[1])) for a in p['assignments']],
+        'condition': p['condition'].strip() if 'condition' in p else None
+    }
 
+def analyze_delete(p):
+    return {
+        'modify': 'DELETE',
+        'table_name': p['table_name'][0],
+        'condition': p['condition'].strip() if 'condition' in p else None
+    }
+
+#####################################
+######## TRAVERSALS
+######################################
+def analyze_traversal(p):
+    return {
+        'traversal': p['traversal'].split()[0],
+        'table_name': p['table_name'][0],
+        'start': p['start'],
+        'reverse': 'reverse' in p,
+        'max_depth': as_int(p['max_depth']) if 'max_depth' in p else None
+    }
 
 ####################### 
 ######### OVERALL
 ####################### 
 def parse_and_analyze(s):
-    logging.debug(f"Parsing: {s}")
-    p = parse(s)
-    logging.debug(f"Result: {p}")
+    # (the arguments are only formatted if debug logging is on)
+    logging.debug("Parsing: %s", s)
+    with timed("parse"):
+        p = parse(s)
+    logging.debug("Result: %s", p)
+    with timed("analyze"):
+        return analyze_parsed(p)
+
+def analyze_parsed(p):
     lp = list(p)
     if 'CREATE' in lp and 'ENTITY' in lp:
         return convert_entity_parse_results(p)
@@ -162,9 +243,15 @@ def parse_and_analyze(s):
         return convert_parse_results_relationship(p)
     elif 'INSERT INTO' in lp:
         return analyze_insert(p)
+    elif 'UPDATE' in lp:
+        return analyze_update(p)
+    elif 'DELETE FROM' in lp:
+        return analyze_delete(p)
     elif 'ALTER' in lp:
         return analyze_alter(p)
     elif 'SELECT' in lp:  
         return analyze_select(p)
+    elif 'CLOSURE OF' in lp or 'PATHS OF' in lp:
+        return analyze_traversal(p)
     else:
         assert False
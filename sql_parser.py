@@ -1,9 +1,31 @@
+import re
 from pyparsing import *
 
 # Helper functions
 def as_list(t):
     return list(t)
 
+# A bind parameter of a prepared statement: $1, $2, ... (a "?" is numbered before parsing, see prepared_statements.py)
+class Param:
+    def __init__(self, index: int):
+        self.index = index
+    def __str__(self):
+        return f"${self.index}"
+    def __repr__(self):
+        return f"Param({self.index})"
+    def __eq__(self, other):
+        return isinstance(other, Param) and other.index == self.index
+    def __hash__(self):
+        return hash(("Param", self.index))
+
+# DEFAULT in the values of an insert: a generated key for the key of an entity (see key_allocation.py), NULL
+# for any other attribute
+class Default:
+    def __repr__(self):
+        return "DEFAULT"
+
+DEFAULT = Default()
+
 # Define keywords
 keywords = ["CREATE", "ENTITY", "RELATIONSHIP", "BETWEEN", "AND", "ONE", "MANY", "TOTAL", "PARTIAL"]
 
@@ -11,193 +33,307 @@ keywords = ["CREATE", "ENTITY", "RELATIONSHIP", "BETWEEN", "AND", "ONE", "MANY",
 keyword_set = set(keyword.lower() for keyword in keywords)
 
 # Custom identifier that excludes keywords
+# (a single regular expression: same as ~MatchFirst(CaselessKeyword(kw) for kw in keywords) + Word(alphas, alphanums + "_"),
+# but without trying each of the keywords separately for every identifier)
+# (wrapped in an And, like the original, so that named results are still lists of tokens)
 def custom_identifier():
-    return ~MatchFirst(CaselessKeyword(kw) for kw in keywords) + Word(alphas, alphanums + "_")
-
-identifier = custom_identifier()
-
-#####################################
-######## Entities
-######################################
-
-# Forward declaration for nested attributes
-attribute = Forward()
-integer = Word(nums)
-string_literal = QuotedString("'", escChar="\\")
-literal = string_literal | integer
-
-# Data types
-data_type = oneOf("INT VARCHAR BOOLEAN DATE", caseless=True)
-
-# Simple attribute
-simple_attribute = Group(
-    identifier
-    + data_type
-    + Optional("[]")
-    + Optional(CaselessKeyword("PRIMARY KEY"))
-    + Optional(CaselessKeyword("DISCRIMINATOR"))
-)
-
-# Composite attribute
-composite_attribute = Group(
-    identifier
-    + CaselessKeyword("COMPOSITE")
-    + "(" + delimitedList(attribute) + ")"
-)
-
-# Define attribute to be either simple or composite
-attribute << (composite_attribute | simple_attribute)
-
-# Attribute list
-attribute_list = Group(delimitedList(attribute))
-
-# Entity table creation
-create_entity_table = (
-    CaselessKeyword("CREATE")
-    + Optional(CaselessKeyword("WEAK"))
-    + CaselessKeyword("ENTITY")
-    + identifier("table_name")
-    + Optional(CaselessKeyword("DEPENDS ON") + identifier("parent_entity"))
-    + Optional(CaselessKeyword("SUBCLASS OF") + identifier("parent_entity"))
-    + "(" + attribute_list("attributes") + ")"
-    + Optional(";")
-)
-
-#####################################
-######## Relationships
-######################################
-# Helper for entity modifiers
-entity_modifier = Group(
-    Optional(identifier("role"))
-    + (CaselessKeyword("ONE") | CaselessKeyword("MANY"))("cardinality")
-    + (CaselessKeyword("TOTAL") | CaselessKeyword("PARTIAL"))("participation")
-)
-
-# Relationship table creation
-create_relationship_table = (
-    CaselessKeyword("CREATE RELATIONSHIP")
-    + identifier("table_name")
-    + "(" + Optional(attribute_list("attributes")) + ")"
-    + CaselessKeyword("BETWEEN")
-    + identifier("entity1")
-    + "(" + entity_modifier("entity1_modifier") + ")"
-    + CaselessKeyword("AND")
-    + identifier("entity2")
-    + "(" + entity_modifier("entity2_modifier") + ")"
-)
-
-#####################################
-######## SELECT
-######################################
-
-# Basic elements
-wildcard = Literal("*")
-
-# Nested select items
-select_item = Forward()
-select_item << (
-    Group(Literal("(") + delimitedList(select_item) + Literal(")"))
-    | Group(Literal("[") + delimitedList(select_item) + Literal("]"))
-    | identifier
-)
-
-# Join condition
-join_condition = identifier
-
-# Table factor (either a simple table or a parenthesized join)
-table_factor = Forward()
-
-# Join expression
-join_expr = Forward()
-
-# Define table_factor as either a simple identifier or a parenthesized join_expr
-table_factor << (identifier | (Literal("(") + join_expr + Literal(")")))
-
-# Define join_expr as a series of joins
-join_expr << (
-    table_factor("left")
-    + ZeroOrMore(
-        CaselessKeyword("JOIN")
-        + identifier("right")
-        + CaselessKeyword("ON")
-        + join_condition("condition")
-    )
-)
-
-# From clause
-from_clause = join_expr
-
-# Select statement (simplified for this example)
-select_stmt = (
-    CaselessKeyword("SELECT")
-    + (Literal("*") | delimitedList(identifier))("columns")
-    + CaselessKeyword("FROM")
-    + from_clause("from_clause")
-    + Optional(CaselessKeyword("WHERE") + SkipTo(StringEnd())("condition"))
-)
-
-
-#####################################
-######## INSERT STAT
-######################################
-# Basic elements
-# Define a floating-point number
-point = Literal('.')
-e = CaselessLiteral('E')
-plusorminus = Literal('+') | Literal('-')
-number = Combine(
-    Optional(plusorminus) +
-    Word(nums) +
-    Optional(point + Optional(Word(nums))) +
-    Optional(e + Optional(plusorminus) + Word(nums))
-)
-
-# Value item (can be nested)
-value_item = Forward()
-value_item << (
-    Group(Literal("(") + delimitedList(value_item) + Literal(")"))
-    | Group(Literal("[") + delimitedList(value_item) + Literal("]"))
-    | string_literal
-    | number
-    | identifier
-)
-
-# Insert statement
-insert_stmt = (
-    CaselessKeyword("INSERT INTO")
-    + identifier("table_name")
-    + CaselessKeyword("VALUES")
-    + Group(Literal("(") + delimitedList(value_item) + Literal(")"))("values")
-)
-
-# Parse action to convert parsed results to a more manageable format
-# insert_stmt.setParseAction(lambda t: dict(t))
-
-#####################################
-######## ALTER TABLE
-######################################
-# Alter table statement
-alter_table = (
-    CaselessKeyword("ALTER TABLE")
-    + identifier("table_name")
-    + (
-        (CaselessKeyword("ADD") + attribute("new_attribute"))
-        | (CaselessKeyword("MODIFY RELATIONSHIP") + CaselessKeyword("TO") + oneOf("ONE-TO-ONE ONE-TO-MANY MANY-TO-MANY", caseless=True)("new_relationship_type"))
-    )
-)
-
-# Full SQL statement
-sql_stmt = (
-    create_entity_table
-    | create_relationship_table
-    | select_stmt
-    | alter_table
-    | insert_stmt
-)
+    return And([Regex(r"(?!(?:" + "|".join(keywords) + r")(?![A-Za-z0-9_$]))[A-Za-z][A-Za-z0-9_]*", flags=re.IGNORECASE)])
+
+# The grammar is only built the first time a statement is parsed (and then kept), so that importing this module
+# (e.g., just to start erbium.py) is cheap
+# (packrat parsing made parsing about twice as slow: once the statement kind is known, there is little backtracking)
+_grammar = None
+
+def grammar():
+    global _grammar
+    if _grammar is None:
+        _grammar = build_grammar()
+    return _grammar
+
+def build_grammar():
+    identifier = custom_identifier()
+
+    #####################################
+    ######## Entities
+    ######################################
+
+    # Forward declaration for nested attributes
+    attribute = Forward()
+    integer = Word(nums)
+    string_literal = QuotedString("'", escChar="\\")
+
+    # Bind parameters (see Param)
+    placeholder = Regex(r"\$[0-9]+").setParseAction(lambda t: Param(int(t[0][1:])))
+    literal = string_literal | integer | placeholder
+
+    # Data types
+    data_type = oneOf("INT VARCHAR BOOLEAN DATE", caseless=True)
+
+    # Simple attribute
+    simple_attribute = Group(
+        identifier
+        + data_type
+        + Optional("[]")
+        + Optional(CaselessKeyword("PRIMARY KEY"))
+        + Optional(CaselessKeyword("DISCRIMINATOR"))
+    )
+
+    # Composite attribute
+    composite_attribute = Group(
+        identifier
+        + CaselessKeyword("COMPOSITE")
+        + "(" + delimitedList(attribute) + ")"
+        + Optional("[]")
+    )
+
+    # Define attribute to be either simple or composite
+    attribute << (composite_attribute | simple_attribute)
+
+    # Attribute list
+    attribute_list = Group(delimitedList(attribute))
+
+    # Entity table creation
+    create_entity_table = (
+        CaselessKeyword("CREATE")
+        + Optional(CaselessKeyword("WEAK"))
+        + CaselessKeyword("ENTITY")
+        + identifier("table_name")
+        + Optional(CaselessKeyword("DEPENDS ON") + identifier("parent_entity"))
+        + Optional(CaselessKeyword("SUBCLASS OF") + identifier("parent_entity"))
+        + "(" + attribute_list("attributes") + ")"
+        + Optional(";")
+    )
+
+    #####################################
+    ######## Relationships
+    ######################################
+    # Helper for entity modifiers
+    entity_modifier = Group(
+        Optional(identifier("role"))
+        + (CaselessKeyword("ONE") | CaselessKeyword("MANY"))("cardinality")
+        + (CaselessKeyword("TOTAL") | CaselessKeyword("PARTIAL"))("participation")
+    )
+
+    # Relationship table creation
+    create_relationship_table = (
+        CaselessKeyword("CREATE RELATIONSHIP")
+        + identifier("table_name")
+        + "(" + Optional(attribute_list("attributes")) + ")"
+        + CaselessKeyword("BETWEEN")
+        + identifier("entity1")
+        + "(" + entity_modifier("entity1_modifier") + ")"
+        + CaselessKeyword("AND")
+        + identifier("entity2")
+        + "(" + entity_modifier("entity2_modifier") + ")"
+    )
+
+    #####################################
+    ######## SELECT
+    ######################################
+
+    # Basic elements
+    wildcard = Literal("*")
+
+    # Nested select items
+    select_item = Forward()
+    select_item << (
+        Group(Literal("(") + delimitedList(select_item) + Literal(")"))
+        | Group(Literal("[") + delimitedList(select_item) + Literal("]"))
+        | identifier
+    )
+
+    # Join condition
+    join_condition = identifier
+
+    # Table factor (either a simple table or a parenthesized join)
+    table_factor = Forward()
+
+    # Join expression
+    join_expr = Forward()
+
+    # Define table_factor as either a simple identifier or a parenthesized join_expr
+    table_factor << (identifier | (Literal("(") + join_expr + Literal(")")))
+
+    # Define join_expr as a series of joins
+    join_expr << (
+        table_factor("left")
+        + ZeroOrMore(
+            CaselessKeyword("JOIN")
+            + identifier("right")
+            + CaselessKeyword("ON")
+            + join_condition("condition")
+        )
+    )
+
+    # From clause
+    from_clause = join_expr
+
+    # Aggregate functions, e.g., COUNT(*), SUM(tot_credits), COUNT(DISTINCT phone_numbers)
+    aggregate_function = MatchFirst(CaselessKeyword(f) for f in ["COUNT", "SUM", "AVG", "MIN", "MAX"])
+    aggregate_call = (
+        aggregate_function("function")
+        + Suppress("(")
+        + Optional(CaselessKeyword("DISTINCT"))("distinct")
+        + (Literal("*") | identifier)("argument")
+        + Suppress(")")
+    )
+
+    # A column in the select list is either an aggregate (with an optional alias) or an attribute
+    select_column = (
+        Group(aggregate_call + Optional(CaselessKeyword("AS") + identifier("alias")))
+        | Group(identifier)
+    )
+
+    # ORDER BY items may refer to attributes, aliases or aggregates
+    order_item = Group(
+        (Group(aggregate_call) | identifier)("expr")
+        + Optional(CaselessKeyword("ASC") | CaselessKeyword("DESC"))("direction")
+    )
+
+    # The WHERE condition is passed through as is, so we only need to know where it ends
+    clause_end = (
+        CaselessKeyword("GROUP BY") | CaselessKeyword("ORDER BY") | CaselessKeyword("LIMIT")
+        | CaselessKeyword("OFFSET") | Literal(";") | StringEnd()
+    )
+
+    # Select statement (simplified for this example)
+    select_stmt = (
+        CaselessKeyword("SELECT")
+        + (Literal("*") | delimitedList(select_column))("columns")
+        + CaselessKeyword("FROM")
+        + from_clause("from_clause")
+        + Optional(CaselessKeyword("WHERE") + SkipTo(clause_end, ignore=string_literal)("condition"))
+        + Optional(CaselessKeyword("GROUP BY") + Group(delimitedList(identifier))("group_by"))
+        + Optional(CaselessKeyword("ORDER BY") + Group(delimitedList(order_item))("order_by"))
+        + Optional(CaselessKeyword("LIMIT") + (integer | placeholder)("limit"))
+        + Optional(CaselessKeyword("OFFSET") + (integer | placeholder)("offset"))
+    )
+
+    #####################################
+    ######## TRAVERSALS
+    ######################################
+    # Transitive closure (or all the paths) over a recursive relationship, starting from one entity, e.g.,
+    #   CLOSURE OF prereq FROM 5 MAX DEPTH 3
+    #   PATHS OF prereq FROM 5 REVERSE
+    traversal_stmt = (
+        (CaselessKeyword("CLOSURE OF") | CaselessKeyword("PATHS OF"))("traversal")
+        + identifier("table_name")
+        + CaselessKeyword("FROM")
+        + literal("start")
+        + Optional(CaselessKeyword("REVERSE"))("reverse")
+        + Optional(CaselessKeyword("MAX DEPTH") + (integer | placeholder)("max_depth"))
+    )
+
+    #####################################
+    ######## INSERT STAT
+    ######################################
+    # Basic elements
+    # Define a floating-point number
+    point = Literal('.')
+    e = CaselessLiteral('E')
+    plusorminus = Literal('+') | Literal('-')
+    number = Combine(
+        Optional(plusorminus) +
+        Word(nums) +
+        Optional(point + Optional(Word(nums))) +
+        Optional(e + Optional(plusorminus) + Word(nums))
+    )
+
+    # Value item (can be nested)
+    value_item = Forward()
+    value_item << (
+        Group(Literal("(") + delimitedList(value_item) + Literal(")"))
+        | Group(Literal("[") + delimitedList(value_item) + Literal("]"))
+        | string_literal
+        | number
+        | placeholder
+        | CaselessKeyword("DEFAULT").setParseAction(lambda t: DEFAULT)
+        | identifier
+    )
+
+    # Insert statement
+    insert_stmt = (
+        CaselessKeyword("INSERT INTO")
+        + identifier("table_name")
+        + CaselessKeyword("VALUES")
+        + Group(Literal("(") + delimitedList(value_item) + Literal(")"))("values")
+    )
+
+    # Parse action to convert parsed results to a more manageable format
+    # insert_stmt.setParseAction(lambda t: dict(t))
+
+    #####################################
+    ######## UPDATE / DELETE
+    ######################################
+    # Set-based changes to the instances of an entity that match a (passed through) condition, e.g.,
+    #   UPDATE person SET city = 'Springfield', name.lastname = 'Smith' WHERE person_id = 5
+    #   DELETE FROM course WHERE credits = '0'
+    statement_end = Literal(";") | StringEnd()
+    attribute_path = Combine(identifier + ZeroOrMore("." + identifier))
+    assignment = Group(attribute_path("attribute") + Suppress("=") + value_item("value"))
+    update_stmt = (
+        CaselessKeyword("UPDATE")
+        + identifier("table_name")
+        + CaselessKeyword("SET")
+        + Group(delimitedList(assignment))("assignments")
+        + Optional(CaselessKeyword("WHERE") + SkipTo(statement_end, ignore=string_literal)("condition"))
+    )
+    delete_stmt = (
+        CaselessKeyword("DELETE FROM")
+        + identifier("table_name")
+        + Optional(CaselessKeyword("WHERE") + SkipTo(statement_end, ignore=string_literal)("condition"))
+    )
+
+    #####################################
+    ######## ALTER TABLE
+    ######################################
+    # Alter table statement
+    alter_table = (
+        CaselessKeyword("ALTER TABLE")
+        + identifier("table_name")
+        + (
+            (CaselessKeyword("ADD") + attribute("new_attribute"))
+            | (CaselessKeyword("MODIFY RELATIONSHIP") + CaselessKeyword("TO") + oneOf("ONE-TO-ONE ONE-TO-MANY MANY-TO-MANY", caseless=True)("new_relationship_type"))
+        )
+    )
+
+    # Full SQL statement
+    sql_stmt = (
+        create_entity_table
+        | create_relationship_table
+        | select_stmt
+        | traversal_stmt
+        | alter_table
+        | insert_stmt
+        | update_stmt
+        | delete_stmt
+    )
+
+    # A parenthesized list of values, e.g., the values bound to a prepared statement: (1, 'Laura', ['123', '456'])
+    value_list = Group(Literal("(") + Optional(delimitedList(value_item)) + Literal(")"))
+
+    # Parse action to convert parsed results to a more manageable format
+    #sql_stmt.setParseAction(as_list)
+
+    return {
+        'create': create_entity_table | create_relationship_table,
+        'select': select_stmt,
+        'closure': traversal_stmt,
+        'paths': traversal_stmt,
+        'alter': alter_table,
+        'insert': insert_stmt,
+        'update': update_stmt,
+        'delete': delete_stmt,
+        'sql_stmt': sql_stmt,
+        'value_list': value_list,
+    }
 
 # Returns a Parsed object
+# The first keyword tells which kind of statement it is, so only that part of the grammar is tried
 def parse(stmt):
-    return sql_stmt.parseString(stmt)
+    g = grammar()
+    first_word = stmt.split(None, 1)[0].lower() if stmt.strip() else ""
+    return g.get(first_word, g['sql_stmt']).parseString(stmt)
 
-# Parse action to convert parsed results to a more manageable format
-#sql_stmt.setParseAction(as_list)
+def parse_values(s):
+    return grammar()['value_list'].parseString(s, parseAll=True)[0]
@@ -0,0 +1,119 @@
+import json
+import os
+import re
+import sys
+
+import psycopg2.extensions
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from er_graph import Graph, serialize_graph, deserialize_graph
+from sql_analyzer import parse_and_analyze
+from construct_create_statements import create_table_statements, figure_out_mappings, create_view_tables
+
+##############################################################################################################
+### Shared fixtures: schemas built as init_database builds them (without a database), and a fake connection
+##############################################################################################################
+
+def load_example():
+    with open(os.path.join(ROOT, "example.json")) as f:
+        return json.load(f)
+
+# (tables, types, graph) for a schema file's contents, with the graph as load_data reads it back from the catalog
+def build_schema(data, mapping=None, composite_storage=None, views=()):
+    graph = Graph()
+    for statement in data["create_entity_statements"]:
+        graph.add_entity(parse_and_analyze(statement))
+    for statement in data.get("create_relationship_statements", []):
+        graph.add_relationship(parse_and_analyze(statement))
+    connected_subgraphs = data[mapping or data["use_connected_subgraph"]]
+    tables, types = create_table_statements(graph, connected_subgraphs, composite_storage or data.get("composite_storage"))
+    figure_out_mappings(graph, connected_subgraphs, tables)
+    serialize_graph(graph)
+    tables += create_view_tables(graph, tables, views)
+    return json.loads(json.dumps(tables)), types, deserialize_graph(serialize_graph(graph))
+
+@pytest.fixture
+def example():
+    return load_example()
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = self.connection = conn
+        self.rows = []
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, sql, params=None):
+        self.conn.log.append(("execute", sql, params))
+        rows, columns = self.conn.respond(sql, params)
+        self.rows = list(rows)
+        self.rowcount = len(self.rows)
+        self.description = [(c,) for c in columns] if columns else None
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def mogrify(self, sql, params):
+        return (sql % tuple(psycopg2.extensions.adapt(p).getquoted().decode() for p in params)).encode()
+
+    def copy_expert(self, sql, file):
+        self.conn.log.append(("copy", sql, file.read()))
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+# responses: [(regex, rows or function (sql, params) -> rows[, column names])]; the first that matches the SQL
+# answers it
+class FakeConnection:
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.log = []
+
+    def respond(self, sql, params):
+        for pattern, rows, *columns in self.responses:
+            if re.search(pattern, sql):
+                return (rows(sql, params) if callable(rows) else rows), (columns[0] if columns else None)
+        return [], None
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def set_session(self, **kwargs):
+        pass
+
+    def commit(self):
+        self.log.append(("commit",))
+
+    def rollback(self):
+        self.log.append(("rollback",))
+
+    def xid(self, format_id, gtrid, bqual):
+        return (format_id, gtrid, bqual)
+
+    def tpc_begin(self, xid):
+        self.log.append(("tpc_begin", xid))
+
+    def tpc_prepare(self):
+        self.log.append(("tpc_prepare",))
+
+    def tpc_commit(self):
+        self.log.append(("tpc_commit",))
+
+    def tpc_rollback(self):
+        self.log.append(("tpc_rollback",))
+
+    def close(self):
+        pass
+
+    def executed(self):
+        return [entry[1] for entry in self.log if entry[0] == "execute"]
@@ -0,0 +1,22 @@
+import entity_export
+from conftest import build_schema, FakeConnection
+
+def test_export_range_filters_on_the_key_of_the_main_table(example, monkeypatch, tmp_path):
+    tables, _, graph = build_schema(example, "connected_subgraphs1")
+    conn = FakeConnection([(r"erbium_key BETWEEN", [(7, 7, "Databases", "4")], ["erbium_key", "course_id", "title", "credits"])])
+    monkeypatch.setattr(entity_export.psycopg2, "connect", lambda dsn: conn)
+    path = tmp_path / "course.jsonl"
+
+    count = entity_export.export_range("univ", tables, graph, "course", "jsonl", str(path), 1, 10)
+
+    assert count == 1
+    [sql] = conn.executed()
+    assert sql.endswith("WHERE erbium_key BETWEEN 1 AND 10")
+    assert " AS erbium_key" in sql
+    # the key is only used for the filter, and is not written out
+    assert path.read_text() == '{"course_id": 7, "title": "Databases", "credits": "4"}\n'
+
+def test_key_range_is_taken_from_the_reassembled_entity(example):
+    tables, _, graph = build_schema(example, "connected_subgraphs1")
+    sql = entity_export.key_range_query(tables, graph, graph.get_node_by_name("course"))
+    assert sql.startswith("SELECT min(erbium_key), max(erbium_key) FROM (SELECT ")
@@ -0,0 +1,33 @@
+import entity_loader
+from conftest import build_schema, FakeConnection
+from entity_loader import EntityLoader
+
+class FakeVersions:
+    def __init__(self):
+        self.version = 1
+
+    def table_versions(self, table_names):
+        return {t: self.version for t in table_names}
+
+def loader(example, monkeypatch, versions=None):
+    tables, _, graph = build_schema(example, "connected_subgraphs1")
+    conn = FakeConnection([(r"FROM rel1 ", [(5, "Databases", "CS", 4)])])
+    monkeypatch.setattr(entity_loader.psycopg2, "connect", lambda dsn: conn)
+    return EntityLoader("univ", tables, graph, versions=versions), conn
+
+def test_without_versions_nothing_is_cached(example, monkeypatch):
+    course_loader, conn = loader(example, monkeypatch)
+    assert course_loader.get_many("course", [5, 6]) == course_loader.get_many("course", [5, 6])
+    assert course_loader.get("course", 5)["title"] == "Databases"
+    assert course_loader.get("course", 6) is None
+    assert len(conn.executed()) == 4 and not course_loader.cache and course_loader.hits == 0
+
+def test_cached_entries_are_dropped_when_their_tables_change(example, monkeypatch):
+    versions = FakeVersions()
+    course_loader, conn = loader(example, monkeypatch, versions)
+    course_loader.get_many("course", [5, 6])
+    assert course_loader.get_many("course", [5, 6])[1] is None
+    assert len(conn.executed()) == 1 and course_loader.hits == 2
+    versions.version = 2
+    course_loader.get("course", 6)
+    assert len(conn.executed()) == 2
@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+import pytest
+
+from erbium_async import AsyncErbium
+
+class FakePlans:
+    def compile(self, query):
+        return query, None
+
+class SlowConnection:
+    async def fetch(self, sql):
+        await asyncio.sleep(0.5)
+        return []
+
+class FakePool:
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return SlowConnection()
+
+    async def __aexit__(self, *exc):
+        pass
+
+class CodecConnection:
+    def __init__(self):
+        self.codecs = {}
+
+    async def set_type_codec(self, type_name, encoder, decoder, schema):
+        self.codecs[(schema, type_name)] = (encoder, decoder)
+
+def test_jsonb_is_decoded():
+    conn = CodecConnection()
+    asyncio.run(AsyncErbium.init_connection(conn))
+    encoder, decoder = conn.codecs[("pg_catalog", "jsonb")]
+    assert decoder('{"a": [1, 2]}') == {"a": [1, 2]}
+    assert json.loads(encoder({"a": 1})) == {"a": 1}
+
+def test_timeout_covers_waiting_for_a_slot():
+    async def run():
+        db = AsyncErbium("univ", max_in_flight=1)
+        db.plans, db.pool = FakePlans(), FakePool()
+        first = asyncio.ensure_future(db.query("select * from person"))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await db.query("select * from course", timeout=0.05)
+        assert await first == []
+    asyncio.run(run())
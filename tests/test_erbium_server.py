@@ -0,0 +1,45 @@
+import io
+import json
+import threading
+
+import psycopg2
+
+from conftest import build_schema
+from map_select_queries import QueryPlanCache
+from erbium_server import ERServer, ERRequestHandler
+
+class FailingPool:
+    def getconn(self):
+        raise psycopg2.OperationalError("the server closed the connection")
+
+def server_for(example):
+    tables, types, graph = build_schema(example, "connected_subgraphs1")
+    server = ERServer.__new__(ERServer)
+    server.db_name, server.tables, server.types, server.graph = "univ", tables, types, graph
+    server.plans = QueryPlanCache(tables, graph)
+    server.pool = FailingPool()
+    server.connections_available = threading.BoundedSemaphore(1)
+    server.cache = None
+    return server
+
+def post(server, path, body):
+    handler = ERRequestHandler.__new__(ERRequestHandler)
+    data = json.dumps(body).encode()
+    handler.server, handler.path, handler.headers = server, path, {"Content-Length": str(len(data))}
+    handler.rfile, handler.wfile = io.BytesIO(data), io.BytesIO()
+    handler.request_version, handler.requestline, handler.client_address = "HTTP/1.1", f"POST {path} HTTP/1.1", ("127.0.0.1", 0)
+    handler.do_POST()
+    status = int(handler.wfile.getvalue().split(b" ", 2)[1])
+    return status, json.loads(handler.wfile.getvalue().split(b"\r\n\r\n", 1)[1])
+
+def test_queries_that_do_not_compile_are_bad_requests(example):
+    server = server_for(example)
+    assert post(server, "/query", {"query": "select nosuch from person"})[0] == 400
+    assert post(server, "/query", {"query": "selec * from person"})[0] == 400
+    assert post(server, "/batch", {"queries": ["select * from nosuch"]})[0] == 400
+    assert post(server, "/query", {"q": "select * from person"})[0] == 400
+
+def test_database_failures_are_server_errors(example):
+    status, body = post(server_for(example), "/query", {"query": "select * from person"})
+    assert status == 500
+    assert body["error"].startswith("OperationalError")
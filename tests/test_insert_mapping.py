@@ -0,0 +1,150 @@
+import json
+
+import pytest
+
+from conftest import build_schema, FakeConnection
+from sql_analyzer import parse_and_analyze
+from map_insert_statements import generate_insert_statements, insert_tables, unflatten_row, match_to_schema
+from row_batches import RowBatch
+
+LAURA = {"person_id": 1, "name": {"firstname": "Laura", "lastname": 'Jack "J" son'}, "street": "Main\tSt", "city": None,
+         "phone_numbers": ["555-1234", "a,b"]}
+
+def person_tables(example, composite_storage=None):
+    tables, types, graph = build_schema(example, "connected_subgraphs4", composite_storage)
+    person = graph.get_node_by_name("person")
+    return person, insert_tables(person, tables, graph), types
+
+def copy_texts(entity, tables, rows):
+    batch = RowBatch(entity, tables)
+    batch.extend(rows)
+    return {layout[0]: (layout[1], batch.copy_text(layout).read()) for layout in batch.layouts}
+
+def test_unflatten_row():
+    attributes = [
+        {"attr_name": "person_id", "attr_type": "INT"},
+        {"attr_name": "name", "attr_type": "COMPOSITE", "sub_attributes": [{"attr_name": "firstname", "attr_type": "VARCHAR"},
+                                                                          {"attr_name": "lastname", "attr_type": "VARCHAR"}]},
+        {"attr_name": "city", "attr_type": "VARCHAR"},
+        {"attr_name": "phone_numbers", "attr_type": "VARCHAR", "is_multivalued": True}]
+    flat = {"person_id": "7", "name__firstname": "Laura", "name__lastname": "", "city": "Paris", "phone_numbers": '["555-1234"]'}
+
+    assert unflatten_row(flat, attributes) == {"person_id": 7, "name": {"firstname": "Laura", "lastname": None}, "city": "Paris",
+                                               "phone_numbers": ["555-1234"]}
+    assert unflatten_row({"person_id": "", "phone_numbers": ""}, attributes)["phone_numbers"] == []
+
+def test_flattened_composites_and_a_normalized_table(example):
+    person, tables, types = person_tables(example)
+
+    statements = [(sql, values) for _, _, sql, values in generate_insert_statements(LAURA, tables, types)]
+    assert statements == [
+        ("INSERT INTO rel0 (person_id, name__firstname, name__lastname, street, city) VALUES (%s, %s, %s, %s, %s)",
+         (1, "Laura", 'Jack "J" son', "Main\tSt", None)),
+        ("INSERT INTO rel1 (person_id, phone_numbers) VALUES (%s, %s)", (1, "555-1234")),
+        ("INSERT INTO rel1 (person_id, phone_numbers) VALUES (%s, %s)", (1, "a,b"))]
+
+    # the same rows, as COPY text (tabs and NULLs escaped), with a row per element in the normalized table
+    assert copy_texts(person, tables, [LAURA]) == {
+        "rel0": (["person_id", "name__firstname", "name__lastname", "street", "city"], '1\tLaura\tJack "J" son\tMain\\tSt\t\\N\n'),
+        "rel1": (["person_id", "phone_numbers"], "1\t555-1234\n1\ta,b\n")}
+
+def test_batches_keep_the_instances_apart(example):
+    person, tables, _ = person_tables(example)
+    rows = [dict(LAURA, phone_numbers=[]), dict(LAURA, person_id=2, name=None, phone_numbers=["1", "2"])]
+
+    texts = copy_texts(person, tables, rows)
+
+    assert texts["rel0"][1] == '1\tLaura\tJack "J" son\tMain\\tSt\t\\N\n2\t\\N\t\\N\tMain\\tSt\t\\N\n'
+    assert texts["rel1"][1] == "2\t1\n2\t2\n"
+
+def test_arrays_are_copied_as_array_literals(example):
+    tables, _, graph = build_schema(example, "connected_subgraphs1")
+    person = graph.get_node_by_name("person")
+
+    texts = copy_texts(person, insert_tables(person, tables, graph), [LAURA])
+
+    assert texts["rel0"][1].endswith('\t{555-1234,"a,b"}\n')
+
+##############################################################################################################
+### Composite storage: flattened, row or jsonb
+##############################################################################################################
+ADDRESSES = {
+    "create_entity_statements": ["CREATE ENTITY person (person_id INT PRIMARY KEY, name COMPOSITE(firstname VARCHAR, lastname VARCHAR), "
+                                 "addrs COMPOSITE(street VARCHAR, zip INT)[])"],
+    "create_relationship_statements": [],
+    "together": [["person", "person.person_id", "person.name", "person.addrs"]],
+    "normalized": [["person", "person.person_id", "person.name"], ["person", "person.addrs"]],
+}
+INSERT = "INSERT INTO person VALUES (1, ('Laura', 'Jackson'), [('Main St', 75001), ('Rue Haute', 1000)])"
+VALUES = {"person_id": 1, "name": {"firstname": "Laura", "lastname": "Jackson"},
+          "addrs": [{"street": "Main St", "zip": 75001}, {"street": "Rue Haute", "zip": 1000}]}
+
+def addresses(mapping, storage):
+    tables, types, graph = build_schema(ADDRESSES, mapping, {"person.name": storage, "person.addrs": storage} if storage else None)
+    person = graph.get_node_by_name("person")
+    return person, insert_tables(person, tables, graph), types
+
+def test_composite_arrays_are_matched_to_lists_of_dicts():
+    person, _, _ = addresses("together", "row")
+    assert match_to_schema("person", parse_and_analyze(INSERT)["values"], person) == VALUES
+
+def test_row_storage():
+    person, tables, types = addresses("together", "row")
+    assert tables == [["rel0", [["person_id", "INTEGER", "person_id"], ["name", "person_name_type", "person.name"],
+                                ["addrs", "person_addrs_type[]", "person.addrs"]]]]
+
+    [(_, _, sql, values)] = generate_insert_statements(VALUES, tables, types)
+    assert sql == ("INSERT INTO rel0 (person_id, name, addrs) VALUES (%s, ROW(%s, %s)::person_name_type, "
+                   "ARRAY[ROW(%s, %s)::person_addrs_type, ROW(%s, %s)::person_addrs_type])")
+    assert values == (1, "Laura", "Jackson", "Main St", 75001, "Rue Haute", 1000)
+
+    # a record literal, and an array of them (with the quotes of the records escaped for the array, and the
+    # backslashes for COPY)
+    assert copy_texts(person, tables, [VALUES])["rel0"][1] == \
+        '1\t(Laura,Jackson)\t{"(\\\\"Main St\\\\",75001)","(\\\\"Rue Haute\\\\",1000)"}\n'
+
+def test_jsonb_storage():
+    person, tables, types = addresses("together", "jsonb")
+    assert [column[1] for column in tables[0][1]] == ["INTEGER", "JSONB", "JSONB[]"]
+
+    [(_, _, sql, values)] = generate_insert_statements(VALUES, tables, types)
+    assert sql == "INSERT INTO rel0 (person_id, name, addrs) VALUES (%s, %s::jsonb, ARRAY[%s::jsonb, %s::jsonb])"
+    assert [getattr(v, "adapted", v) for v in values] == [1, VALUES["name"]] + VALUES["addrs"]
+
+    assert copy_texts(person, tables, [VALUES])["rel0"][1] == (
+        '1\t{"firstname": "Laura", "lastname": "Jackson"}\t'
+        '{"{\\\\"street\\\\": \\\\"Main St\\\\", \\\\"zip\\\\": 75001}","{\\\\"street\\\\": \\\\"Rue Haute\\\\", \\\\"zip\\\\": 1000}"}\n')
+
+@pytest.mark.parametrize("storage", [None, "row", "jsonb"])
+def test_a_normalized_composite_array_gets_a_row_per_element(storage):
+    person, tables, types = addresses("normalized", storage)
+
+    inserts = [values for table_name, _, _, values in generate_insert_statements(VALUES, tables, types) if table_name == "rel1"]
+    texts = copy_texts(person, tables, [VALUES])
+
+    assert len(inserts) == 2
+    assert texts["rel1"][1].count("\n") == 2
+
+def test_composite_arrays_cannot_be_flattened():
+    with pytest.raises(AssertionError, match="cannot be flattened"):
+        addresses("together", "flattened")
+
+def test_insert_statements_for_the_same_entity_are_copied_together(example, tmp_path):
+    from erbium import insert_statements_from
+    tables, types, graph = build_schema(example, "connected_subgraphs4")
+    load_file = tmp_path / "inserts.json"
+    load_file.write_text(json.dumps({"insert_statements": [
+        "INSERT INTO Person VALUES (1, ('Laura', 'Jackson'), 'Main St', 'Paris', ['1', '2']);",
+        "INSERT INTO Person VALUES (2, ('Matthew', 'Long'), 'Side St', 'Rome', ['4']);",
+        "INSERT INTO Person VALUES (3, ('Jacob', 'Lewis'), 'Main St', 'Oslo', ['3']);",
+        "INSERT INTO Course VALUES (7, 'Databases', '4');"]}))
+    conn = FakeConnection()
+
+    insert_statements_from(conn, conn.cursor(), str(load_file), tables, types, graph, batch_size=2)
+
+    copies = [(entry[1].split(" (")[0], entry[2]) for entry in conn.log if entry[0] == "copy"]
+    assert copies == [("COPY rel0", "1\tLaura\tJackson\tMain St\tParis\n2\tMatthew\tLong\tSide St\tRome\n"), ("COPY rel1", "1\t1\n1\t2\n2\t4\n"),
+                      ("COPY rel0", "3\tJacob\tLewis\tMain St\tOslo\n"), ("COPY rel1", "3\t3\n"),
+                      ("COPY rel2", "7\tDatabases\t4\n")]
+    # (a transaction per batch)
+    assert [entry[0] for entry in conn.log].count("commit") == 3
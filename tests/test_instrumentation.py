@@ -0,0 +1,24 @@
+import threading
+
+import instrumentation
+from instrumentation import timed, current_stage
+
+def test_stages_nest_and_are_removed_with_the_outermost():
+    thread_id = threading.get_ident()
+    with timed("execute"):
+        with timed("decode_rows"):
+            assert current_stage(thread_id) == "decode_rows"
+        assert current_stage(thread_id) == "execute"
+    assert current_stage(thread_id) is None
+    assert thread_id not in instrumentation.active_stages
+
+def test_threads_leave_no_stages_behind():
+    def work():
+        with timed("execute"):
+            pass
+    threads = [threading.Thread(target=work) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not any(thread.ident in instrumentation.active_stages for thread in threads)
@@ -0,0 +1,57 @@
+from conftest import build_schema, FakeConnection
+from key_allocation import KeyAllocator
+
+def sequence_responses(size, starts):
+    starts = iter(starts)
+    return [(r"FROM pg_sequences", [(size,)]),
+            (r"nextval", lambda sql, params: [(next(starts),) for _ in range(params[0])])]
+
+def test_keys_are_handed_out_from_blocks(example):
+    _, _, graph = build_schema(example, "connected_subgraphs1")
+    course = graph.get_node_by_name("course")
+    conn = FakeConnection(sequence_responses(1000, [1, 1001, 2001]))
+    keys = KeyAllocator()
+    cursor = conn.cursor()
+
+    assert keys.allocate(cursor, course, 3) == [1, 2, 3]
+    assert keys.allocate(cursor, course, 996) == list(range(4, 1000))
+    # the rest of the first block, and then two new blocks in one statement
+    assert keys.allocate(cursor, course, 1002) == list(range(1000, 2001)) + [2001]
+    nextvals = [entry[2] for entry in conn.log if entry[0] == "execute" and "nextval" in entry[1]]
+    assert nextvals == [(1,), (2,)]
+    assert len([sql for sql in conn.executed() if "pg_sequences" in sql]) == 1
+
+def test_only_missing_keys_are_filled(example):
+    _, _, graph = build_schema(example, "connected_subgraphs1")
+    course = graph.get_node_by_name("course")
+    conn = FakeConnection(sequence_responses(1000, [1]))
+    keys = KeyAllocator()
+    rows = [{"course_id": None, "title": "Databases"}, {"course_id": 42, "title": "Compilers"}, {"title": "Networks"}]
+
+    keys.fill(conn.cursor(), course, rows)
+
+    assert [row["course_id"] for row in rows] == [1, 42, 2]
+    assert list(keys.explicit) == ["erbium_ids_course"]
+
+def test_sync_moves_the_sequence_past_explicit_keys(example):
+    tables, _, graph = build_schema(example, "connected_subgraphs1")
+    course = graph.get_node_by_name("course")
+    conn = FakeConnection([(r"^SELECT GREATEST", [(42,)])])
+    keys = KeyAllocator()
+    keys.fill(conn.cursor(), course, [{"course_id": 42}])
+
+    keys.sync(conn.cursor(), tables, graph)
+
+    assert conn.executed() == ["SELECT GREATEST((SELECT max(course_id) FROM rel1))",
+                               "SELECT setval('erbium_ids_course', GREATEST((SELECT last_value FROM erbium_ids_course), %s))"]
+    assert conn.log[-1][2] == (42,)
+
+def test_sync_skips_hierarchies_without_tables(example):
+    _, _, graph = build_schema(example, "connected_subgraphs1")
+    conn = FakeConnection()
+    keys = KeyAllocator()
+    keys.fill(conn.cursor(), graph.get_node_by_name("course"), [{"course_id": 42}])
+
+    keys.sync(conn.cursor(), [], graph)
+
+    assert conn.executed() == []
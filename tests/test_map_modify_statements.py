@@ -0,0 +1,55 @@
+import pytest
+
+from conftest import build_schema
+from map_modify_statements import compile_modification
+from sql_analyzer import parse_and_analyze
+
+@pytest.fixture
+def univ(example):
+    return build_schema(example, "connected_subgraphs1")
+
+def compiled(univ, query):
+    tables, types, graph = univ
+    return compile_modification(parse_and_analyze(query), tables, types, graph)
+
+def test_update_sets_the_attributes_in_the_tables_that_hold_them(univ):
+    statements, changed = compiled(univ, "UPDATE student SET tot_credits = 5, name.lastname = 'X' WHERE person_id = 1")
+    assert statements == [
+        ("CREATE TEMP TABLE erbium_keys_student ON COMMIT DROP AS SELECT DISTINCT key FROM (SELECT erbium_key AS key FROM "
+         "(SELECT rel0.person_id AS erbium_key, rel0.person_id AS person_id FROM rel0 JOIN rel4 ON rel0.person_id = rel4.person_id) "
+         "AS student WHERE person_id = 1) AS matching", []),
+        ("UPDATE rel0 SET name__lastname = %s WHERE person_id IN (SELECT key FROM erbium_keys_student)", ['X']),
+        ("UPDATE rel4 SET tot_credits = %s WHERE person_id IN (SELECT key FROM erbium_keys_student)", [5])]
+    assert changed == ['rel0', 'rel4']
+
+def test_the_key_cannot_be_updated(univ):
+    with pytest.raises(AssertionError, match="The key person_id of person cannot be updated"):
+        compiled(univ, "UPDATE person SET person_id = 5")
+
+def test_deleting_a_superclass_deletes_the_subclasses_and_their_relationships(univ):
+    statements, changed = compiled(univ, "DELETE FROM person WHERE city = 'Paris'")
+    assert [sql for sql, _ in statements[1:]] == [
+        "DELETE FROM rel0 WHERE person_id IN (SELECT key FROM erbium_keys_person)",
+        "DELETE FROM rel3 WHERE person_id IN (SELECT key FROM erbium_keys_person)",
+        "DELETE FROM rel4 WHERE person_id IN (SELECT key FROM erbium_keys_person)",
+        "DELETE FROM rel5 WHERE person_id IN (SELECT key FROM erbium_keys_person)",
+        "DELETE FROM rel6 WHERE person_id IN (SELECT key FROM erbium_keys_person)",
+        "DELETE FROM rel7 WHERE instructor_id IN (SELECT key FROM erbium_keys_person) OR student_id IN (SELECT key FROM erbium_keys_person)"]
+    assert changed == ['rel0', 'rel3', 'rel4', 'rel5', 'rel6', 'rel7']
+
+def test_deleting_a_subclass_leaves_the_superclass(univ):
+    statements, changed = compiled(univ, "DELETE FROM student WHERE tot_credits < 3")
+    assert statements[0][0].endswith("AS student WHERE tot_credits < 3) AS matching")
+    # (not rel0, the person, nor rel3, the instructor, nor the instructor's relationships)
+    assert [sql for sql, _ in statements[1:]] == [
+        "DELETE FROM rel4 WHERE person_id IN (SELECT key FROM erbium_keys_student)",
+        "DELETE FROM rel5 WHERE person_id IN (SELECT key FROM erbium_keys_student)",
+        "DELETE FROM rel7 WHERE student_id IN (SELECT key FROM erbium_keys_student)"]
+    assert changed == ['rel4', 'rel5', 'rel7']
+
+def test_deleting_an_entity_deletes_its_weak_entities(univ):
+    statements, changed = compiled(univ, "DELETE FROM course WHERE course_id = 5")
+    assert statements[1] == ("CREATE TEMP TABLE erbium_keys_section ON COMMIT DROP AS SELECT DISTINCT section_id AS key "
+                             "FROM rel2 WHERE course_id IN (SELECT key FROM erbium_keys_course)", [])
+    assert "DELETE FROM rel2 WHERE section_id IN (SELECT key FROM erbium_keys_section)" in [sql for sql, _ in statements]
+    assert changed == ['rel1', 'rel2', 'rel5', 'rel6', 'rel8']
@@ -0,0 +1,70 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import build_schema
+from sql_analyzer import parse_and_analyze
+from map_query_results import split_composite_text, decode_rows, decode_columns
+
+def entity_of(statement):
+    return SimpleNamespace(attributes_with_structure=parse_and_analyze(statement)["attributes"])
+
+def test_split_composite_text():
+    assert split_composite_text('(Laura,"Jackson, Jr.",)') == ["Laura", "Jackson, Jr.", None]
+    assert split_composite_text('{"(a,b)",NULL,"say \\"hi\\""}') == ["(a,b)", None, 'say "hi"']
+    assert split_composite_text("{}") == []
+
+def test_flattened_composites_and_arrays(example):
+    _, _, graph = build_schema(example, "connected_subgraphs1")
+    rows = [(1, "Laura", "Jackson", "Main St", "Paris", ["555-1234", "555-9876"])]
+    names = ["person_id", "name__firstname", "name__lastname", "street", "city", "phone_numbers"]
+
+    assert decode_rows(rows, names, graph.get_node_by_name("person")) == [
+        {"person_id": 1, "name": {"firstname": "Laura", "lastname": "Jackson"}, "street": "Main St", "city": "Paris",
+         "phone_numbers": ["555-1234", "555-9876"]}]
+
+def test_composites_as_row_values():
+    entity = entity_of("CREATE ENTITY person (person_id INT PRIMARY KEY, name COMPOSITE(firstname VARCHAR, nicknames VARCHAR[]), "
+                       "addresses COMPOSITE(street VARCHAR, zip INT)[])")
+    rows = [(1, '(Laura,"{Lo,""La La""}")', '{"(Main St,75001)","(Rue Haute,)"}')]
+
+    assert decode_rows(rows, ["person_id", "name", "addresses"], entity) == [
+        {"person_id": 1, "name": {"firstname": "Laura", "nicknames": ["Lo", "La La"]},
+         "addresses": [{"street": "Main St", "zip": 75001}, {"street": "Rue Haute", "zip": None}]}]
+
+def test_booleans_and_dates_are_decoded_however_they_are_stored():
+    entity = entity_of("CREATE ENTITY member (member_id INT PRIMARY KEY, active BOOLEAN, "
+                       "status COMPOSITE(verified BOOLEAN, since DATE, visits INT))")
+    expected = {"member_id": 1, "active": True, "status": {"verified": False, "since": datetime.date(2024, 1, 5), "visits": 3}}
+
+    # a composite type, flattened, and JSONB (booleans and dates are kept as TEXT, whatever the spelling)
+    assert decode_rows([(1, "t", "(f,2024-01-05,3)")], ["member_id", "active", "status"], entity) == [expected]
+    assert decode_rows([(1, "True", "false", "2024-01-05", 3)],
+                       ["member_id", "active", "status__verified", "status__since", "status__visits"], entity) == [expected]
+    assert decode_rows([(1, "true", {"verified": "f", "since": "2024-01-05", "visits": 3})], ["member_id", "active", "status"], entity) == [expected]
+
+def test_columns_that_are_not_attributes_are_passed_through(example):
+    _, _, graph = build_schema(example, "connected_subgraphs1")
+    assert decode_rows([("Paris", 3)], ["city", "count"], graph.get_node_by_name("person")) == [{"city": "Paris", "count": 3}]
+
+def test_arrow_columns(example):
+    pa = pytest.importorskip("pyarrow")
+    _, _, graph = build_schema(example, "connected_subgraphs1")
+    rows = [(1, "Laura", "Jackson", ["555-1234"]), (2, "Ann", None, [])]
+    batch = decode_columns(rows, ["person_id", "name__firstname", "name__lastname", "phone_numbers"], graph.get_node_by_name("person"))
+
+    assert batch.schema.names == ["person_id", "name", "phone_numbers"]
+    assert batch.column(1).to_pylist() == [{"firstname": "Laura", "lastname": "Jackson"}, {"firstname": "Ann", "lastname": None}]
+    assert batch.column(2).to_pylist() == [["555-1234"], []]
+    assert pa.types.is_list(batch.schema.field("phone_numbers").type)
+
+def test_numpy_columns(example):
+    np = pytest.importorskip("numpy")
+    _, _, graph = build_schema(example, "connected_subgraphs1")
+    rows = [(1, "Laura", "Jackson", ["555-1234"]), (2, "Ann", None, [])]
+    columns = decode_columns(rows, ["person_id", "name__firstname", "name__lastname", "phone_numbers"], graph.get_node_by_name("person"), "numpy")
+
+    assert list(columns) == ["person_id", "name.firstname", "name.lastname", "phone_numbers"]
+    assert columns["person_id"].dtype == np.int64
+    assert list(columns["phone_numbers"]) == [["555-1234"], []]
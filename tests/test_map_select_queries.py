@@ -0,0 +1,93 @@
+import pytest
+
+from conftest import build_schema
+from map_select_queries import compile_query
+
+@pytest.fixture
+def univ(example):
+    tables, _, graph = build_schema(example, "connected_subgraphs1")
+    return tables, graph
+
+def compiled(univ, query):
+    tables, graph = univ
+    return compile_query(query, tables, graph)[1]
+
+def test_projection_of_a_flattened_composite(univ):
+    assert compiled(univ, "select name from person") == \
+        "SELECT name__firstname, name__lastname FROM (SELECT name__firstname AS name__firstname, name__lastname AS name__lastname FROM rel0) AS person"
+
+def test_aggregates_over_a_multivalued_attribute_work_on_its_values(univ):
+    assert compiled(univ, "select city, count(phone_numbers) as phones from person group by city order by phones desc limit 10") == (
+        "SELECT city, COUNT(phone_numbers) AS phones FROM (SELECT rel0.city AS city, phone_numbers_values.phone_numbers AS phone_numbers "
+        "FROM rel0 LEFT JOIN LATERAL unnest(rel0.phone_numbers) AS phone_numbers_values(phone_numbers) ON TRUE) AS person "
+        "GROUP BY city ORDER BY phones DESC LIMIT 10")
+
+def test_aggregates_without_an_alias_are_named_after_the_function(univ):
+    assert compiled(univ, "select sum(tot_credits), min(tot_credits) from student") == (
+        "SELECT SUM(tot_credits) AS sum_tot_credits, MIN(tot_credits) AS min_tot_credits "
+        "FROM (SELECT rel4.tot_credits AS tot_credits FROM rel0 JOIN rel4 ON rel0.person_id = rel4.person_id) AS student")
+    assert compiled(univ, "select count(distinct city) from person").startswith("SELECT COUNT(DISTINCT city) AS count_city FROM")
+
+def test_order_by_a_composite_orders_by_its_parts(univ):
+    assert compiled(univ, "select * from person where city = 'Paris' order by name limit 5 offset 10").endswith(
+        "AS person WHERE city = 'Paris' ORDER BY name__firstname ASC, name__lastname ASC LIMIT 5 OFFSET 10")
+
+def test_counting_a_flattened_composite_counts_the_values_with_any_part_set(univ):
+    assert compiled(univ, "select count(name), count(distinct name) as names from person") == (
+        "SELECT COUNT(*) FILTER (WHERE name__firstname IS NOT NULL OR name__lastname IS NOT NULL) AS count_name, "
+        "COUNT(DISTINCT ROW(name__firstname, name__lastname)) FILTER (WHERE name__firstname IS NOT NULL OR name__lastname IS NOT NULL) "
+        "AS names FROM (SELECT name__firstname AS name__firstname, name__lastname AS name__lastname FROM rel0) AS person")
+
+def test_invalid_aggregates_and_attributes_are_rejected(univ):
+    with pytest.raises(AssertionError, match="Cannot compute AVG over composite attribute name"):
+        compiled(univ, "select avg(name) from person")
+    with pytest.raises(AssertionError, match="Unknown attribute nosuch for person"):
+        compiled(univ, "select nosuch from person")
+
+def test_closure_of_a_recursive_relationship(univ):
+    # (UNION, so cycles end)
+    assert compiled(univ, "closure of prereq from 1") == (
+        "WITH RECURSIVE traversal(prereq_id) AS (SELECT prereq_id FROM rel8 WHERE course_id = '1' "
+        "UNION SELECT rel8.prereq_id FROM traversal JOIN rel8 ON rel8.course_id = traversal.prereq_id) "
+        "SELECT prereq_id FROM traversal ORDER BY prereq_id")
+    assert "WHERE traversal.depth < 3) SELECT DISTINCT prereq_id FROM traversal" in compiled(univ, "closure of prereq from 1 max depth 3")
+
+def test_paths_do_not_go_around_cycles(univ):
+    assert compiled(univ, "paths of prereq from 1 max depth 2") == (
+        "WITH RECURSIVE traversal(source, target, depth, path) AS (SELECT course_id, prereq_id, 1, ARRAY[course_id, prereq_id] "
+        "FROM rel8 WHERE course_id = '1' UNION ALL SELECT traversal.source, rel8.prereq_id, traversal.depth + 1, "
+        "traversal.path || rel8.prereq_id FROM traversal JOIN rel8 ON rel8.course_id = traversal.target "
+        "WHERE rel8.prereq_id <> ALL(traversal.path) AND traversal.depth < 2) "
+        "SELECT source AS course_id, target AS prereq_id, depth, path FROM traversal ORDER BY depth, path")
+
+def test_reverse_traversal_follows_the_relationship_backwards(univ):
+    sql = compiled(univ, "paths of prereq from 1 reverse")
+    assert "FROM rel8 WHERE prereq_id = '1'" in sql
+    assert "JOIN rel8 ON rel8.prereq_id = traversal.target" in sql
+
+def test_only_recursive_relationships_can_be_traversed(univ):
+    with pytest.raises(AssertionError, match="takes is not a recursive relationship"):
+        compiled(univ, "closure of takes from 1")
+
+def test_normalized_multivalued_attributes_are_aggregated_per_instance(example):
+    tables, _, graph = build_schema(example, "connected_subgraphs4")
+    assert compile_query("select phone_numbers from person", tables, graph)[1] == (
+        "SELECT phone_numbers FROM (SELECT ARRAY_AGG(phone_numbers) AS phone_numbers "
+        "FROM rel0 JOIN rel1 ON rel0.person_id = rel1.person_id GROUP BY rel0.person_id) AS person")
+    assert compile_query("select city from person order by phone_numbers", tables, graph)[1] == (
+        "SELECT city FROM (SELECT rel0.city AS city, ARRAY_AGG(phone_numbers) AS phone_numbers "
+        "FROM rel0 JOIN rel1 ON rel0.person_id = rel1.person_id GROUP BY rel0.person_id, rel0.city) AS person "
+        "ORDER BY phone_numbers ASC")
+
+def test_aggregates_over_a_multivalued_attribute_cannot_be_mixed_with_others(univ):
+    with pytest.raises(AssertionError, match=r"Cannot compute COUNT\(\*\) together with aggregates over phone_numbers"):
+        compiled(univ, "select count(*), count(phone_numbers) from person")
+    # grouping by one is fine: each group counts the instances that have that value
+    assert compiled(univ, "select phone_numbers, count(*) from person group by phone_numbers").startswith(
+        "SELECT phone_numbers, COUNT(*) AS count FROM")
+
+def test_instances_without_values_are_kept_when_unnesting(example):
+    tables, _, graph = build_schema(example, "connected_subgraphs4")
+    assert compile_query("select city, count(phone_numbers) from person group by city", tables, graph)[1] == (
+        "SELECT city, COUNT(phone_numbers) AS count_phone_numbers FROM (SELECT rel0.city AS city, rel1.phone_numbers AS phone_numbers "
+        "FROM rel0 LEFT JOIN rel1 ON rel0.person_id = rel1.person_id) AS person GROUP BY city")
@@ -0,0 +1,37 @@
+import json
+
+from conftest import build_schema, FakeConnection
+from reference_checks import ReferenceChecker
+
+def test_keys_read_as_strings_are_checked_as_integers(example, tmp_path):
+    tables, _, graph = build_schema(example, "connected_subgraphs1")
+    checker = ReferenceChecker(graph.get_node_by_name("takes"), tables, graph, str(tmp_path))
+    # student 9 does not exist
+    conn = FakeConnection([(r"erbium_key = refs.k0", lambda sql, params: [(k,) for k in params[0] if k == 9])])
+    rows = [{"person_id": "5", "course_id": "1", "grade": "A"}, {"person_id": "9", "course_id": "1", "grade": "B"}]
+
+    valid = checker.check(conn.cursor(), rows)
+    checker.close()
+
+    assert valid == rows[:1]
+    assert sorted(conn.log[0][2][0]) == [5, 9]
+    assert '"erbium_missing": ["student"]' in (tmp_path / "takes.jsonl").read_text()
+
+def test_insert_statements_are_checked_a_batch_at_a_time(example, tmp_path):
+    from erbium import insert_statements_from
+    tables, types, graph = build_schema(example, "connected_subgraphs1")
+    load_file = tmp_path / "takes.json"
+    load_file.write_text(json.dumps({"insert_statements": [
+        "INSERT INTO Takes VALUES (33, 11, 6793, 'D');", "INSERT INTO Takes VALUES (30, 11, 6793, 'F');",
+        "INSERT INTO Takes VALUES (9, 11, 6793, 'A');"]}))
+    # student 9 does not exist
+    conn = FakeConnection([(r"erbium_key = refs.k0", lambda sql, params: [(k,) for k in params[0] if k == 9])])
+    checkers = {}
+
+    insert_statements_from(conn, conn.cursor(), str(load_file), tables, types, graph, checkers, str(tmp_path))
+    checkers["takes"].close()
+
+    checks = [sql for sql in conn.executed() if "refs" in sql]
+    assert len(checks) == len(checkers["takes"].targets)
+    assert [entry[2].count("\n") for entry in conn.log if entry[0] == "copy"] == [2]
+    assert '"erbium_missing": ["student"]' in (tmp_path / "takes.jsonl").read_text()
@@ -0,0 +1,41 @@
+import result_cache
+from conftest import FakeConnection
+from result_cache import ResultCache
+
+class FakeListener(FakeConnection):
+    def __init__(self, versions):
+        super().__init__([(r"FROM erdb_table_versions", lambda sql, params: list(versions.items()))])
+        self.notifies = []
+
+    def set_isolation_level(self, level):
+        pass
+
+    def poll(self):
+        pass
+
+def cache_on(monkeypatch, versions):
+    monkeypatch.setattr(result_cache.psycopg2, "connect", lambda dsn: FakeListener(versions))
+    return ResultCache("univ", ["rel0", "rel1"])
+
+def test_results_are_dropped_when_a_table_changes(monkeypatch):
+    cache = cache_on(monkeypatch, {"rel0": 1, "rel1": 1})
+    rows, versions = cache.get("SELECT city FROM rel0")
+    assert rows is None and versions == {"rel0": 1}
+    cache.put("SELECT city FROM rel0", versions, [("Paris",)])
+    assert cache.get("SELECT city FROM rel0")[0] == [("Paris",)]
+
+    cache.listener.notifies.append(type("Notify", (), {"payload": '{"rel1": 2}'}))
+    assert cache.get("SELECT city FROM rel0")[0] == [("Paris",)]
+    cache.listener.notifies.append(type("Notify", (), {"payload": '{"rel0": 2}'}))
+    assert cache.get("SELECT city FROM rel0")[0] is None
+
+def test_refresh_sees_a_local_change_before_its_notification(monkeypatch):
+    versions = {"rel0": 1, "rel1": 1}
+    cache = cache_on(monkeypatch, versions)
+    cache.put("SELECT city FROM rel0", {"rel0": 1}, [("Paris",)])
+
+    # committed by this process, but the notification has not arrived yet
+    versions["rel0"] = 2
+    cache.refresh()
+
+    assert cache.get("SELECT city FROM rel0")[0] is None
@@ -0,0 +1,75 @@
+from decimal import Decimal
+
+import sharding
+from conftest import build_schema, FakeConnection
+from sql_analyzer import parse_and_analyze
+from map_modify_statements import compile_modification
+from sharding import ShardedQuery, execute_on_shards
+
+def test_partial_aggregates_are_combined_per_group(example):
+    tables, _, graph = build_schema(example, "connected_subgraphs1")
+    query = ShardedQuery(parse_and_analyze("select city, avg(tot_credits) as credits, count(*) as n from student group by city order by n desc"), tables, graph)
+    names = ["city", "erbium_p1", "erbium_p2", "erbium_p3"]
+    results = [(names, [("Paris", 10, 2, 2), ("Rome", 5, 1, 1)]),
+               (names, [("Paris", 20, 1, 2), ("Oslo", None, 0, 1)])]
+
+    rows, column_names = query.merge(results)
+
+    assert column_names == ["city", "credits", "n"]
+    # (a NULL tot_credits is in COUNT(*), but not in the average)
+    assert rows == [("Paris", Decimal(10), 4), ("Rome", Decimal(5), 1), ("Oslo", None, 1)]
+
+def test_order_by_limit_is_applied_after_the_merge(example):
+    tables, _, graph = build_schema(example, "connected_subgraphs1")
+    query = ShardedQuery(parse_and_analyze("select name from person order by city limit 2 offset 1"), tables, graph)
+    assert query.sql.endswith("ORDER BY city ASC LIMIT 3")
+    names = ["name__firstname", "name__lastname", "city"]
+    results = [(names, [("A", "a", "Bergen"), ("C", "c", "Oslo")]), (names, [("B", "b", "Lyon"), ("D", "d", None)])]
+
+    rows, column_names = query.merge(results)
+
+    assert column_names == ["name__firstname", "name__lastname"]
+    assert rows == [("B", "b"), ("C", "c")]
+
+def shard_connections(monkeypatch, responses):
+    connections = {shard: FakeConnection(rows) for shard, rows in responses.items()}
+    monkeypatch.setattr(sharding.psycopg2, "connect", lambda dsn: connections[dsn.split("=", 1)[1]])
+    return connections
+
+def test_changes_use_the_keys_from_all_shards_and_commit_in_two_phases(example, monkeypatch):
+    tables, types, graph = build_schema(example, "connected_subgraphs1")
+    statements, changed = compile_modification(parse_and_analyze("DELETE FROM course WHERE course_id < 10"), tables, types, graph)
+    connections = shard_connections(monkeypatch, {
+        "univ_shard0": [(r"AS matching$", [(5,)]), (r"FROM rel2 WHERE", [(50,)])],
+        "univ_shard1": [(r"AS matching$", [(7,)])],
+    })
+
+    assert execute_on_shards(["univ_shard0", "univ_shard1"], statements, changed, "course") == 2
+
+    for conn in connections.values():
+        executed = conn.executed()
+        assert not any("TEMP TABLE" in sql for sql in executed)
+        assert "DELETE FROM rel1 WHERE course_id = ANY(ARRAY[5,7])" in executed
+        assert "DELETE FROM rel2 WHERE section_id = ANY(ARRAY[50])" in executed
+        kinds = [entry[0] for entry in conn.log]
+        assert kinds[0] == "tpc_begin" and kinds[-2:] == ["tpc_prepare", "tpc_commit"]
+    assert len({conn.log[0][1][1] for conn in connections.values()}) == 1
+
+def test_weak_entities_without_instances_are_left_alone(example, monkeypatch):
+    tables, types, graph = build_schema(example, "connected_subgraphs1")
+    statements, changed = compile_modification(parse_and_analyze("DELETE FROM course WHERE course_id = 5"), tables, types, graph)
+    connections = shard_connections(monkeypatch, {"univ_shard0": [(r"AS matching$", [(5,)])]})
+
+    execute_on_shards(["univ_shard0"], statements, changed, "course")
+
+    assert "DELETE FROM rel2 WHERE FALSE" in connections["univ_shard0"].executed()
+
+def test_nothing_is_changed_if_nothing_matches(example, monkeypatch):
+    tables, types, graph = build_schema(example, "connected_subgraphs1")
+    statements, changed = compile_modification(parse_and_analyze("DELETE FROM course WHERE course_id = 5"), tables, types, graph)
+    connections = shard_connections(monkeypatch, {"univ_shard0": [], "univ_shard1": []})
+
+    assert execute_on_shards(["univ_shard0", "univ_shard1"], statements, changed, "course") == 0
+    for conn in connections.values():
+        assert conn.executed()[1:] == []
+        assert conn.log[-1] == ("tpc_rollback",)
@@ -0,0 +1,36 @@
+import erbium
+from erbium import ERShell
+
+class RecordingLoader:
+    def __init__(self):
+        self.invalidated = 0
+
+    def invalidate(self, entity_name=None, keys=None):
+        self.invalidated += 1
+
+def test_writes_invalidate_looked_up_instances(monkeypatch):
+    monkeypatch.setattr(erbium, "run_modification", lambda *args: 1)
+    shell = ERShell("univ", [], {}, None)
+    shell.loader = RecordingLoader()
+
+    shell.onecmd("update person set city = 'Paris' where person_id = 1")
+    shell.onecmd("delete from person where person_id = 2")
+    shell.do_update("person set city = 'Rome'")
+
+    assert shell.loader.invalidated == 3
+
+class RecordingCache:
+    def __init__(self):
+        self.refreshed = 0
+
+    def refresh(self):
+        self.refreshed += 1
+
+def test_writes_refresh_the_result_cache(monkeypatch):
+    monkeypatch.setattr(erbium, "run_modification", lambda *args: 1)
+    shell = ERShell("univ", [], {}, None)
+    shell.cache = RecordingCache()
+
+    shell.onecmd("delete from person where person_id = 2")
+
+    assert shell.cache.refreshed == 1
@@ -0,0 +1,40 @@
+import threading
+
+from conftest import build_schema, FakeConnection
+from workload import Replayer
+from key_allocation import KeyAllocator
+
+def replayer_on(conn, tables, types, graph):
+    replayer = Replayer.__new__(Replayer)
+    replayer.tables, replayer.types, replayer.graph = tables, types, graph
+    replayer.local = threading.local()
+    replayer.local.conn = conn
+    return replayer
+
+def test_replayed_modification_is_committed(example):
+    tables, types, graph = build_schema(example, "connected_subgraphs1")
+    conn = FakeConnection([(r"^CREATE TEMP TABLE", [(1,), (2,)])])
+    replayer = replayer_on(conn, tables, types, graph)
+
+    matched = replayer.run({"kind": "modify", "statement": "UPDATE person SET city = 'Paris' WHERE person_id < 3"})
+
+    assert matched == 2
+    kinds = [entry[0] for entry in conn.log]
+    assert ("commit",) in conn.log
+    # the update and the version bump are in the committed transaction
+    commit = kinds.index("commit")
+    executed = [entry[1] for entry in conn.log[:commit] if entry[0] == "execute"]
+    assert any(sql.startswith("UPDATE rel0 SET city") for sql in executed)
+    assert any("erdb_table_versions" in sql for sql in executed)
+
+def test_replayed_insert_generates_missing_keys(example):
+    tables, types, graph = build_schema(example, "connected_subgraphs1")
+    conn = FakeConnection([(r"FROM pg_sequences", [(1000,)]), (r"nextval", [(1001,)])])
+    replayer = replayer_on(conn, tables, types, graph)
+    replayer.keys = KeyAllocator()
+
+    replayer.run({"kind": "insert", "statement": "INSERT INTO course VALUES (DEFAULT, 'Databases', '4')"})
+    replayer.run({"kind": "insert_values", "entity": "course", "values": {"title": "Compilers", "credits": "4"}})
+
+    inserts = [params for kind, sql, params in [e for e in conn.log if e[0] == "execute"] if sql.startswith("INSERT INTO rel1")]
+    assert [params[0] for params in inserts] == [1001, 1002]
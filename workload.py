@@ -0,0 +1,264 @@
+import argparse
+import json
+import queue
+import statistics
+import threading
+import time
+
+import psycopg2
+
+##############################################################################################################
+### Workload capture and replay
+###
+### Recording is opt-in: "record on <file>" in the shell, --record <file> for insert/shell/serve, or
+### workload.start_recording(path) from Python. Every ER statement that runs is then appended to the file as one
+### compact JSON line:
+###
+###     {"t": 1718000000.123, "kind": "query", "statement": "select * from person", "sql": "SELECT ...", "ms": 1.2, "rows": 210}
+###
+### kinds: query (SELECT/CLOSURE/PATHS), batch (a list of queries), insert (an ER insert statement), insert_values
+### (an instance of an entity/relationship loaded from a .jsonl/.csv file, as a dict), modify (an ER UPDATE or
+### DELETE) and prepared (a prepared statement, with its parameters). Failed statements are recorded with "error".
+###
+###     python3 workload.py replay <file> <dbname> [--pacing original|fast] [--speed X] [--concurrency N] [--out report.json]
+###
+### re-runs the statements against any database (with any mapping: the statements are compiled again against its
+### catalog), either at the original pacing (optionally sped up) or as fast as possible, over N connections, and
+### reports the latencies per kind next to the recorded ones.
+##############################################################################################################
+
+class WorkloadRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a", buffering=1)
+        self.count = 0
+
+    def record(self, kind, statement, sql=None, seconds=None, rows=None, **extra):
+        entry = {"t": round(time.time(), 6), "kind": kind, "statement": statement}
+        if sql is not None:
+            entry["sql"] = sql
+        if seconds is not None:
+            entry["ms"] = round(seconds * 1000, 3)
+        if rows is not None:
+            entry["rows"] = rows
+        entry.update(extra)
+        line = json.dumps(entry, separators=(",", ":"), default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+recorder = None
+
+def start_recording(path):
+    global recorder
+    stop_recording()
+    recorder = WorkloadRecorder(path)
+    return recorder
+
+def stop_recording():
+    global recorder
+    if recorder is not None:
+        recorder.close()
+        recorder = None
+
+# Called wherever ER statements run; does nothing unless recording is on
+def record(kind, statement, sql=None, seconds=None, rows=None, **extra):
+    if recorder is not None:
+        recorder.record(kind, statement, sql, seconds, rows, **extra)
+
+def read_workload(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+##############################################################################################################
+### Replay
+##############################################################################################################
+class Replayer:
+    def __init__(self, db_name):
+        from erbium import load_data
+        from map_select_queries import QueryPlanCache
+        from key_allocation import KeyAllocator
+        self.db_name = db_name
+        self.tables, self.types, self.graph = load_data(db_name)
+        self.plans = QueryPlanCache(self.tables, self.graph)
+        self.keys = KeyAllocator()
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    # Every replay thread has its own connection (and prepared statements)
+    def connection(self):
+        if not hasattr(self.local, "conn"):
+            from prepared_statements import ERSession
+            self.local.conn = psycopg2.connect(f"dbname={self.db_name}")
+            self.local.session = ERSession(self.db_name, self.tables, self.types, self.graph)
+            self.local.prepared = {}
+            with self.lock:
+                self.connections += [self.local.conn, self.local.session]
+        return self.local.conn
+
+    def close(self):
+        # (as after a load, the sequences are moved past the keys that were given explicitly)
+        if self.keys.explicit:
+            conn = psycopg2.connect(f"dbname={self.db_name}")
+            cursor = conn.cursor()
+            self.keys.sync(cursor, self.tables, self.graph)
+            conn.commit()
+            cursor.close()
+            conn.close()
+        for conn in self.connections:
+            conn.close()
+
+    # Runs one recorded statement; returns the number of rows
+    def run(self, entry):
+        from map_select_queries import compile_batch
+        from map_query_results import decode_rows, decode_json_rows
+        conn = self.connection()
+        cursor = conn.cursor()
+        try:
+            kind = entry["kind"]
+            if kind == "query":
+                sql, entity = self.plans.compile(entry["statement"])
+                cursor.execute(sql)
+                rows = decode_rows(cursor.fetchall(), [d[0] for d in cursor.description], entity)
+                return len(rows)
+            if kind == "batch":
+                _, sql, entities = compile_batch(entry["statement"], self.tables, self.graph)
+                cursor.execute(sql)
+                return sum(len(decode_json_rows(records, entity)) for records, entity in zip(cursor.fetchone(), entities))
+            if kind in ["insert", "insert_values"]:
+                return self.insert(cursor, entry)
+            if kind == "modify":
+                # (committed, with the versions of the changed tables bumped, as in the shell)
+                from sql_analyzer import parse_and_analyze
+                from map_modify_statements import compile_modification, execute_modification
+                query = parse_and_analyze(entry["statement"])
+                statements, changed = compile_modification(query, self.tables, self.types, self.graph)
+                return execute_modification(conn, statements, changed, query["table_name"].lower())
+            if kind == "prepared":
+                prepared = self.local.prepared.get(entry["statement"])
+                if prepared is None:
+                    prepared = self.local.prepared[entry["statement"]] = self.local.session.prepare(entry["statement"])
+                rows = prepared.execute(*entry.get("params", []))
+                # (an insert returns its key, and is recorded as one row)
+                return len(rows)
+            assert False, f"Unknown kind of statement: {kind}"
+        finally:
+            cursor.close()
+            conn.rollback()
+
+    def insert(self, cursor, entry):
+        from sql_analyzer import parse_and_analyze
+        from map_insert_statements import generate_insert_statements, match_to_schema, insert_tables
+        from result_cache import bump_table_versions
+        if entry["kind"] == "insert":
+            parsed = parse_and_analyze(entry["statement"])
+            entity = self.graph.get_node_by_name(parsed["table_name"])
+            values_as_dict = match_to_schema(parsed["table_name"], parsed["values"], entity)
+        else:
+            entity = self.graph.get_node_by_name(entry["entity"])
+            values_as_dict = dict(entry["values"])
+        # (DEFAULT and rows without a key get a generated key, as when they were recorded)
+        self.keys.fill(cursor, entity, [values_as_dict])
+        insert_data = generate_insert_statements(values_as_dict, insert_tables(entity, self.tables, self.graph), self.types)
+        for _, _, statement, values in insert_data:
+            cursor.execute(statement, values)
+        bump_table_versions(cursor, {table_name for table_name, _, _, _ in insert_data})
+        cursor.connection.commit()
+        return 1
+
+def percentiles(times_ms):
+    times_ms = sorted(times_ms)
+    pick = lambda p: times_ms[min(len(times_ms) - 1, int(round((len(times_ms) - 1) * p / 100)))]
+    return {"count": len(times_ms), "p50_ms": round(pick(50), 3), "p95_ms": round(pick(95), 3), "p99_ms": round(pick(99), 3),
+            "mean_ms": round(statistics.mean(times_ms), 3)}
+
+# pacing "original" keeps the gaps between the statements (divided by speed), "fast" runs them back to back;
+# with more than one thread, statements are started in order but may overlap
+def replay(entries, db_name, pacing="original", speed=1.0, concurrency=1):
+    from sharding import not_sharded
+    not_sharded(db_name, "replay")
+    replayer = Replayer(db_name)
+    entries = [e for e in entries if "error" not in e]
+    work = queue.Queue(maxsize=concurrency * 4)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            entry = work.get()
+            if entry is None:
+                return
+            start = time.perf_counter()
+            try:
+                rows, error = replayer.run(entry), None
+            except Exception as e:
+                rows, error = None, f"{type(e).__name__}: {e}"
+            elapsed = time.perf_counter() - start
+            with lock:
+                results.append((entry, elapsed, rows, error))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    first = entries[0]["t"] if entries else 0
+    for entry in entries:
+        if pacing == "original":
+            delay = (entry["t"] - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        work.put(entry)
+    for _ in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    replayer.close()
+
+    report = {"db_name": db_name, "pacing": pacing, "speed": speed, "concurrency": concurrency,
+              "statements": len(results), "wall_s": round(wall, 3),
+              "statements_per_s": round(len(results) / wall, 1) if wall else None,
+              "errors": [{"statement": e["statement"], "error": error} for e, _, _, error in results if error][:20],
+              "error_count": sum(1 for r in results if r[3]), "kinds": {}}
+    for kind in sorted({e["kind"] for e, _, _, _ in results}):
+        replayed = [elapsed * 1000 for e, elapsed, _, error in results if e["kind"] == kind and not error]
+        recorded = [e["ms"] for e, _, _, _ in results if e["kind"] == kind and "ms" in e]
+        report["kinds"][kind] = {"replayed": percentiles(replayed) if replayed else None,
+                                 "recorded": percentiles(recorded) if recorded else None,
+                                 "rows_differ": sum(1 for e, _, rows, error in results
+                                                    if e["kind"] == kind and not error and "rows" in e and e["rows"] != rows)}
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded ER workload")
+    parser.add_argument("command", choices=["replay", "summary"], help="replay the workload, or summarize the recording")
+    parser.add_argument("workload", help="Workload file (JSON lines) written by the recorder")
+    parser.add_argument("db_name", nargs="?", help="Database to replay against")
+    parser.add_argument("--pacing", choices=["original", "fast"], default="fast", help="Keep the recorded gaps between statements, or not")
+    parser.add_argument("--speed", type=float, default=1.0, help="With original pacing, replay this many times faster")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of connections to replay over")
+    parser.add_argument("--out", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    entries = read_workload(args.workload)
+    if args.command == "summary":
+        kinds = {}
+        for entry in entries:
+            kinds.setdefault(entry["kind"], []).append(entry.get("ms", 0))
+        report = {kind: percentiles(times) for kind, times in kinds.items()}
+    else:
+        assert args.db_name, "replay needs a database"
+        report = replay(entries, args.db_name, args.pacing, args.speed, args.concurrency)
+    print(json.dumps(report, indent=4))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == "__main__":
+    main()